@@ -45,6 +45,7 @@ setup(
                       'Flask-Restless>=1.0.0b2.dev0',
                       'Flask-SQLAlchemy',
                       'gpxpy',
+                      'numpy',
                       'OSMAlchemy',
                       'passlib',
                       'Shapely',
@@ -54,7 +55,11 @@ setup(
     test_suite='test',
     entry_points={
                   'console_scripts': [
-                                      'veripeditus-standalone = veripeditus.server:server_main'
+                                      'veripeditus-standalone = veripeditus.server:server_main',
+                                      'veripeditus-spawner = veripeditus.server:spawner_main',
+                                      'veripeditus-push = veripeditus.server:push_main',
+                                      'veripeditus-osm-import = veripeditus.server:osm_import_main',
+                                      'veripeditus-admin = veripeditus.server:admin_main',
                                      ]
                  },
 )
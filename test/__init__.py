@@ -0,0 +1,23 @@
+# veripeditus-server - Server component for the Veripeditus game framework
+# Copyright (C) 2016, 2017  Dominik George <nik@naturalnet.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from veripeditus.server.app import APP, create_app
+from veripeditus.server.control import init
+
+# Register all endpoints and initialise the database in memory once for all tests
+APP.config['SECRET_KEY'] = "test"
+create_app()
+init()
@@ -0,0 +1,60 @@
+# veripeditus-server - Server component for the Veripeditus game framework
+# Copyright (C) 2016, 2017  Dominik George <nik@naturalnet.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+class FrameworkDistanceTests(unittest.TestCase):
+    """ Tests that check vectorized distances in framework.distance """
+
+    def test_haversine(self):
+        """ Test that distances match gpxpy for single pairs """
+
+        from gpxpy import geo
+        from veripeditus.framework.distance import haversine
+
+        for lat1, lon1, lat2, lon2 in [(52.0, 7.0, 52.001, 7.002),
+                                       (52.0, 7.0, 52.0, 7.0),
+                                       (-33.9, 18.4, 51.5, -0.1)]:
+            self.assertAlmostEqual(float(haversine(lat1, lon1, lat2, lon2)),
+                                   geo.haversine_distance(lat1, lon1, lat2, lon2),
+                                   places=3)
+
+    def test_get_distance_matrix(self):
+        """ Test distances between two sets of coordinates """
+
+        from gpxpy import geo
+        from veripeditus.framework.distance import get_distance_matrix, get_distances
+
+        points1 = [(52.0, 7.0), (52.001, 7.0), (52.0, 7.001)]
+        points2 = [(52.0, 7.0), (52.01, 7.01)]
+
+        matrix = get_distance_matrix(points1, points2)
+        self.assertEqual(matrix.shape, (3, 2))
+        for i, point1 in enumerate(points1):
+            for j, point2 in enumerate(points2):
+                self.assertAlmostEqual(matrix[i, j], geo.haversine_distance(*point1, *point2),
+                                       places=3)
+
+        self.assertEqual(list(get_distances(points1, points2[0])), list(matrix[:, 0]))
+        self.assertEqual(get_distance_matrix([], points2).shape, (0, 2))
+
+    def test_get_bbox_mask(self):
+        """ Test selecting coordinates within a bounding box """
+
+        from veripeditus.framework.distance import get_bbox_mask
+
+        mask = get_bbox_mask([52.0, 52.5, 52.05], [7.0, 7.0, 7.5], 51.9, 6.9, 52.1, 7.1)
+        self.assertEqual(list(mask), [True, False, False])
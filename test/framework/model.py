@@ -0,0 +1,459 @@
+# veripeditus-server - Server component for the Veripeditus game framework
+# Copyright (C) 2016, 2017  Dominik George <nik@naturalnet.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from unittest import mock
+
+from veripeditus.server.app import APP, DB
+
+class FrameworkModelTests(unittest.TestCase):
+    """ Tests that check game object handling in framework.model """
+
+    def setUp(self):
+        """ Sets up a request context and a test player """
+
+        self.ctx = APP.test_request_context()
+        self.ctx.push()
+
+        import veripeditus.game.test as testgame
+        from veripeditus.server.model import World
+        self.testgame = testgame
+        self.test_player = testgame.Player()
+        self.test_player.world = World.query.first()
+        DB.session.add(self.test_player)
+        DB.session.commit()
+
+    def tearDown(self):
+        """ Remove test objects and pop request context """
+
+        for item in self.test_player.inventory:
+            DB.session.delete(item)
+        DB.session.delete(self.test_player)
+        DB.session.commit()
+        self.ctx.pop()
+
+    def test_has_item(self):
+        """ Tests counting items in the inventory """
+
+        from veripeditus.framework.model import Item
+
+        self.assertEqual(self.test_player.has_item(self.testgame.Beer), 0)
+        self.assertFalse(self.test_player.has_items(self.testgame.Beer))
+
+        # Counts are updated when items are added
+        self.test_player.new_item(self.testgame.Beer)
+        self.test_player.new_item(self.testgame.Beer)
+        self.assertEqual(self.test_player.has_item(self.testgame.Beer), 2)
+        self.assertTrue(self.test_player.has_items(self.testgame.Beer))
+
+        # Items of derived classes are counted for the base class
+        self.assertEqual(self.test_player.has_item(Item), 2)
+
+    def test_drop_item(self):
+        """ Tests removing items from the inventory """
+
+        self.test_player.new_item(self.testgame.Beer)
+        self.assertEqual(self.test_player.has_item(self.testgame.Beer), 1)
+
+        beer = self.test_player.inventory.one()
+        beer_id = beer.id
+
+        self.test_player.drop_item(self.testgame.Beer)
+        self.assertEqual(self.test_player.has_item(self.testgame.Beer), 0)
+        self.assertEqual(self.test_player.inventory.count(), 0)
+
+        # The deleted item is gone from the session
+        self.assertNotIn(beer, DB.session)
+        self.assertIsNone(self.testgame.Beer.query.get(beer_id))
+
+    def test_drop_items_attributes(self):
+        """ Tests that dropping items removes their attributes """
+
+        from veripeditus.framework.model import GameObjectAttribute, GameObjectsToAttributes
+
+        self.test_player.new_item(self.testgame.Beer)
+        self.test_player.new_item(self.testgame.Beer)
+        for item in self.test_player.inventory:
+            item.set_attribute("brand", "test")
+        DB.session.commit()
+        ids = [item.id for item in self.test_player.inventory]
+
+        self.test_player.drop_items(self.testgame.Beer)
+
+        self.assertEqual(self.test_player.inventory.count(), 0)
+        self.assertEqual(GameObjectsToAttributes.query.filter(
+            GameObjectsToAttributes.gameobject_id.in_(ids)).count(), 0)
+        self.assertEqual(GameObjectAttribute.query.filter(
+            GameObjectAttribute.gameobject_id.in_(ids)).count(), 0)
+
+    def test_attribute_values(self):
+        """ Tests reading and writing attributes independent of the storage """
+
+        from veripeditus.framework.model import GameObject
+
+        self.test_player.set_attribute("level", "1")
+        self.test_player.set_attribute("level", "2")
+        self.test_player.set_attribute("team", "blue")
+        DB.session.commit()
+        DB.session.expire(self.test_player)
+
+        # Only requested keys are looked up
+        self.assertEqual(self.test_player.get_attribute_values(["level", "colour"]), {"level": "2"})
+
+        # Attributes of many objects are loaded at once
+        GameObject.load_attributes([self.test_player])
+        with mock.patch.object(GameObject, "_get_attribute_rows") as get_rows:
+            self.assertEqual(self.test_player.attributes["team"].value, "blue")
+            self.assertEqual(self.test_player.get_attribute_values(["team"]), {"team": "blue"})
+            get_rows.assert_not_called()
+
+    def test_paginate_attributes(self):
+        """ Tests that attributes of a page of game objects are loaded at once """
+
+        from sqlalchemy import event
+        from veripeditus.framework.model import GameObject
+
+        objects = [self.testgame.Beer(world=self.test_player.world) for _ in range(4)]
+        DB.session.add_all(objects)
+        DB.session.commit()
+        for i, obj in enumerate(objects):
+            obj.set_attribute("level", str(i))
+        DB.session.commit()
+        ids = [obj.id for obj in objects]
+        DB.session.expire_all()
+
+        # Count statements while fetching a page and reading the attributes
+        statements = []
+        def _count(conn, cursor, statement, *args): # pylint: disable=unused-argument
+            statements.append(statement)
+        event.listen(DB.engine, "before_cursor_execute", _count)
+        try:
+            page = GameObject.query.filter(GameObject.id.in_(ids)).order_by(GameObject.id).paginate(
+                1, len(ids), error_out=False)
+            levels = [gameobject.attributes["level"].value for gameobject in page.items]
+        finally:
+            event.remove(DB.engine, "before_cursor_execute", _count)
+            for obj in objects:
+                DB.session.delete(obj)
+            DB.session.commit()
+
+        # Page and count, the item table, and all attributes in one query
+        self.assertEqual(levels, ["0", "1", "2", "3"])
+        self.assertEqual(len(statements), 4)
+
+    def test_spawn_player_attributes(self):
+        """ Tests that items can require attributes of the player """
+
+        from flask import g
+
+        beer = self.testgame.Beer(world=self.test_player.world)
+        g.user = mock.Mock(current_player=self.test_player)
+
+        with mock.patch.object(self.testgame.Beer, "spawn_player_attributes", {"level": "2"},
+                               create=True):
+            self.assertFalse(beer.isonmap)
+            self.test_player.set_attribute("level", "1")
+            self.assertFalse(beer.isonmap)
+            self.test_player.set_attribute("level", "2")
+            self.assertTrue(beer.isonmap)
+
+            # Without a user, e.g. in the spawner, the condition does not apply
+            g.user = None
+            self.test_player.set_attribute("level", "1")
+            self.assertTrue(beer.isonmap)
+            self.assertIsNotNone(self.testgame.Beer.isonmap)
+
+    def test_migrate_attributes(self):
+        """ Tests moving attributes to the compact storage """
+
+        from veripeditus.framework.model import (Attribute, GameObjectAttribute,
+                                                 GameObjectsToAttributes, migrate_attributes)
+
+        if APP.config['ATTRIBUTE_STORAGE'] == "compact":
+            self.skipTest("Attributes are already stored compactly.")
+
+        self.test_player.set_attribute("level", "2")
+        DB.session.commit()
+        player_id = self.test_player.id
+
+        self.assertEqual(migrate_attributes(), 1)
+        self.assertEqual(GameObjectsToAttributes.query.count(), 0)
+        self.assertEqual(Attribute.query.count(), 0)
+        attribute = GameObjectAttribute.query.filter_by(gameobject_id=player_id).one()
+        self.assertEqual((attribute.key, attribute.value), ("level", "2"))
+
+        # Running again moves nothing
+        self.assertEqual(migrate_attributes(), 0)
+        DB.session.delete(attribute)
+        DB.session.commit()
+
+    def test_in_bbox(self):
+        """ Tests selecting game objects within a bounding box """
+
+        from veripeditus.framework.model import GameObject
+
+        self.test_player.latitude, self.test_player.longitude = 52.0, 7.0
+        DB.session.commit()
+
+        inside = GameObject.query.filter(GameObject.in_bbox(51.9, 6.9, 52.1, 7.1)).all()
+        outside = GameObject.query.filter(GameObject.in_bbox(52.1, 6.9, 52.3, 7.1)).all()
+        large = GameObject.query.filter(GameObject.in_bbox(40.0, 0.0, 60.0, 10.0)).all()
+
+        self.assertIn(self.test_player, inside)
+        self.assertNotIn(self.test_player, outside)
+        self.assertIn(self.test_player, large)
+
+    def test_backfill_tiles(self):
+        """ Tests filling in tiles of objects stored without one """
+
+        from veripeditus.framework.model import GameObject, backfill_tiles
+
+        self.test_player.latitude, self.test_player.longitude = 52.0, 7.0
+        DB.session.commit()
+        DB.session.execute(GameObject.__table__.update().where(
+            GameObject.__table__.c.id == self.test_player.id).values(tile=None))
+        DB.session.commit()
+
+        self.assertNotIn(self.test_player, GameObject.query.filter(
+            GameObject.in_bbox(51.9, 6.9, 52.1, 7.1)).all())
+        self.assertEqual(backfill_tiles(batch_size=1), 1)
+        self.assertIn(self.test_player, GameObject.query.filter(
+            GameObject.in_bbox(51.9, 6.9, 52.1, 7.1)).all())
+        self.assertEqual(backfill_tiles(), 0)
+
+    def test_prefetch_distances(self):
+        """ Tests that prefetched distances are used until objects move """
+
+        from flask import g
+        from veripeditus.framework.model import GameObject
+
+        self.test_player.latitude, self.test_player.longitude = 52.0, 7.0
+        beer = self.testgame.Beer(world=self.test_player.world, latitude=52.001, longitude=7.0)
+        DB.session.add(beer)
+        DB.session.commit()
+        g.user = mock.Mock(current_player=self.test_player)
+
+        try:
+            GameObject.prefetch_distances([beer])
+            with mock.patch.object(GameObject, "distance_to") as distance_to:
+                self.assertAlmostEqual(beer.distance_to_current_player, 111.2, places=1)
+                distance_to.assert_not_called()
+
+            # Moving the object falls back to calculating the distance
+            beer.latitude = 52.002
+            self.assertAlmostEqual(beer.distance_to_current_player, 222.4, places=1)
+        finally:
+            DB.session.delete(beer)
+            DB.session.commit()
+
+    def test_isonmap_query(self):
+        """ Tests that visibility rules of the game are applied in SQL """
+
+        from flask import g
+        from veripeditus.framework.model import GameObject
+
+        self.test_player.latitude, self.test_player.longitude = 52.0, 7.0
+        near = self.testgame.Beer(world=self.test_player.world, latitude=52.002, longitude=7.0)
+        far = self.testgame.Beer(world=self.test_player.world, latitude=52.0, longitude=7.01)
+        DB.session.add_all([near, far])
+        DB.session.commit()
+        g.user = mock.Mock(current_player=self.test_player)
+
+        try:
+            with mock.patch.object(self.testgame, "VISIBLE_RAD_ITEMS", 500, create=True):
+                items = self.testgame.Beer.query.filter(self.testgame.Beer.isonmap).all()
+                self.assertEqual(items, [near])
+
+                # Polymorphic queries apply the rules of each class
+                visible = GameObject.query.filter(GameObject.isonmap).all()
+                self.assertIn(near, visible)
+                self.assertNotIn(far, visible)
+                self.assertNotIn(self.test_player, visible)
+
+                # Corners of the bounding box are only left out by the exact check
+                far.latitude, far.longitude = 52.004, 7.006
+                DB.session.commit()
+                self.assertNotIn(far, self.testgame.Beer.query.filter(
+                    self.testgame.Beer.isonmap).all())
+                with mock.patch.dict(APP.config, {'VISIBILITY_EXACT': False}):
+                    self.assertIn(far, self.testgame.Beer.query.filter(
+                        self.testgame.Beer.isonmap).all())
+        finally:
+            DB.session.delete(near)
+            DB.session.delete(far)
+            DB.session.commit()
+
+    def test_load_polymorphic(self):
+        """ Tests loading columns of derived classes for base class queries """
+
+        from sqlalchemy import inspect
+        from veripeditus.framework.model import GameObject
+
+        beer = self.testgame.Beer(world=self.test_player.world)
+        DB.session.add(beer)
+        DB.session.commit()
+        beer_id = beer.id
+        DB.session.expunge(beer)
+
+        if APP.config['GAMEOBJECT_WITH_POLYMORPHIC'] is None:
+            # Only the base table is queried
+            self.assertNotIn("gameobject_item", str(GameObject.query.statement))
+            beer = GameObject.query.filter_by(id=beer_id).one()
+            self.assertIsInstance(beer, self.testgame.Beer)
+            self.assertIn("owner_id", inspect(beer).unloaded)
+        else:
+            beer = GameObject.query.filter_by(id=beer_id).one()
+
+        GameObject.load_polymorphic([beer, self.test_player])
+        self.assertNotIn("owner_id", inspect(beer).unloaded)
+
+        DB.session.delete(beer)
+        DB.session.commit()
+
+    def test_paginate_mixed(self):
+        """ Tests that pages of mixed game objects are loaded per class """
+
+        from sqlalchemy import event, inspect
+        from veripeditus.framework.model import GameObject
+
+        objects = [self.testgame.Beer(world=self.test_player.world) for _ in range(4)]
+        objects += [self.testgame.Kangoo(world=self.test_player.world) for _ in range(4)]
+        DB.session.add_all(objects)
+        DB.session.commit()
+        ids = [self.test_player.id] + [obj.id for obj in objects]
+        DB.session.expire_all()
+
+        # Count statements while fetching and serializing a page
+        statements = []
+        def _count(conn, cursor, statement, *args): # pylint: disable=unused-argument
+            statements.append(statement)
+        event.listen(DB.engine, "before_cursor_execute", _count)
+        try:
+            page = GameObject.query.filter(GameObject.id.in_(ids)).order_by(GameObject.id).paginate(
+                1, len(ids), error_out=False)
+            for gameobject in page.items:
+                state = inspect(gameobject)
+                self.assertFalse(state.unloaded & set(state.mapper.columns.keys()))
+        finally:
+            event.remove(DB.engine, "before_cursor_execute", _count)
+            for obj in objects:
+                DB.session.delete(obj)
+            DB.session.commit()
+
+        # Page and count, one query each for the player and item tables,
+        # and one for the attributes
+        self.assertEqual(len(page.items), len(ids))
+        self.assertEqual(len(statements), 5)
+
+    def test_spawn_points(self):
+        """ Tests building and looking up spawn points from OSM data """
+
+        from veripeditus.framework.model import SpawnPoint, SpawnTile
+        from veripeditus.server.app import OA
+
+        tree = OA.node(52.0, 7.0, id=4242)
+        tree.tags["natural"] = "tree"
+        rock = OA.node(52.0001, 7.0, id=4243)
+        rock.tags["natural"] = "rock"
+        DB.session.add_all([tree, rock])
+        DB.session.commit()
+        bboxes = [(51.999, 6.999, 52.001, 7.001)]
+
+        try:
+            # Do not ask Overpass for more data
+            with mock.patch("osmalchemy.triggers._get_elements_by_query",
+                            return_value="<osm></osm>"):
+                points = SpawnPoint.get_in_bboxes(self.testgame.Kangoo, bboxes)
+                self.assertEqual([point.osm_id for point in points], [4242])
+
+                # Known tiles are not built again
+                with mock.patch.object(SpawnPoint, "build") as build:
+                    SpawnPoint.get_in_bboxes(self.testgame.Kangoo, bboxes)
+                    build.assert_not_called()
+
+                # Tiles built without Overpass are built again once it is on
+                SpawnTile.query.update({"from_overpass": False})
+                with mock.patch.object(SpawnPoint, "build") as build:
+                    with mock.patch.dict(APP.config, {'OSM_OVERPASS': False}):
+                        SpawnPoint.get_in_bboxes(self.testgame.Kangoo, bboxes)
+                        build.assert_not_called()
+                    SpawnPoint.get_in_bboxes(self.testgame.Kangoo, bboxes)
+                    build.assert_called_once()
+
+                # Changed OSM data causes the tile to be built again
+                tree.tags["natural"] = "rock"
+                tree.latitude = 52.00001
+                DB.session.commit()
+                points = SpawnPoint.get_in_bboxes(self.testgame.Kangoo, bboxes)
+                self.assertEqual(points, [])
+        finally:
+            DB.session.delete(tree)
+            DB.session.delete(rock)
+            SpawnPoint.query.delete()
+            SpawnTile.query.delete()
+            DB.session.commit()
+
+    def test_spawn_default_osm(self):
+        """ Tests spawning game objects at spawn points """
+
+        from flask import g
+        from veripeditus.framework.model import SpawnPoint
+
+        # Spawn code does not run on behalf of any user
+        g.user = None
+
+        point = SpawnPoint(osm_id=4242, latitude=52.0, longitude=7.0)
+        with mock.patch.object(SpawnPoint, "get_in_bboxes", return_value=[point]):
+            # Only one object is spawned per spawn point
+            self.testgame.Kangoo.spawn_default(self.test_player.world)
+            self.testgame.Kangoo.spawn_default(self.test_player.world)
+
+        kangoos = self.testgame.Kangoo.query.filter_by(osm_element_id=4242).all()
+        try:
+            self.assertEqual(len(kangoos), 1)
+            self.assertEqual((kangoos[0].latitude, kangoos[0].longitude), (52.0, 7.0))
+        finally:
+            for kangoo in kangoos:
+                DB.session.delete(kangoo)
+            DB.session.commit()
+
+    def test_spawn_default_latlon(self):
+        """ Tests spawning game objects within a spawn area """
+
+        from flask import g
+        from gpxpy import geo
+
+        # Spawn code does not run on behalf of any user
+        g.user = None
+
+        kangoo = self.testgame.Kangoo
+        with mock.patch.multiple(kangoo, create=True, spawn_latlon=((52.0, 7.0), 100),
+                                 spawn_min=2, spawn_max=5):
+            kangoo.spawn_default(self.test_player.world)
+            del kangoo._spawn_area
+
+        kangoos = kangoo.query.filter_by(osm_element_id=None).all()
+        try:
+            self.assertEqual(len(kangoos), 5)
+            for obj in kangoos:
+                self.assertLessEqual(geo.haversine_distance(52.0, 7.0, obj.latitude, obj.longitude),
+                                     100.5)
+            # Objects get their own positions
+            self.assertEqual(len({(obj.latitude, obj.longitude) for obj in kangoos}), 5)
+        finally:
+            for obj in kangoos:
+                DB.session.delete(obj)
+            DB.session.commit()
@@ -0,0 +1,155 @@
+# veripeditus-server - Server component for the Veripeditus game framework
+# Copyright (C) 2016, 2017  Dominik George <nik@naturalnet.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+class FrameworkUtilTests(unittest.TestCase):
+    """ Tests that check geographic helpers in framework.util """
+
+    def test_get_bbox_around(self):
+        """ Test that the bounding box contains the whole circle """
+
+        from gpxpy import geo
+        from veripeditus.framework.util import get_bbox_around
+
+        lat_min, lon_min, lat_max, lon_max = get_bbox_around(52.0, 7.0, 100)
+
+        # Edges of the box must be at least radius away from the centre
+        self.assertGreaterEqual(geo.haversine_distance(52.0, 7.0, lat_max, 7.0), 99.9)
+        self.assertGreaterEqual(geo.haversine_distance(52.0, 7.0, lat_min, 7.0), 99.9)
+        self.assertGreaterEqual(geo.haversine_distance(52.0, 7.0, 52.0, lon_max), 99.9)
+        self.assertGreaterEqual(geo.haversine_distance(52.0, 7.0, 52.0, lon_min), 99.9)
+
+    def test_get_tile(self):
+        """ Test calculating slippy map tile numbers """
+
+        from veripeditus.framework.util import get_tile
+
+        # Tile 0/0/0 covers the whole world
+        self.assertEqual(get_tile(52.0, 7.0, zoom=0), 0)
+
+        # Tiles at zoom 1 are numbered row by row from north-west
+        self.assertEqual(get_tile(45.0, -90.0, zoom=1), 0)
+        self.assertEqual(get_tile(45.0, 90.0, zoom=1), 1)
+        self.assertEqual(get_tile(-45.0, -90.0, zoom=1), 2)
+        self.assertEqual(get_tile(-45.0, 90.0, zoom=1), 3)
+
+        # Coordinates outside of the map are clamped
+        self.assertEqual(get_tile(90.0, 180.0, zoom=1), 1)
+
+    def test_get_tile_ranges(self):
+        """ Test that the tile ranges cover a bounding box """
+
+        from veripeditus.framework.util import get_tile, get_tile_ranges
+
+        ranges = get_tile_ranges(51.9, 6.9, 52.1, 7.1)
+
+        # Every corner and the centre must be contained in a range
+        for lat, lon in ((51.9, 6.9), (51.9, 7.1), (52.1, 6.9), (52.1, 7.1), (52.0, 7.0)):
+            tile = get_tile(lat, lon)
+            self.assertTrue(any(first <= tile <= last for first, last in ranges))
+
+        # One range per tile row
+        self.assertEqual(len(ranges), len(set(first for first, _ in ranges)))
+
+    def test_get_tile_blocks(self):
+        """ Test joining tiles to blocks of adjacent tiles """
+
+        from veripeditus.framework.util import get_tile_bbox, get_tile_blocks
+
+        # A square of 2x2 tiles at zoom 2 is one block
+        blocks = get_tile_blocks({1, 2, 5, 6}, zoom=2)
+        self.assertEqual(blocks, [(get_tile_bbox(5, 2)[0], get_tile_bbox(1, 2)[1],
+                                   get_tile_bbox(1, 2)[2], get_tile_bbox(6, 2)[3])])
+
+        # Tiles far apart, or at opposite ends of adjacent rows, are not
+        blocks = get_tile_blocks({3, 4, 9, 15}, zoom=2)
+        self.assertEqual(sorted(blocks), sorted(get_tile_bbox(tile, 2) for tile in (3, 4, 9, 15)))
+
+        # Runs spanning different columns stay separate
+        self.assertEqual(len(get_tile_blocks({0, 1, 4}, zoom=2)), 2)
+
+    def test_get_image_path(self):
+        """ Test looking up image files of a game """
+
+        import os
+        import veripeditus.game.test as testgame
+        from veripeditus.framework.util import get_image_path
+
+        # Images from the framework are found
+        path = get_image_path(testgame, "avatar_fox")
+        self.assertEqual(os.path.basename(path), "avatar_fox.svg")
+        self.assertTrue(os.path.isfile(path))
+
+        # Unknown images fall back to the dummy
+        path = get_image_path(testgame, "nonexistent")
+        self.assertEqual(os.path.basename(path), "dummy.svg")
+        self.assertTrue(os.path.isfile(path))
+
+    def test_image_index_cleared_on_reload(self):
+        """ Test that reloading games invalidates the image index """
+
+        import veripeditus.game.test as testgame
+        from veripeditus.framework.util import _IMAGE_INDEX, get_image_path
+        from veripeditus.server.util import reload_games
+
+        # Fill index, then reload
+        get_image_path(testgame, "avatar_fox")
+        reload_games()
+
+        self.assertNotIn(testgame.__name__, _IMAGE_INDEX)
+
+    def test_spawn_area_polygon(self):
+        """ Test sampling points within a concave polygon """
+
+        from shapely.geometry import Point, Polygon
+        from veripeditus.framework.util import SpawnArea, random_point_in_polygon
+
+        # An L-shaped polygon, given clockwise
+        points = ((52.0, 7.0), (52.2, 7.0), (52.2, 7.1), (52.1, 7.1), (52.1, 7.2), (52.0, 7.2))
+        polygon = Polygon(points)
+
+        samples = SpawnArea(points).sample(1000)
+        self.assertEqual(samples.shape, (1000, 2))
+        self.assertTrue(all(polygon.buffer(1e-9).contains(Point(lat, lon))
+                            for lat, lon in samples))
+
+        # Both arms of the L get points in proportion to their area
+        upper = sum(1 for lat, _ in samples if lat > 52.1)
+        self.assertTrue(200 < upper < 467)
+
+        latlon = random_point_in_polygon(points)
+        self.assertTrue(polygon.buffer(1e-9).contains(Point(*latlon)))
+
+    def test_spawn_area_rect_circle_point(self):
+        """ Test sampling points within rectangles, circles and points """
+
+        from gpxpy import geo
+        from veripeditus.framework.util import SpawnArea
+
+        samples = SpawnArea(((52.0, 7.0), (52.1, 7.2))).sample(100)
+        self.assertTrue(all(52.0 <= lat <= 52.1 and 7.0 <= lon <= 7.2 for lat, lon in samples))
+
+        samples = SpawnArea(((52.0, 7.0), 100)).sample(100)
+        distances = [geo.haversine_distance(52.0, 7.0, lat, lon) for lat, lon in samples]
+        self.assertLessEqual(max(distances), 100.5)
+        self.assertGreater(max(distances), 50)
+
+        samples = SpawnArea((52.0, 7.0)).sample(3)
+        self.assertEqual(samples.tolist(), [[52.0, 7.0]] * 3)
+
+        with self.assertRaises(TypeError):
+            SpawnArea((52.0, (7.0, 7.1)))
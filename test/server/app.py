@@ -14,9 +14,15 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
 
-from veripeditus.server.app import APP
+from sqlalchemy import text
+
+from veripeditus.server.app import APP, DB
 
 class ServerAppTests(unittest.TestCase):
     """ Tests that check game data handling in server.app """
@@ -55,3 +61,77 @@ class ServerAppTests(unittest.TestCase):
         self.assertGreaterEqual(user.active_player.longitude, -180.0)
         self.assertLessEqual(user.active_player.latitude, 90.0)
         self.assertGreaterEqual(user.active_player.latitude, -90.0)
+
+    def test_create_app_no_queries(self):
+        """ Test that starting a worker does not touch the database """
+
+        # Count all statements in a fresh interpreter
+        code = """
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+statements = []
+event.listen(Engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+from veripeditus.server.app import APP, create_app
+APP.config['SECRET_KEY'] = "test"
+create_app()
+print(len(statements))
+"""
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=root,
+                                         stderr=subprocess.DEVNULL, universal_newlines=True)
+        self.assertEqual(output.strip(), "0")
+
+    def test_create_app_secret_key(self):
+        """ Test that workers refuse to start without a secret key """
+
+        from unittest import mock
+        from veripeditus.server.app import create_app
+
+        with mock.patch.dict(APP.config, {'SECRET_KEY': None}):
+            self.assertRaises(RuntimeError, create_app)
+
+    def test_import_accounts(self):
+        """ Test creating users from an accounts list """
+
+        from veripeditus.server.control import import_accounts
+        from veripeditus.server.model import User
+
+        with tempfile.NamedTemporaryFile("w", suffix=".lst", delete=False) as file:
+            file.write("alice secret\nadmin other\n\nbob secret\n")
+        try:
+            self.assertEqual(import_accounts(file.name), 2)
+            self.assertEqual(User.query.filter_by(username="alice").one().password, "secret")
+            # Existing users are not changed
+            self.assertEqual(User.query.filter_by(username="admin").one().password, "admin")
+            self.assertEqual(import_accounts(file.name), 0)
+        finally:
+            os.unlink(file.name)
+            for user in User.query.filter(User.username.in_(["alice", "bob"])):
+                DB.session.delete(user)
+            DB.session.commit()
+
+    def test_migrate(self):
+        """ Test adding missing columns and indexes to existing tables """
+
+        from veripeditus.framework.model import GameObjectTombstone
+        from veripeditus.server.control import migrate
+
+        table = GameObjectTombstone.__table__
+
+        # Replace the table by one from an older version
+        DB.session.remove()
+        with DB.engine.begin() as connection:
+            connection.execute(text("DROP TABLE gameobject_tombstone"))
+            connection.execute(text("CREATE TABLE gameobject_tombstone (id INTEGER PRIMARY KEY, "
+                                    "created DATETIME, updated DATETIME, gameobject_id INTEGER, "
+                                    "world_id INTEGER, longitude FLOAT)"))
+        try:
+            self.assertEqual(migrate(), ["added column gameobject_tombstone.latitude",
+                                         "created index ix_gameobject_tombstone_world_created"])
+            with DB.engine.begin() as connection:
+                connection.execute(table.insert().values(gameobject_id=1, latitude=1.0,
+                                                         longitude=2.0))
+            self.assertEqual(migrate(), [])
+        finally:
+            table.drop(DB.engine)
+            table.create(DB.engine)
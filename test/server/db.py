@@ -0,0 +1,179 @@
+# veripeditus-server - Server component for the Veripeditus game framework
+# Copyright (C) 2016, 2017  Dominik George <nik@naturalnet.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from flask import Flask
+from sqlalchemy.pool import QueuePool
+
+from veripeditus.server.app import APP
+
+class ServerDBTests(unittest.TestCase):
+    """ Tests that check the engine configuration in server.db """
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, "veripeditus.sqlite")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _get_db(self, profile, **config):
+        """ Get an extension for a separate application using the
+        default settings, a profile if not None and extra settings.
+        """
+
+        from veripeditus.server.db import PROFILES, ConfiguredSQLAlchemy
+
+        app = Flask(__name__)
+        app.config.update({key: value for key, value in APP.config.items()
+                           if key.startswith("DB_")})
+        if profile is not None:
+            app.config.update(PROFILES[profile])
+        app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///" + self.path
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        app.config.update(config)
+
+        db = ConfiguredSQLAlchemy(app)
+        self.addCleanup(lambda: db.get_engine(app).dispose())
+        return db, app
+
+    def test_sqlite_workers_profile(self):
+        """ Test the pragmas and pooling of the SQLite worker profile """
+
+        db, app = self._get_db("sqlite-workers")
+        engine = db.get_engine(app)
+
+        self.assertIsInstance(engine.pool, QueuePool)
+        with engine.connect() as conn:
+            self.assertEqual(conn.scalar("PRAGMA journal_mode"), "wal")
+            self.assertEqual(conn.scalar("PRAGMA synchronous"), 1)
+            self.assertEqual(conn.scalar("PRAGMA busy_timeout"), 30000)
+            dbapi_connection = conn.connection.connection
+
+        # Connections are reused, also from other threads
+        with engine.connect() as conn:
+            self.assertIs(conn.connection.connection, dbapi_connection)
+        results = []
+        thread = threading.Thread(target=lambda: results.append(engine.scalar("SELECT 1")))
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [1])
+        self.assertEqual(engine.pool.checkedout(), 0)
+
+    def test_sqlite_workers_concurrent_writes(self):
+        """ Test that a writer waits for another worker's transaction """
+
+        db, app = self._get_db("sqlite-workers", DB_SQLITE_BUSY_TIMEOUT=10)
+        other, other_app = self._get_db("sqlite-workers", DB_SQLITE_BUSY_TIMEOUT=10)
+        engine, other_engine = db.get_engine(app), other.get_engine(other_app)
+        engine.execute("CREATE TABLE counter (value INTEGER)")
+
+        # Hold the write lock in one worker while the other writes
+        conn = engine.connect()
+        trans = conn.begin()
+        conn.execute("INSERT INTO counter VALUES (1)")
+        thread = threading.Thread(target=other_engine.execute,
+                                  args=("INSERT INTO counter VALUES (2)",))
+        thread.start()
+        thread.join(0.5)
+        self.assertTrue(thread.is_alive())
+
+        # Readers are not blocked by the writer
+        self.assertEqual(other_engine.scalar("SELECT count(*) FROM counter"), 0)
+
+        trans.commit()
+        conn.close()
+        thread.join()
+        self.assertEqual(engine.scalar("SELECT count(*) FROM counter"), 2)
+
+    def test_pre_ping(self):
+        """ Test that connections closed behind the pool are replaced """
+
+        db, app = self._get_db("sqlite-workers", DB_POOL_PRE_PING=True)
+        engine = db.get_engine(app)
+
+        with engine.connect() as conn:
+            dbapi_connection = conn.connection.connection
+        dbapi_connection.close()
+
+        with engine.connect() as conn:
+            self.assertIsNot(conn.connection.connection, dbapi_connection)
+            self.assertEqual(conn.scalar("SELECT 1"), 1)
+
+    def test_defaults(self):
+        """ Test that SQLite files are not pooled without a pool size """
+
+        db, app = self._get_db("sqlite-workers", DB_POOL_SIZE=None,
+                               DB_SQLITE_JOURNAL_MODE=None)
+        engine = db.get_engine(app)
+
+        self.assertNotIsInstance(engine.pool, QueuePool)
+        self.assertEqual(engine.scalar("PRAGMA journal_mode"), "delete")
+
+    def test_engine_options(self):
+        """ Test the engine options built from the DB_* settings """
+
+        from veripeditus.server.db import _SA_VERSION, PROFILES, get_engine_options
+
+        config = {key: value for key, value in APP.config.items() if key.startswith("DB_")}
+        config.update(PROFILES["postgresql-workers"])
+        config['SQLALCHEMY_DATABASE_URI'] = "postgresql://veripeditus@localhost/veripeditus"
+
+        options = get_engine_options(config)
+        self.assertEqual(options['pool_size'], 5)
+        self.assertEqual(options['pool_recycle'], 1800)
+        self.assertEqual(options.get('pool_pre_ping', False), _SA_VERSION >= (1, 2))
+
+        # Databases in memory are never pooled
+        config['SQLALCHEMY_DATABASE_URI'] = "sqlite://"
+        self.assertEqual(get_engine_options(config), {})
+
+        # Options set in the configuration take precedence
+        db, app = self._get_db("sqlite-workers",
+                               SQLALCHEMY_ENGINE_OPTIONS={'max_overflow': 1})
+        self.assertEqual(app.config['SQLALCHEMY_ENGINE_OPTIONS']['max_overflow'], 1)
+        self.assertEqual(db.get_engine(app).pool._max_overflow, 1)
+
+    def test_get_database_now(self):
+        """ Test that the database time is comparable with timestamp columns """
+
+        from datetime import datetime, timezone
+        from veripeditus.server.db import get_database_now
+
+        # PostgreSQL returns the time with a time zone
+        session = mock.Mock()
+        session.query.return_value.scalar.return_value = datetime(
+            2017, 1, 1, 12, 0, tzinfo=timezone.utc)
+        self.assertEqual(get_database_now(session), datetime(2017, 1, 1, 12, 0))
+
+        # SQLite returns it without
+        db, app = self._get_db(None)
+        with app.app_context():
+            self.assertIsNone(get_database_now(db.session).tzinfo)
+
+    def test_session_pragmas(self):
+        """ Test that connections of the session get the SQLite pragmas """
+
+        db, app = self._get_db("sqlite-workers", DB_SQLITE_SYNCHRONOUS="OFF")
+        with app.app_context():
+            self.assertEqual(db.session.execute("PRAGMA journal_mode").scalar(), "wal")
+            self.assertEqual(db.session.execute("PRAGMA synchronous").scalar(), 0)
+            db.session.remove()
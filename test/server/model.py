@@ -71,3 +71,39 @@ class ServerModelTests(unittest.TestCase):
         # Check that, through auto coercion, the password can be verified
         # by direct comparison
         self.assertEqual(self.test_user.password, test_pw)
+
+    def test_user_get_authenticated_cached(self):
+        """ Tests that cached credentials are verified and invalidated """
+
+        from veripeditus.server.model import _CREDENTIAL_CACHE
+
+        # First login verifies and caches the credentials
+        self.assertIs(User.get_authenticated("test", "test"), self.test_user)
+        self.assertIsNotNone(_CREDENTIAL_CACHE.get("test", "test"))
+
+        # Second login is served from the cache, wrong passwords are not
+        self.assertIs(User.get_authenticated("test", "test"), self.test_user)
+        self.assertIsNone(User.get_authenticated("test", "wrong"))
+
+        # Changing the password invalidates the cached credentials
+        self.test_user.password = "changed"
+        DB.session.commit()
+        self.assertIsNone(_CREDENTIAL_CACHE.get("test", "test"))
+        self.assertIsNone(User.get_authenticated("test", "test"))
+        self.assertIs(User.get_authenticated("test", "changed"), self.test_user)
+
+    def test_user_token(self):
+        """ Tests that session tokens identify the user until the password changes """
+
+        token = self.test_user.create_token()
+
+        # The token identifies the user
+        self.assertIs(User.get_by_token(token), self.test_user)
+
+        # Tampered tokens are rejected
+        self.assertIsNone(User.get_by_token(token + "x"))
+
+        # Changing the password invalidates the token
+        self.test_user.password = "changed"
+        DB.session.commit()
+        self.assertIsNone(User.get_by_token(token))
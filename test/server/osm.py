@@ -0,0 +1,236 @@
+# veripeditus-server - Server component for the Veripeditus game framework
+# Copyright (C) 2016, 2017  Dominik George <nik@naturalnet.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime
+import gzip
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from sqlalchemy import event
+
+from veripeditus.server.app import APP, DB, OA
+
+_TEST_OSM = b"""<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <node id="9001" lat="52.0" lon="7.0" version="2" user="test" timestamp="2017-01-01T00:00:00Z">
+  <tag k="natural" v="tree"/>
+ </node>
+ <node id="9002" lat="52.001" lon="7.001"/>
+ <way id="9003">
+  <nd ref="9001"/>
+  <nd ref="9002"/>
+  <tag k="highway" v="path"/>
+ </way>
+</osm>
+"""
+
+class ServerOSMTests(unittest.TestCase):
+    """ Tests that check OSM data handling in server.osm """
+
+    def setUp(self):
+        # Never ask Overpass for data
+        self.config = mock.patch.dict(APP.config, {'OSM_OVERPASS': False})
+        self.config.start()
+
+        fd, self.path = tempfile.mkstemp(suffix=".osm.gz")
+        os.close(fd)
+        with gzip.open(self.path, "wb") as fileobj:
+            fileobj.write(_TEST_OSM)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+        for element in DB.session.query(OA.element).filter(OA.element.id.in_([9001, 9002, 9003])):
+            DB.session.delete(element)
+        DB.session.commit()
+        self.config.stop()
+
+    def test_overpass_switch(self):
+        """ Test that Overpass is only queried if enabled """
+
+        from veripeditus.server.osm import OverpassSwitch
+
+        api = mock.Mock()
+        switch = OverpassSwitch(api)
+
+        self.assertIn("<osm", switch.Get("node(1);", responseformat="xml"))
+        api.Get.assert_not_called()
+
+        with mock.patch.dict(APP.config, {'OSM_OVERPASS': True}):
+            switch.Get("node(1);", responseformat="xml")
+        api.Get.assert_called_once_with("node(1);", responseformat="xml")
+
+        # Queries answered without Overpass are not recorded as run
+        query = OA.cached_query(oql_hash="test")
+        query.oql_queried = datetime(2017, 1, 1)
+        self.assertEqual(query.oql_queried, datetime(1970, 1, 1))
+        with mock.patch.dict(APP.config, {'OSM_OVERPASS': True}):
+            query.oql_queried = datetime(2017, 1, 1)
+        self.assertEqual(query.oql_queried, datetime(2017, 1, 1))
+
+    def test_import_osm_file(self):
+        """ Test importing an OSM XML extract in small batches """
+
+        from veripeditus.server.osm import import_osm_file
+
+        counts = import_osm_file(self.path, batch_size=1)
+        self.assertEqual(counts, {"node": 2, "way": 1})
+
+        node = DB.session.query(OA.node).filter_by(id=9001).one()
+        self.assertEqual((node.latitude, node.longitude), (52.0, 7.0))
+        self.assertEqual(dict(node.tags), {"natural": "tree"})
+        self.assertEqual(node.version, 2)
+        way = DB.session.query(OA.way).filter_by(id=9003).one()
+        self.assertEqual([node.id for node in way.nodes], [9001, 9002])
+        self.assertEqual(dict(way.tags), {"highway": "path"})
+        DB.session.remove()
+
+        # Importing again replaces the elements and keeps the way intact
+        import_osm_file(self.path)
+        self.assertEqual(DB.session.query(OA.node).filter_by(id=9001).count(), 1)
+        way = DB.session.query(OA.way).filter_by(id=9003).one()
+        self.assertEqual([node.id for node in way.nodes], [9001, 9002])
+
+    def test_import_osm_file_nodes_of_ways(self):
+        """ Test re-importing nodes of ways that are not part of the import """
+
+        from veripeditus.server.osm import import_osm_file
+
+        import_osm_file(self.path)
+
+        # Only the node, which the way still refers to
+        with gzip.open(self.path, "wb") as fileobj:
+            data = _TEST_OSM.replace(b'lat="52.0"', b'lat="52.0005"')
+            fileobj.write(data[:data.index(b'<node id="9002"')] + b"</osm>")
+        statements = []
+        def _record(conn, cursor, statement, *args): # pylint: disable=unused-argument
+            statements.append(statement)
+        event.listen(DB.engine, "before_cursor_execute", _record)
+        try:
+            counts = import_osm_file(self.path)
+        finally:
+            event.remove(DB.engine, "before_cursor_execute", _record)
+
+        # Rows the way refers to are updated, not deleted
+        self.assertFalse([statement for statement in statements
+                          if statement.startswith("DELETE FROM osm_nodes")
+                          or statement.startswith("DELETE FROM osm_elements ")])
+        self.assertEqual(counts, {"node": 1, "way": 0})
+
+        DB.session.remove()
+        node = DB.session.query(OA.node).filter_by(id=9001).one()
+        self.assertEqual((node.latitude, node.longitude), (52.0005, 7.0))
+        self.assertEqual(dict(node.tags), {"natural": "tree"})
+        way = DB.session.query(OA.way).filter_by(id=9003).one()
+        self.assertEqual([node.id for node in way.nodes], [9001, 9002])
+
+class _OverpassHandler(BaseHTTPRequestHandler):
+    """ Stand-in for the Overpass API, counting requests """
+
+    requests = 0
+
+    def do_POST(self): # pylint: disable=invalid-name
+        self.rfile.read(int(self.headers["Content-Length"]))
+        _OverpassHandler.requests += 1
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.end_headers()
+        self.wfile.write(_TEST_OSM)
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+class ServerOverpassCacheTests(unittest.TestCase):
+    """ Tests that check the Overpass response cache in server.osm """
+
+    def setUp(self):
+        import overpass
+
+        # Run a local Overpass server
+        self.server = HTTPServer(("127.0.0.1", 0), _OverpassHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        _OverpassHandler.requests = 0
+        self.api = overpass.API(endpoint="http://127.0.0.1:%i/api/interpreter" %
+                                self.server.server_address[1])
+
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.config = mock.patch.dict(APP.config, {
+            'OSM_OVERPASS': True,
+            'OSM_OVERPASS_CACHE': os.path.join(self.tempdir.name, "overpass.sqlite"),
+            'OSM_OVERPASS_INTERVAL': 0.0})
+        self.config.start()
+
+    def tearDown(self):
+        self.config.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        self.tempdir.cleanup()
+
+    def test_cache_shared(self):
+        """ Test that cached responses are used by all instances """
+
+        from veripeditus.server.osm import OverpassSwitch
+
+        first, second = OverpassSwitch(self.api), OverpassSwitch(self.api)
+
+        response = first.Get("node(9001);", responseformat="xml")
+        self.assertIn("9001", response)
+        self.assertEqual(second.Get("node(9001);", responseformat="xml"), response)
+        self.assertEqual(_OverpassHandler.requests, 1)
+
+        # Other queries are fetched
+        second.Get("node(9002);", responseformat="xml")
+        self.assertEqual(_OverpassHandler.requests, 2)
+
+    def test_cache_ttl_and_size(self):
+        """ Test expiry and LRU eviction of cached responses """
+
+        from veripeditus.server.osm import OverpassCache
+
+        cache = OverpassCache(APP.config['OSM_OVERPASS_CACHE'], ttl=60, max_size=10)
+
+        with mock.patch("time.time", return_value=1000.0):
+            cache.put("a", "aaaa")
+        with mock.patch("time.time", return_value=1001.0):
+            cache.put("b", "bbbb")
+        with mock.patch("time.time", return_value=1002.0):
+            self.assertEqual(cache.get("a"), "aaaa")
+            # Least recently used response is evicted
+            cache.put("c", "cccc")
+            self.assertIsNone(cache.get("b"))
+            self.assertEqual(cache.get("a"), "aaaa")
+
+        # Responses expire
+        with mock.patch("time.time", return_value=1100.0):
+            self.assertIsNone(cache.get("c"))
+
+    def test_cache_lease(self):
+        """ Test that only one process fetches a response at a time """
+
+        from veripeditus.server.osm import OverpassCache
+
+        cache = OverpassCache(APP.config['OSM_OVERPASS_CACHE'], ttl=60, max_size=1000)
+        other = OverpassCache(APP.config['OSM_OVERPASS_CACHE'], ttl=60, max_size=1000)
+
+        self.assertTrue(cache.acquire("a"))
+        self.assertFalse(other.acquire("a"))
+        cache.release("a")
+        self.assertTrue(other.acquire("a"))
@@ -0,0 +1,203 @@
+# veripeditus-server - Server component for the Veripeditus game framework
+# Copyright (C) 2016, 2017  Dominik George <nik@naturalnet.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import unittest
+from unittest import mock
+
+from veripeditus.server.app import APP, DB
+
+class _FakeWriter(object):
+    """ Stream writer collecting written data """
+
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+class ServerPushTests(unittest.TestCase):
+    """ Tests that check the push channel in server.push """
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def _get_websocket(self, data):
+        """ Create a WebSocket reading the given data """
+
+        from veripeditus.server.push import WebSocket
+
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return WebSocket(reader, _FakeWriter())
+
+    def test_handshake(self):
+        """ Test the accept key of the handshake, using the example from RFC 6455 """
+
+        websocket = self._get_websocket(b"GET /?token=abc HTTP/1.1\r\n"
+                                        b"Host: localhost\r\nUpgrade: websocket\r\n"
+                                        b"Connection: Upgrade\r\n"
+                                        b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n\r\n")
+
+        path = self.loop.run_until_complete(websocket.handshake())
+
+        self.assertEqual(path, "/?token=abc")
+        self.assertTrue(websocket.writer.data.startswith(b"HTTP/1.1 101"))
+        self.assertIn(b"Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n",
+                      websocket.writer.data)
+
+    def test_handshake_rejected(self):
+        """ Test that no WebSocket frames follow a rejected handshake """
+
+        from veripeditus.server.push import WebSocketError
+
+        websocket = self._get_websocket(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+
+        with self.assertRaises(WebSocketError):
+            self.loop.run_until_complete(websocket.handshake())
+        websocket.close()
+
+        self.assertEqual(websocket.writer.data,
+                         b"HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n")
+
+    def test_receive(self):
+        """ Test receiving a fragmented, masked message with a ping in between """
+
+        mask = b"\x01\x02\x03\x04"
+        def _frame(first, payload):
+            return bytes([first, 0x80 | len(payload)]) + mask + \
+                   bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+        websocket = self._get_websocket(_frame(0x01, b"Hello, ") + _frame(0x89, b"") +
+                                        _frame(0x80, b"world!") + _frame(0x88, b""))
+
+        self.assertEqual(self.loop.run_until_complete(websocket.receive()), "Hello, world!")
+        self.assertEqual(websocket.writer.data, b"\x8a\x00")
+        self.assertIsNone(self.loop.run_until_complete(websocket.receive()))
+
+    def test_send(self):
+        """ Test sending unmasked text frames """
+
+        websocket = self._get_websocket(b"")
+
+        self.loop.run_until_complete(websocket.send("Hello"))
+        self.loop.run_until_complete(websocket.send("x" * 200))
+
+        self.assertTrue(websocket.writer.data.startswith(b"\x81\x05Hello\x81\x7e\x00\xc8x"))
+
+    def test_poll_world(self):
+        """ Test building events for the subscribers of a world """
+
+        import veripeditus.game.test as testgame
+        from veripeditus.server.model import User, World
+        from veripeditus.server.push import PushServer, _Subscriber
+
+        world = World.query.first()
+        item = testgame.Beer()
+        item.world = world
+        item.latitude, item.longitude = 50.0, 7.0
+        DB.session.add(item)
+        DB.session.commit()
+        item_id, world_id = item.id, world.id
+        user_id = User.query.filter_by(username="admin").one().id
+
+        server = PushServer(APP, self.loop)
+        subscriber = _Subscriber(mock.Mock(), user_id)
+        subscriber.world_id = world_id
+        subscriber.bbox = [49.0, 6.0, 51.0, 8.0]
+
+        with APP.test_request_context():
+            messages = server._poll_world(world_id, [subscriber])
+            events = [json.loads(message) for _, message in messages]
+            self.assertIn(str(item_id), [event["gameobject"]["id"] for event in events
+                                         if event["event"] == "spawn"])
+
+            # Changes are only sent once
+            messages = server._poll_world(world_id, [subscriber])
+            self.assertEqual(messages, [])
+
+            # Deleted objects are announced as removed
+            DB.session.delete(testgame.Beer.query.get(item_id))
+            DB.session.commit()
+            messages = server._poll_world(world_id, [subscriber])
+            events = [json.loads(message) for _, message in messages]
+            self.assertIn({"event": "remove", "id": str(item_id)}, events)
+
+            DB.session.remove()
+
+    def test_poll_world_viewport(self):
+        """ Test that subscribers only get events for their viewport """
+
+        import veripeditus.game.test as testgame
+        from veripeditus.server.model import User, World
+        from veripeditus.server.push import PushServer, _Subscriber
+
+        world = World.query.first()
+        item = testgame.Beer()
+        item.world = world
+        item.latitude, item.longitude = 40.0, 7.0
+        DB.session.add(item)
+        DB.session.commit()
+        item_id, world_id = item.id, world.id
+        user_id = User.query.filter_by(username="admin").one().id
+
+        server = PushServer(APP, self.loop)
+        near, far = _Subscriber(mock.Mock(), user_id), _Subscriber(mock.Mock(), user_id)
+        near.world_id = far.world_id = world_id
+        near.bbox, far.bbox = [39.0, 6.0, 41.0, 8.0], [10.0, 10.0, 11.0, 11.0]
+
+        with APP.test_request_context():
+            messages = server._poll_world(world_id, [near, far])
+            self.assertIn(near, [subscriber for subscriber, _ in messages])
+            self.assertNotIn(far, [subscriber for subscriber, _ in messages])
+
+            # Moving out of view is only announced to clients knowing the object
+            testgame.Beer.query.get(item_id).latitude = 60.0
+            DB.session.commit()
+            messages = server._poll_world(world_id, [near, far])
+            self.assertEqual([(subscriber, json.loads(message)) for subscriber, message in messages],
+                             [(near, {"event": "remove", "id": str(item_id)})])
+
+            # Deletion outside of all viewports is not announced
+            DB.session.delete(testgame.Beer.query.get(item_id))
+            DB.session.commit()
+            self.assertEqual(server._poll_world(world_id, [near, far]), [])
+
+            DB.session.remove()
+
+    def test_parse_numbers(self):
+        """ Test that only complete, finite coordinates are accepted """
+
+        from veripeditus.server.push import _parse_numbers
+
+        self.assertEqual(_parse_numbers(["1", 2, 3.5, -4], 4), [1.0, 2.0, 3.5, -4.0])
+        self.assertRaises(ValueError, _parse_numbers, [1, 2, 3], 4)
+        self.assertRaises(ValueError, _parse_numbers, [1, 2, 3, 4, 5], 4)
+        self.assertRaises(ValueError, _parse_numbers, [1, 2, 3, "nan"], 4)
+        self.assertRaises(ValueError, _parse_numbers, [1, "inf"], 2)
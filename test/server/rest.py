@@ -0,0 +1,422 @@
+# veripeditus-server - Server component for the Veripeditus game framework
+# Copyright (C) 2016, 2017  Dominik George <nik@naturalnet.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import unittest
+from unittest import mock
+
+from veripeditus.server.app import APP, DB
+
+class ServerRestTests(unittest.TestCase):
+    """ Tests that check the REST API in server.rest """
+
+    def setUp(self):
+        """ Sets up a test client and a test game object """
+
+        # Do not start background threads from test requests
+        self.config = mock.patch.dict(APP.config, {'SPAWN_THREAD': False})
+        self.config.start()
+
+        self.client = APP.test_client()
+
+        import veripeditus.game.test as testgame
+        from veripeditus.server.model import World
+        self.test_player = testgame.Player()
+        self.test_player.world = World.query.first()
+        self.test_player.image = "avatar_fox"
+        DB.session.add(self.test_player)
+        DB.session.commit()
+
+    def tearDown(self):
+        """ Remove test object """
+
+        DB.session.delete(self.test_player)
+        DB.session.commit()
+        self.config.stop()
+
+    def test_image_raw(self):
+        """ Test getting the image of a game object """
+
+        res = self.client.get("/api/v2/gameobject/%i/image_raw" % self.test_player.id)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers["Content-Type"], "image/svg+xml")
+        self.assertIn("ETag", res.headers)
+        self.assertIn("Last-Modified", res.headers)
+        self.assertIn(b"<svg", res.get_data())
+
+    def test_image_raw_not_modified(self):
+        """ Test that a conditional request for an image is answered with 304 """
+
+        url = "/api/v2/gameobject/%i/image_raw" % self.test_player.id
+        etag = self.client.get(url).headers["ETag"]
+
+        res = self.client.get(url, headers={"If-None-Match": etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.get_data(), b"")
+
+    def test_token(self):
+        """ Test getting a session token and authenticating with it """
+
+        import base64
+        basic = base64.b64encode(b"admin:admin").decode("ascii")
+
+        # Without credentials, no token is issued
+        res = self.client.get("/api/v2/user/token")
+        self.assertEqual(res.status_code, 401)
+
+        # Get a token with basic authentication
+        res = self.client.get("/api/v2/user/token",
+                              headers={"Authorization": "Basic " + basic})
+        self.assertEqual(res.status_code, 200)
+        token = json.loads(res.get_data(as_text=True))["token"]
+
+        # The token is accepted instead of the credentials
+        res = self.client.get("/api/v2/world/0/viewport",
+                              headers={"Authorization": "Bearer " + token})
+        self.assertEqual(res.status_code, 404)
+
+        # A tampered token is not
+        res = self.client.get("/api/v2/world/0/viewport",
+                              headers={"Authorization": "Bearer x" + token})
+        self.assertEqual(res.status_code, 401)
+
+        # A token cannot be renewed with itself
+        res = self.client.get("/api/v2/user/token",
+                              headers={"Authorization": "Bearer " + token})
+        self.assertEqual(res.status_code, 401)
+
+        # Not even if the Bearer header is parsed as authorization, like
+        # newer versions of Werkzeug do
+        from flask import Request
+        from werkzeug.datastructures import Authorization
+        with mock.patch.object(Request, "authorization", Authorization("bearer")):
+            res = self.client.get("/api/v2/user/token",
+                                  headers={"Authorization": "Bearer " + token})
+        self.assertEqual(res.status_code, 401)
+
+    def test_rewrite_viewport_filters(self):
+        """ Test that viewport filters are rewritten to use the tile index """
+
+        from veripeditus.server.rest import _rewrite_viewport_filters
+
+        filters = [{"or": [{"and": [{"name": "latitude", "op": "ge", "val": 51.9},
+                                    {"name": "latitude", "op": "le", "val": 52.1},
+                                    {"name": "longitude", "op": "ge", "val": 6.9},
+                                    {"name": "longitude", "op": "le", "val": 7.1},
+                                    {"name": "world", "op": "has",
+                                     "val": {"name": "id", "op": "eq", "val": 1}}]},
+                           {"name": "id", "op": "eq", "val": 1},
+                           {"name": "world", "op": "has",
+                            "val": {"name": "id", "op": "eq", "val": 2}}]}]
+        _rewrite_viewport_filters(filters)
+
+        conjunction = filters[0]["or"][0]["and"]
+        self.assertIn({"name": "world_id", "op": "eq", "val": 1}, conjunction)
+        self.assertIn("or", conjunction[-1])
+        self.assertEqual(conjunction[-1]["or"][0]["and"][0]["name"], "tile")
+
+        # The alternative without a box is left alone
+        self.assertEqual(filters[0]["or"][1], {"name": "id", "op": "eq", "val": 1})
+        # Direct alternatives are rewritten as well
+        self.assertEqual(filters[0]["or"][2], {"name": "world_id", "op": "eq", "val": 2})
+
+    def _get_admin_headers(self):
+        """ Make the test player the current player of admin and
+        return headers for requests as admin.
+        """
+
+        import base64
+        from veripeditus.server.model import User
+
+        # Player and user need to be linked in two steps
+        admin = User.query.filter_by(username="admin").first()
+        self.test_player.user = admin
+        DB.session.commit()
+        admin.current_player = self.test_player
+        DB.session.commit()
+
+        basic = base64.b64encode(b"admin:admin").decode("ascii")
+        return {"Authorization": "Basic " + basic}
+
+    def _reset_admin(self, player_id):
+        """ Unlink the test player from admin again. """
+
+        from veripeditus.framework.model import GameObject
+        from veripeditus.server.model import User
+
+        admin = User.query.filter_by(username="admin").first()
+        admin.current_player = None
+        DB.session.commit()
+        self.test_player = GameObject.query.get(player_id)
+        self.test_player.user = None
+        DB.session.commit()
+
+    def _delete_gameobjects(self, *ids):
+        """ Delete game objects by id. """
+
+        from veripeditus.framework.model import GameObject
+
+        for id_ in ids:
+            gameobject = GameObject.query.get(id_)
+            if gameobject is not None:
+                DB.session.delete(gameobject)
+        DB.session.commit()
+
+    def test_viewport(self):
+        """ Test getting all visible game objects within a bounding box """
+
+        import veripeditus.game.test as testgame
+
+        self.test_player.latitude, self.test_player.longitude = 52.0, 7.0
+        headers = self._get_admin_headers()
+
+        # Place items near and far away
+        near = testgame.Beer(world=self.test_player.world, latitude=52.0005, longitude=7.0)
+        far = testgame.Beer(world=self.test_player.world, latitude=53.0, longitude=7.0)
+        DB.session.add_all([near, far])
+        DB.session.commit()
+        player_id, world_id, near_id, far_id = (self.test_player.id, self.test_player.world.id,
+                                                near.id, far.id)
+
+        try:
+            url = "/api/v2/world/%i/viewport" % world_id
+            res = self.client.get(url, query_string={"bbox": "51.9,6.9,52.1,7.1"},
+                                  headers=headers)
+            self.assertEqual(res.status_code, 200)
+            data = json.loads(res.get_data(as_text=True))["data"]
+            ids = [int(go["id"]) for go in data]
+
+            self.assertIn(near_id, ids)
+            self.assertNotIn(far_id, ids)
+            self.assertIn(player_id, ids)
+
+            # Objects are serialized from plain rows like full objects
+            resource = data[ids.index(near_id)]
+            self.assertEqual(resource["type"], "gameobject_item")
+            self.assertEqual(resource["attributes"], {"name": None, "image": "dummy",
+                                                      "latitude": 52.0005, "longitude": 7.0,
+                                                      "isonmap": True,
+                                                      "gameobject_type": "gameobject_item"})
+            self.assertEqual(resource["relationships"]["world"]["data"]["id"], str(world_id))
+
+            # Invalid boxes are rejected
+            res = self.client.get(url, query_string={"bbox": "foo"}, headers=headers)
+            self.assertEqual(res.status_code, 400)
+        finally:
+            self._reset_admin(player_id)
+            self._delete_gameobjects(near_id, far_id)
+
+    def test_changes(self):
+        """ Test syncing changes of game objects since a cursor """
+
+        from datetime import datetime
+        import veripeditus.game.test as testgame
+        from veripeditus.framework.model import GameObject
+
+        self.test_player.latitude, self.test_player.longitude = 52.0, 7.0
+        headers = self._get_admin_headers()
+
+        # Place items that exist before the first sync
+        unchanged = testgame.Beer(world=self.test_player.world, latitude=52.0005, longitude=7.0)
+        deleted = testgame.Beer(world=self.test_player.world, latitude=52.0006, longitude=7.0)
+        collected = testgame.Beer(world=self.test_player.world, latitude=52.0006, longitude=7.0)
+        DB.session.add_all([unchanged, deleted, collected])
+        DB.session.commit()
+        player_id, world_id, unchanged_id, deleted_id, collected_id = (
+            self.test_player.id, self.test_player.world.id, unchanged.id, deleted.id, collected.id)
+        added_id = None
+
+        try:
+            url = "/api/v2/world/%i/changes" % world_id
+
+            # Without a cursor, the full viewport is returned
+            res = self.client.get(url, query_string={"bbox": "51.9,6.9,52.1,7.1"},
+                                  headers=headers)
+            self.assertEqual(res.status_code, 200)
+            result = json.loads(res.get_data(as_text=True))
+            self.assertTrue(result["reset"])
+            self.assertIn(str(unchanged_id), [go["id"] for go in result["data"]])
+            cursor = result["cursor"]
+
+            # Pretend the existing items were last changed long ago
+            DB.session.execute(GameObject.__table__.update().where(
+                GameObject.id.in_([unchanged_id, deleted_id, collected_id])).values(
+                    updated=datetime(2000, 1, 1)))
+            DB.session.commit()
+
+            # Collect an item
+            GameObject.query.get(collected_id).owner = GameObject.query.get(player_id)
+            DB.session.commit()
+
+            # Add and delete items
+            added = testgame.Beer(world_id=world_id, latitude=52.0007, longitude=7.0)
+            DB.session.add(added)
+            DB.session.commit()
+            added_id = added.id
+            self._delete_gameobjects(deleted_id)
+
+            res = self.client.get(url, query_string={"bbox": "51.9,6.9,52.1,7.1", "cursor": cursor},
+                                  headers=headers)
+            self.assertEqual(res.status_code, 200)
+            result = json.loads(res.get_data(as_text=True))
+            ids = [go["id"] for go in result["data"]]
+
+            self.assertFalse(result["reset"])
+            self.assertIn(str(added_id), ids)
+            self.assertNotIn(str(unchanged_id), ids)
+            self.assertIn(str(deleted_id), result["removed"])
+            self.assertIn(str(collected_id), result["removed"])
+            cursor = result["cursor"]
+
+            # Moving changes the visible radius, so the viewport is reset
+            player = GameObject.query.get(player_id)
+            player.latitude = 52.001
+            DB.session.commit()
+            res = self.client.get(url, query_string={"bbox": "51.9,6.9,52.1,7.1", "cursor": cursor},
+                                  headers=headers)
+            result = json.loads(res.get_data(as_text=True))
+            self.assertTrue(result["reset"])
+            self.assertIn(str(unchanged_id), [go["id"] for go in result["data"]])
+
+            # Invalid cursors are rejected
+            res = self.client.get(url, query_string={"bbox": "51.9,6.9,52.1,7.1", "cursor": "foo"},
+                                  headers=headers)
+            self.assertEqual(res.status_code, 400)
+        finally:
+            self._reset_admin(player_id)
+            self._delete_gameobjects(unchanged_id, collected_id, added_id)
+
+    def test_post_positions(self):
+        """ Test updating the own position with a batch of fixes """
+
+        import veripeditus.game.test as testgame
+        from veripeditus.framework.model import GameObject
+
+        self.test_player.latitude, self.test_player.longitude = 52.0, 7.0
+        headers = self._get_admin_headers()
+
+        # Place an item that is only reached on the way
+        beer = testgame.Beer(world=self.test_player.world, latitude=52.0005, longitude=7.0)
+        DB.session.add(beer)
+        DB.session.commit()
+        player_id, beer_id = self.test_player.id, beer.id
+
+        try:
+            url = "/api/v2/gameobject_player/self/positions"
+            fixes = [{"latitude": 52.01, "longitude": 7.0, "timestamp": 2},
+                     {"latitude": 52.0005, "longitude": 7.0, "timestamp": 1}]
+            with mock.patch.object(testgame.Beer, "auto_collect_radius", 10):
+                res = self.client.post(url, data=json.dumps({"fixes": fixes}), headers=headers)
+            self.assertEqual(res.status_code, 200)
+            result = json.loads(res.get_data(as_text=True))
+
+            # The latest fix is applied, the item on the path is collected
+            self.assertEqual(result["position"], {"latitude": 52.01, "longitude": 7.0})
+            self.assertEqual([go["id"] for go in result["collected"]], [str(beer_id)])
+            self.assertEqual(GameObject.query.get(player_id).latitude, 52.01)
+            self.assertEqual(GameObject.query.get(beer_id).owner_id, player_id)
+
+            # Fixes without time keep their place after the fix before them
+            fixes = [{"latitude": 52.02, "longitude": 7.0, "timestamp": 3},
+                     {"latitude": 52.03, "longitude": 7.0}]
+            res = self.client.post(url, data=json.dumps({"fixes": fixes}), headers=headers)
+            self.assertEqual(json.loads(res.get_data(as_text=True))["position"],
+                             {"latitude": 52.03, "longitude": 7.0})
+
+            # Invalid batches are rejected
+            for fixes in ([{"latitude": "foo"}],
+                          [{"latitude": 52.0, "longitude": 7.0, "timestamp": "foo"}],
+                          [{"latitude": 52.0, "longitude": 7.0, "timestamp": [1]}],
+                          [{"latitude": 52.0, "longitude": 7.0, "timestamp": "nan"}],
+                          "foo"):
+                res = self.client.post(url, data=json.dumps({"fixes": fixes}), headers=headers)
+                self.assertEqual(res.status_code, 400)
+        finally:
+            self._reset_admin(player_id)
+            self._delete_gameobjects(beer_id)
+
+    def test_collection_pages(self):
+        """ Test listing collections page by page """
+
+        from veripeditus.framework.model import GameObject
+        from veripeditus.server.model import User
+
+        headers = self._get_admin_headers()
+        player_id = self.test_player.id
+        expected = [str(row[0]) for row in DB.session.query(GameObject.id).order_by(GameObject.id)]
+
+        try:
+            # Follow the links to the next pages
+            ids = []
+            url = "/api/v2/gameobject?limit=2"
+            while url is not None:
+                res = self.client.get(url, headers=headers)
+                self.assertEqual(res.status_code, 200)
+                page = json.loads(res.get_data(as_text=True))
+                self.assertLessEqual(len(page["data"]), 2)
+                ids += [resource["id"] for resource in page["data"]]
+                url = page["links"]["next"]
+            self.assertEqual(ids, expected)
+
+            # Derived collections only contain their objects, with their columns
+            res = self.client.get("/api/v2/gameobject_player", headers=headers)
+            data = json.loads(res.get_data(as_text=True))["data"]
+            self.assertIn(str(player_id), [resource["id"] for resource in data])
+            self.assertIn("user_id", data[0]["attributes"])
+
+            # Passwords are never listed
+            res = self.client.get("/api/v2/user", headers=headers)
+            data = json.loads(res.get_data(as_text=True))["data"]
+            self.assertNotIn("password", data[0]["attributes"])
+
+            # Unknown collections and bad parameters are rejected
+            self.assertEqual(self.client.get("/api/v2/foo", headers=headers).status_code, 404)
+            self.assertEqual(self.client.get("/api/v2/world?after=x",
+                                             headers=headers).status_code, 400)
+
+            # Other users cannot list objects they may not see
+            admin = User.query.filter_by(username="admin").first()
+            admin.role = "PLAYER"
+            DB.session.commit()
+            self.assertEqual(self.client.get("/api/v2/gameobject", headers=headers).status_code, 403)
+        finally:
+            User.query.filter_by(username="admin").first().role = "ADMIN"
+            DB.session.commit()
+            self._reset_admin(player_id)
+
+    def test_collection_export(self):
+        """ Test streaming whole collections """
+
+        from veripeditus.framework.model import GameObject
+
+        headers = self._get_admin_headers()
+        player_id = self.test_player.id
+        expected = [str(row[0]) for row in DB.session.query(GameObject.id).order_by(GameObject.id)]
+
+        try:
+            with mock.patch.dict(APP.config, {'API_EXPORT_BATCH_SIZE': 2}):
+                res = self.client.get("/api/v2/gameobject/export", headers=headers)
+                self.assertEqual(res.headers["Content-Type"], "application/x-ndjson")
+                lines = res.get_data(as_text=True).splitlines()
+                self.assertEqual([json.loads(line)["id"] for line in lines], expected)
+
+                res = self.client.get("/api/v2/gameobject/export?format=json", headers=headers)
+                data = json.loads(res.get_data(as_text=True))["data"]
+                self.assertEqual([resource["id"] for resource in data], expected)
+        finally:
+            self._reset_admin(player_id)
@@ -0,0 +1,119 @@
+# veripeditus-server - Server component for the Veripeditus game framework
+# Copyright (C) 2016, 2017  Dominik George <nik@naturalnet.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from unittest import mock
+
+from veripeditus.server.app import APP
+
+class ServerSpawnTests(unittest.TestCase):
+    """ Tests that check the spawn scheduler in server.spawn """
+
+    def setUp(self):
+        """ Create a fresh scheduler and an application context """
+
+        from veripeditus.server.spawn import SpawnScheduler
+        self.scheduler = SpawnScheduler(APP)
+        self.ctx = APP.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        """ Pop application context """
+
+        self.ctx.pop()
+
+    def test_get_spawn_classes(self):
+        """ Test whether the game classes of the test game are found """
+
+        from veripeditus.server.spawn import get_spawn_classes
+        import veripeditus.game.test as testgame
+
+        classes = get_spawn_classes()
+
+        self.assertIn(testgame.Player, classes["test"])
+        self.assertIn(testgame.Kangoo, classes["test"])
+
+    def test_run_pending_interval(self):
+        """ Test that jobs are not run again before their interval passed """
+
+        with mock.patch("veripeditus.server.spawn.spawn_class") as spawn_class:
+            first = self.scheduler.run_pending(now=0)
+            second = self.scheduler.run_pending(now=1)
+            third = self.scheduler.run_pending(now=APP.config['SPAWN_INTERVAL'])
+
+        self.assertGreater(first, 0)
+        self.assertEqual(second, 0)
+        self.assertEqual(third, first)
+        self.assertEqual(spawn_class.call_count, first + third)
+
+    def test_run_pending_budget(self):
+        """ Test that no more jobs than the budget are run per tick """
+
+        with mock.patch.dict(APP.config, {'SPAWN_BUDGET': 1}), \
+                mock.patch("veripeditus.server.spawn.spawn_class"):
+            self.assertEqual(self.scheduler.run_pending(now=0), 1)
+            self.assertEqual(self.scheduler.run_pending(now=0), 1)
+
+    def test_trigger(self):
+        """ Test that a triggered world is spawned before its interval passed """
+
+        from veripeditus.server.model import World
+        world_id = World.query.first().id
+
+        with mock.patch("veripeditus.server.spawn.spawn_class"):
+            first = self.scheduler.run_pending(now=0)
+            self.scheduler.trigger(world_id)
+            second = self.scheduler.run_pending(now=1)
+
+        self.assertEqual(second, first)
+
+    def test_budget_carries_triggered_jobs(self):
+        """ Test that triggered jobs exceeding the budget run on the next
+        tick without waking up the scheduler early
+        """
+
+        from veripeditus.server.model import World
+        world_id = World.query.first().id
+
+        with mock.patch("veripeditus.server.spawn.spawn_class") as spawn_class:
+            first = self.scheduler.run_pending(now=0)
+            self.scheduler.trigger(world_id)
+            self.scheduler._wakeup.clear() # pylint: disable=protected-access
+
+            with mock.patch.dict(APP.config, {'SPAWN_BUDGET': 1}):
+                runs = [self.scheduler.run_pending(now=1) for _ in range(first + 1)]
+
+        self.assertFalse(self.scheduler._wakeup.is_set()) # pylint: disable=protected-access
+        self.assertEqual(runs, [1] * first + [0])
+        self.assertEqual(spawn_class.call_count, 2 * first)
+
+    def test_spawn_requested(self):
+        """ Test that spawns requested through the database are run """
+
+        from datetime import datetime
+        from veripeditus.server.app import DB
+        from veripeditus.server.model import World
+
+        with mock.patch("veripeditus.server.spawn.spawn_class"):
+            first = self.scheduler.run_pending(now=0)
+            world = World.query.first()
+            world.spawn_requested = datetime.utcnow()
+            DB.session.commit()
+            second = self.scheduler.run_pending(now=1)
+            third = self.scheduler.run_pending(now=2)
+
+        self.assertEqual(second, first)
+        self.assertEqual(third, 0)
@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
+from unittest import mock
 
 class ServerUtilTests(unittest.TestCase):
     """ Tests that check game data handling in server.util """
@@ -59,3 +60,54 @@ class ServerUtilTests(unittest.TestCase):
         # The test key should refer to the test game module
         import veripeditus.game.test as testgame
         self.assertIs(game, testgame)
+
+    def test_get_game_by_name_installed_later(self):
+        """ Test looking up a game installed after discovery """
+
+        import veripeditus.server.util as util
+
+        # A registry from before the game was installed
+        games = {name: module for name, module in util.get_games().items() if name != "test"}
+        with mock.patch.object(util, "_GAMES", games):
+            import veripeditus.game.test as testgame
+            self.assertIs(util.get_game_by_name("test"), testgame)
+            self.assertIn("test", util.get_games())
+
+        # Unknown games are still unknown
+        with self.assertRaises(KeyError):
+            util.get_game_by_name("nonexistent")
+
+    def test_get_games_cached(self):
+        """ Test that game modules are not discovered again on every call """
+
+        from veripeditus.server.util import get_games
+
+        # Both calls should return the same registry
+        self.assertIs(get_games(), get_games())
+
+    def test_reload_games(self):
+        """ Test re-discovering game modules """
+
+        from veripeditus.server.util import get_games, reload_games
+
+        # Get registries before and after reload
+        games_before = get_games()
+        games_after = reload_games()
+
+        # The registry is replaced, but modules are kept
+        self.assertIs(get_games(), games_after)
+        self.assertIs(games_before["test"], games_after["test"])
+
+    def test_get_game_constants(self):
+        """ Test getting the constants defined by a game """
+
+        from veripeditus.server.util import get_game_constants
+
+        # Get constants of test game
+        constants = get_game_constants("test")
+
+        # Constants should be taken from the module
+        import veripeditus.game.test as testgame
+        self.assertEqual(constants["NAME"], testgame.NAME)
+        self.assertEqual(constants["HIDE_SELF"], testgame.HIDE_SELF)
+        self.assertNotIn("Player", constants)
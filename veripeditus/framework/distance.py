@@ -0,0 +1,95 @@
+"""
+Vectorized distance calculations for framework components
+
+The functions in this module work on whole arrays of coordinates, so
+distances for a complete result set take one array operation instead of
+one Python call per pair of objects.
+"""
+
+# veripeditus-server - Server component for the Veripeditus game framework
+# Copyright (C) 2016, 2017  Dominik George <nik@naturalnet.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gpxpy import geo
+import numpy
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Get haversine distances in metres between coordinates.
+
+    All arguments can be numbers or arrays, which are broadcast against
+    each other like in any NumPy operation. The earth radius is the same
+    as in gpxpy.geo.haversine_distance.
+    """
+
+    _lat1, _lon1, _lat2, _lon2 = (numpy.radians(numpy.asarray(_x, dtype=float))
+                                  for _x in (lat1, lon1, lat2, lon2))
+
+    _a = (numpy.sin((_lat2 - _lat1) / 2) ** 2 +
+          numpy.cos(_lat1) * numpy.cos(_lat2) * numpy.sin((_lon2 - _lon1) / 2) ** 2)
+
+    return 2 * geo.EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(_a, 1.0)))
+
+def get_coordinates(objs):
+    """
+    Get arrays of latitudes and longitudes of objects, or of
+    (lat, lon) tuples.
+    """
+
+    if not objs:
+        return numpy.empty(0), numpy.empty(0)
+
+    if hasattr(objs[0], "latitude"):
+        _coords = numpy.array([(obj.latitude, obj.longitude) for obj in objs], dtype=float)
+    else:
+        _coords = numpy.array(objs, dtype=float)
+
+    return _coords[:, 0], _coords[:, 1]
+
+def get_distances(objs, target):
+    """
+    Get an array of distances in metres from many objects to one target.
+
+    Objects and target can be game objects or (lat, lon) tuples.
+    """
+
+    _lats, _lons = get_coordinates(objs)
+    _lat, _lon = get_coordinates([target])
+
+    return haversine(_lats, _lons, _lat[0], _lon[0])
+
+def get_distance_matrix(objs1, objs2):
+    """
+    Get a matrix of distances in metres from every object in objs1
+    (rows) to every object in objs2 (columns).
+    """
+
+    _lats1, _lons1 = get_coordinates(objs1)
+    _lats2, _lons2 = get_coordinates(objs2)
+
+    return haversine(_lats1[:, numpy.newaxis], _lons1[:, numpy.newaxis],
+                     _lats2[numpy.newaxis, :], _lons2[numpy.newaxis, :])
+
+def get_bbox_mask(latitudes, longitudes, lat_min, lon_min, lat_max, lon_max):
+    """
+    Get a boolean array telling which coordinates are within a bounding box.
+
+    Useful as a cheap filter before calculating exact distances.
+    """
+
+    latitudes, longitudes = numpy.asarray(latitudes), numpy.asarray(longitudes)
+
+    return ((latitudes >= lat_min) & (latitudes <= lat_max) &
+            (longitudes >= lon_min) & (longitudes <= lon_max))
@@ -15,22 +15,35 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from collections import Sequence
-from numbers import Real
-import random
+from datetime import timedelta
+import math
 
-from flask import g, redirect
+from flask import g, has_app_context, redirect, send_file
 from flask_restless import url_for
-from sqlalchemy import and_ as sa_and
+import numpy
+from sqlalchemy import and_ as sa_and, bindparam, event, exists, false, func, inspect, or_, true
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.collections import attribute_mapped_collection
-from sqlalchemy.sql import and_
+from sqlalchemy.sql import and_, ClauseElement
+from sqlalchemy.sql.util import find_tables
 
-from veripeditus.framework.util import get_image_path, get_gameobject_distance, random_point_in_polygon, send_action
-from veripeditus.server.app import DB, OA
-from veripeditus.server.model import Base, World
-from veripeditus.server.util import api_method
+from veripeditus.framework.distance import get_distance_matrix, get_distances
+from veripeditus.framework.util import get_image_path, get_gameobject_distance, send_action, SpawnArea, \
+                                       get_bbox_around, get_tile, get_tile_blocks, get_tile_ranges, tile_filter
+from veripeditus.server.app import APP, DB, OA
+from veripeditus.server.model import Base, User, World
+from veripeditus.server.util import api_method, select_columns
+
+# Maximum number of tile ranges to put into one viewport query
+MAX_TILE_RANGES = 32
+
+# Whether attributes of game objects are stored in the compact table,
+# decides which relationship is exposed as GameObject.attributes
+_COMPACT_ATTRIBUTES = APP.config['ATTRIBUTE_STORAGE'] == "compact"
 
 class _GameObjectMeta(type(Base)):
     """ Meta-class to allow generation of dynamic mapper args.
@@ -55,7 +68,7 @@ class _GameObjectMeta(type(Base)):
             # We are a parent class in the framework, so we need to configure
             # the polymorphism to use
             mapperargs["polymorphic_on"] = obj.type
-            mapperargs["with_polymorphic"] = "*"
+            mapperargs["with_polymorphic"] = APP.config['GAMEOBJECT_WITH_POLYMORPHIC']
             mapperargs["polymorphic_identity"] = obj.__name__
         elif obj.__module__.startswith("veripeditus.game"):
             # We are an implementation in a game, so we only need to set the identity
@@ -75,9 +88,31 @@ class Attribute(Base):
     key = DB.Column(DB.Unicode(256))
     value = DB.Column(DB.Unicode(256))
 
+class GameObjectQuery(DB.Query):
+    """ Query class for game objects that prepares pages of API listings.
+
+    Flask-Restless paginates collections with this query class and then
+    serializes the objects on the page one by one, so everything the
+    serializer reads is loaded for the whole page here.
+    """
+
+    def paginate(self, *args, **kwargs):
+        """ Paginate like Flask-SQLAlchemy, and load the columns of derived
+        classes for all objects on the page with one query per class, and
+        their attributes with one more query.
+        """
+
+        pagination = super().paginate(*args, **kwargs)
+        GameObject.load_polymorphic(pagination.items)
+        GameObject.load_attributes(pagination.items)
+        return pagination
+
 class GameObject(Base, metaclass=_GameObjectMeta):
     __tablename__ = "gameobject"
 
+    # Load pages of listings at once
+    query_class = GameObjectQuery
+
     _api_includes = ["world", "attributes"]
 
     id = DB.Column(DB.Integer(), primary_key=True)
@@ -95,6 +130,9 @@ class GameObject(Base, metaclass=_GameObjectMeta):
     longitude = DB.Column(DB.Float(), default=0.0, nullable=False)
     latitude = DB.Column(DB.Float(), default=0.0, nullable=False)
 
+    # Slippy map tile containing the position, maintained automatically
+    tile = DB.Column(DB.BigInteger())
+
     osm_element_id = DB.Column(DB.Integer(), DB.ForeignKey("osm_elements.id"))
     osm_element = DB.relationship(OA.element, backref=DB.backref("osm_elements",
                                                                  lazy="dynamic"),
@@ -102,11 +140,9 @@ class GameObject(Base, metaclass=_GameObjectMeta):
 
     type = DB.Column(DB.Unicode(256))
 
-    attributes = association_proxy("gameobjects_to_attributes", "value",
-                                   creator=lambda k, v: GameObjectsToAttributes(
-                                       attribute=Attribute(key=k, value=v)))
-
     distance_max = None
+    # Seconds between runs of the spawn code, None for the server default
+    spawn_interval = None
 
     @property
     def gameobject_type(self):
@@ -117,6 +153,145 @@ class GameObject(Base, metaclass=_GameObjectMeta):
         # Return distance to another gamobject
         return get_gameobject_distance(self, obj)
 
+    @classmethod
+    def in_bbox(cls, lat_min, lon_min, lat_max, lon_max):
+        """ Get an SQL expression matching objects within a bounding box.
+
+        The box is translated to ranges of tiles, so the query can use the
+        index on the tile column.
+        """
+
+        ranges = get_tile_ranges(lat_min, lon_min, lat_max, lon_max,
+                                 max_ranges=MAX_TILE_RANGES)
+
+        return and_(tile_filter(cls.tile, ranges),
+                    cls.latitude.between(lat_min, lat_max),
+                    cls.longitude.between(lon_min, lon_max))
+
+    @classmethod
+    def in_radius(cls, latitude, longitude, radius):
+        """ Get an SQL expression matching objects within a circle.
+
+        The circle is narrowed to its bounding box first, so the query can
+        use the index on the tile column. If VISIBILITY_EXACT is set, the
+        distance is then checked by an equirectangular approximation, which
+        needs no trigonometric functions in the database.
+        """
+
+        lat_min, lon_min, lat_max, lon_max = get_bbox_around(latitude, longitude, radius)
+
+        # Circles around the whole earth contain everything
+        if lat_max - lat_min >= 180.0:
+            return true()
+
+        expr = cls.in_bbox(lat_min, lon_min, lat_max, lon_max)
+
+        if APP.config['VISIBILITY_EXACT']:
+            # Compare squared distances in degrees of latitude
+            _delta = (lat_max - lat_min) / 2
+            _scale = math.cos(math.radians(latitude))
+            _dlat = cls.latitude - latitude
+            _dlon = (cls.longitude - longitude) * _scale
+            expr = and_(expr, _dlat * _dlat + _dlon * _dlon <= _delta * _delta)
+
+        return expr
+
+    @classmethod
+    def in_visible_radius(cls, constant):
+        """ Get an SQL expression matching objects within the radius around
+        the current player defined by a game constant like VISIBLE_RAD_ITEMS,
+        or None if the game does not define it.
+        """
+
+        player = g.user.current_player
+        radius = getattr(player.world.game.module, constant, None)
+        if radius is None:
+            return None
+
+        return cls.in_radius(player.latitude, player.longitude, radius)
+
+    @staticmethod
+    def load_polymorphic(gameobjects):
+        """ Load the columns of derived classes for game objects that were
+        queried as a base class, with one query per class instead of one
+        per object on first access.
+        """
+
+        # Find objects with columns of their class not loaded yet, by class
+        classes = {}
+        for gameobject in gameobjects:
+            state = inspect(gameobject)
+            if state.key is not None and state.unloaded & set(state.mapper.columns.keys()):
+                classes.setdefault(type(gameobject), []).append(gameobject.id)
+
+        # Querying the objects again fills the missing columns in the identity map
+        for cls, ids in classes.items():
+            cls.query.filter(cls.id.in_(ids)).all()
+
+    @staticmethod
+    def _get_attribute_rows(ids, keys=None):
+        """ Query the stored attributes of game objects by their ids, optionally
+        only some keys, in one query using the configured storage.
+        """
+
+        if _COMPACT_ATTRIBUTES:
+            query = GameObjectAttribute.query.filter(GameObjectAttribute.gameobject_id.in_(ids))
+            if keys is not None:
+                query = query.filter(GameObjectAttribute.key.in_(keys))
+        else:
+            query = GameObjectsToAttributes.query.join(GameObjectsToAttributes.attribute).options(
+                joinedload(GameObjectsToAttributes.attribute)).filter(
+                    GameObjectsToAttributes.gameobject_id.in_(ids))
+            if keys is not None:
+                query = query.filter(Attribute.key.in_(keys))
+
+        return query.all()
+
+    @staticmethod
+    def load_attributes(gameobjects):
+        """ Load the attributes of many game objects in one query.
+
+        Objects whose attributes are already loaded are left alone.
+        """
+
+        gameobjects = [gameobject for gameobject in gameobjects
+                       if gameobject.id is not None and "attributes" in inspect(gameobject).unloaded]
+        if not gameobjects:
+            return
+
+        # Group rows by object and fill the collections without marking them changed
+        rows = {}
+        for row in GameObject._get_attribute_rows([gameobject.id for gameobject in gameobjects]):
+            rows.setdefault(row.gameobject_id, []).append(row)
+        for gameobject in gameobjects:
+            set_committed_value(gameobject, "attributes", rows.get(gameobject.id, []))
+
+    def get_attribute_values(self, keys):
+        """ Get the values of some attributes as a dictionary.
+
+        Uses the loaded attributes if there are any, or else looks up
+        only the requested keys, which is one indexed lookup in the
+        compact storage.
+        """
+
+        if self.id is None or "attributes" not in inspect(self).unloaded:
+            return {key: self.attributes[key].value for key in keys if key in self.attributes}
+
+        return {row.key: row.value for row in self._get_attribute_rows([self.id], keys)}
+
+    def set_attribute(self, key, value):
+        """ Set the value of an attribute, independent of the storage used. """
+
+        if key in self.attributes:
+            if _COMPACT_ATTRIBUTES:
+                self.attributes[key].value = value
+            else:
+                self.attributes[key].attribute.value = value
+        elif _COMPACT_ATTRIBUTES:
+            self.attributes[key] = GameObjectAttribute(key=key, value=value)
+        else:
+            self.attributes[key] = GameObjectsToAttributes(attribute=Attribute(key=key, value=value))
+
     @property
     def image_path(self):
         # Return path of image file
@@ -126,17 +301,70 @@ class GameObject(Base, metaclass=_GameObjectMeta):
     def isonmap(self):
         return True
 
+    @isonmap.expression
+    def isonmap(cls):
+        # Combine the rules of all derived classes by their type, so queries
+        # for all kinds of game objects only return visible ones
+        identities, clauses = [], []
+        for mapper in cls.__mapper__.self_and_descendants:
+            if mapper.class_ is GameObject:
+                continue
+            identities.append(mapper.polymorphic_identity)
+            expr = mapper.class_.isonmap
+            if hasattr(expr, "__clause_element__"):
+                expr = expr.__clause_element__()
+
+            # Rules using columns of derived tables are checked in a correlated
+            # subquery, as the tables are only joined if loaded polymorphically
+            if not isinstance(expr, ClauseElement):
+                expr = true() if expr else false()
+            elif set(find_tables(expr, check_columns=True)) - {GameObject.__table__}:
+                tables = [table for table in mapper.tables if table is not GameObject.__table__]
+                expr = exists().where(and_(*[table.c.id == cls.id for table in tables] + [expr])
+                                     ).correlate_except(*tables)
+
+            clauses.append(and_(cls.type == mapper.polymorphic_identity, expr))
+
+        # Objects of other types have no rules
+        return or_(cls.type == None, cls.type.notin_(identities), *clauses)
+
     @property
     def distance_to_current_player(self):
         # Return distance to current player
         if g.user is None or g.user.current_player is None:
             return None
-        return self.distance_to(g.user.current_player)
+
+        # Use distances calculated for a whole result set, if still valid
+        player = g.user.current_player
+        position, distances = g.get("current_player_distances", (None, {}))
+        if position == (player.latitude, player.longitude):
+            distance = distances.get((self.id, self.latitude, self.longitude))
+            if distance is not None:
+                return distance
+
+        return self.distance_to(player)
+
+    @staticmethod
+    def prefetch_distances(gameobjects):
+        """ Calculate the distances of many game objects to the current player
+        in one go, to be used by distance_to_current_player in this request.
+        """
+
+        if g.user is None or g.user.current_player is None or not gameobjects:
+            return
+
+        player = g.user.current_player
+        distances = get_distances(gameobjects, player)
+        g.current_player_distances = ((player.latitude, player.longitude),
+                                      {(gameobject.id, gameobject.latitude, gameobject.longitude):
+                                       float(distance)
+                                       for gameobject, distance in zip(gameobjects, distances)})
 
     @api_method(authenticated=False)
     def image_raw(self):
-        with open(self.image_path, "rb") as file:
-            return file.read()
+        # Stream file with MIME type from extension, ETag and Last-Modified,
+        # answering conditional requests with 304 Not Modified
+        return send_file(self.image_path, conditional=True)
 
     @classmethod
     def spawn(cls, world=None):
@@ -154,72 +382,54 @@ class GameObject(Base, metaclass=_GameObjectMeta):
                         go.spawn_default(world)
 
     @classmethod
-    def spawn_default(cls, world):
-        # Get current player
-        current_player = None if g.user is None else g.user.current_player
+    def get_spawn_area(cls):
+        """ Get the spawn area defined by spawn_latlon, prepared on first use. """
+
+        if "_spawn_area" not in vars(cls):
+            cls._spawn_area = SpawnArea(cls.spawn_latlon)
+        return cls._spawn_area
 
+    @classmethod
+    def spawn_default(cls, world):
         # Determine spawn location
         if "spawn_latlon" in vars(cls):
-            latlon = cls.spawn_latlon
-
-            if isinstance(latlon, Sequence):
-                # We got one of:
-                #  (lat, lon)
-                #  ((lat, lon), (lat, lon),…)
-                #  ((lat, lon), radius)
-                if isinstance(latlon[0], Sequence) and isinstance(latlon[1], Sequence):
-                    if len(latlon) == 2:
-                        # We got a rect like ((lat, lon), (lat, lon))
-                        # Randomise coordinates within that rect
-                        latlon = (random.uniform(latlon[0][0], latlon[1][0]), random.uniform(latlon[0][1], latlon[1][1]))
-                    else:
-                        # We got a polygon, randomise coordinates within it
-                        latlon = random_point_in_polygon(latlon)
-                elif isinstance(latlon[0], Sequence) and isinstance(latlon[1], Real):
-                    # We got a circle like ((lat, lon), radius)
-                    # FIXME implement
-                    raise RuntimeError("Not implemented.")
-                elif isinstance(latlon[0], Real) and isinstance(latlon[1], Real):
-                    # We got a single point like (lat, lon)
-                    # Nothing to do, we can use that as is
-                    pass
-                else:
-                    raise TypeError("Unknown value for spawn_latlon.")
-
-            # Define a single spawn point with no linked OSM element
-            spawn_points = {latlon: None}
+            # Define a single spawn area with no linked OSM element
+            spawn_points = {cls.get_spawn_area(): None}
         elif "spawn_osm" in vars(cls):
-            # Skip if no current player or current player not in this world
-            if current_player is None or current_player.world is not world:
-                return
+            # Spawn around all players currently playing in this world
+            players = Player.query.filter_by(world=world).join(
+                User, User.current_player_id == Player.id).all()
 
-            # Define bounding box around current player
+            # Define bounding boxes around players
             # FIXME do something more intelligent here
-            lat_min = current_player.latitude - 0.001
-            lat_max = current_player.latitude + 0.001
-            lon_min = current_player.longitude - 0.001
-            lon_max = current_player.longitude + 0.001
-            bbox_queries = [OA.node.latitude>lat_min, OA.node.latitude<lat_max,
-                            OA.node.longitude>lon_min, OA.node.longitude<lon_max]
-
-            # Build list of tag values using OSMAlchemy
-            has_queries = [OA.node.tags.any(key=k, value=v) for k, v in cls.spawn_osm.items()]
-            and_query = sa_and(*bbox_queries, *has_queries)
-
-            # Do query
-            # FIXME support more than plain nodes
-            nodes = DB.session.query(OA.node).filter(and_query).all()
+            bboxes = [(player.latitude - 0.001, player.longitude - 0.001,
+                       player.latitude + 0.001, player.longitude + 0.001) for player in players]
 
-            # Extract latitude and longitude information and build spawn_points
-            latlons = [(node.latitude, node.longitude) for node in nodes]
-            spawn_points = dict(zip(latlons, nodes))
+            # Look up precomputed spawn points, with the OSM id of their node
+            # FIXME support more than plain nodes
+            spawn_points = {(point.latitude, point.longitude): point.osm_id
+                            for point in SpawnPoint.get_in_bboxes(cls, bboxes)}
         else:
             # Do nothing if we cannot determine a location
             return
 
-        for latlon, osm_element in spawn_points.items():
+        # Count existing objects on map per OSM element in one query
+        osm_ids = [osm_id for osm_id in spawn_points.values() if osm_id is not None]
+        counts = {}
+        if osm_ids:
+            counts = dict(cls.query.filter_by(world=world, isonmap=True).filter(
+                cls.osm_element_id.in_(osm_ids)).with_entities(
+                    cls.osm_element_id, func.count(cls.id)).group_by(cls.osm_element_id).all())
+
+        # Collect new objects to add them in one transaction
+        objs = []
+
+        for location, osm_id in spawn_points.items():
             # Determine existing number of objects on map
-            existing = cls.query.filter_by(world=world, osm_element=osm_element, isonmap=True).count()
+            if osm_id is None:
+                existing = cls.query.filter_by(world=world, osm_element=None, isonmap=True).count()
+            else:
+                existing = counts.get(osm_id, 0)
             if "spawn_min" in vars(cls) and "spawn_max" in vars(cls) and existing < cls.spawn_min:
                 to_spawn = cls.spawn_max - existing
             elif existing == 0:
@@ -227,14 +437,20 @@ class GameObject(Base, metaclass=_GameObjectMeta):
             else:
                 to_spawn = 0
 
+            # Draw positions from spawn areas in one go
+            if isinstance(location, SpawnArea):
+                latlons = location.sample(to_spawn)
+            else:
+                latlons = [location] * to_spawn
+
             # Spawn the determined number of objects
-            for i in range(0, to_spawn):
+            for latlon in latlons:
                 # Create a new object
                 obj = cls()
                 obj.world = world
-                obj.latitude = latlon[0]
-                obj.longitude = latlon[1]
-                obj.osm_element = osm_element
+                obj.latitude = float(latlon[0])
+                obj.longitude = float(latlon[1])
+                obj.osm_element_id = osm_id
 
                 # Determine any defaults
                 for k in vars(cls):
@@ -247,8 +463,13 @@ class GameObject(Base, metaclass=_GameObjectMeta):
                 if obj.name is None:
                     obj.name = cls.__name__.lower()
 
-                # Add to session
-                obj.commit()
+                objs.append(obj)
+
+        # Add to session
+        # Not using bulk_save_objects, because it skips the tile maintenance
+        if objs:
+            DB.session.add_all(objs)
+            DB.session.commit()
 
     def commit(self):
         """ Commit this object to the database. """
@@ -256,6 +477,214 @@ class GameObject(Base, metaclass=_GameObjectMeta):
         DB.session.add(self)
         DB.session.commit()
 
+# Index for looking up game objects by world and location
+DB.Index("ix_gameobject_world_tile", GameObject.world_id, GameObject.tile)
+# Index for looking up changed game objects by world
+DB.Index("ix_gameobject_world_updated", GameObject.world_id, GameObject.updated)
+
+@event.listens_for(GameObject, "before_insert", propagate=True)
+@event.listens_for(GameObject, "before_update", propagate=True)
+def _update_tile(mapper, connection, target): # pylint: disable=unused-argument
+    """ Keep the tile of a game object in sync with its position. """
+
+    latitude = 0.0 if target.latitude is None else target.latitude
+    longitude = 0.0 if target.longitude is None else target.longitude
+    target.tile = get_tile(latitude, longitude)
+
+def backfill_tiles(batch_size=1000):
+    """ Fill in the tile of game objects stored before the tile column
+    existed, in batches of batch_size objects.
+
+    Objects without a tile are not found by tile index queries. Returns
+    the number of updated objects.
+    """
+
+    table = GameObject.__table__
+    update = table.update().where(table.c.id == bindparam("_id")).values(tile=bindparam("_tile"))
+
+    count = 0
+    while True:
+        rows = DB.session.execute(select_columns([table.c.id, table.c.latitude, table.c.longitude]).where(
+            table.c.tile == None).limit(batch_size)).fetchall()
+        if not rows:
+            break
+
+        # Same defaults as _update_tile
+        DB.session.execute(update, [{"_id": row[0],
+                                     "_tile": get_tile(row[1] or 0.0, row[2] or 0.0)}
+                                    for row in rows])
+        DB.session.commit()
+        count += len(rows)
+
+    return count
+
+class GameObjectTombstone(Base):
+    """ Record of a deleted game object, used to tell clients about
+    removed objects when they sync changes.
+    """
+
+    __tablename__ = "gameobject_tombstone"
+
+    # Former id and location of the game object
+    gameobject_id = DB.Column(DB.Integer(), nullable=False)
+    world_id = DB.Column(DB.Integer(), DB.ForeignKey("world.id"))
+    latitude = DB.Column(DB.Float(), default=0.0, nullable=False)
+    longitude = DB.Column(DB.Float(), default=0.0, nullable=False)
+
+    __table_args__ = (DB.Index("ix_gameobject_tombstone_world_created", "world_id", "created"),)
+
+    @staticmethod
+    def prune(max_age):
+        """ Remove tombstones older than max_age seconds. """
+
+        oldest = DB.session.query(DB.func.now()).scalar() - timedelta(seconds=max_age)
+        GameObjectTombstone.query.filter(GameObjectTombstone.created < oldest).delete(
+            synchronize_session=False)
+        DB.session.commit()
+
+@event.listens_for(GameObject, "after_delete", propagate=True)
+def _add_tombstone(mapper, connection, target): # pylint: disable=unused-argument
+    """ Record deletion of a game object. """
+
+    connection.execute(GameObjectTombstone.__table__.insert().values(
+        gameobject_id=target.id, world_id=target.world_id,
+        latitude=target.latitude, longitude=target.longitude))
+
+class SpawnTile(Base):
+    """ Record of a tile for which the spawn points of a game object
+    class were built from the OSM data.
+    """
+
+    __tablename__ = "spawn_tile"
+
+    # Polymorphic identity of the game object class and the tile
+    gameobject_type = DB.Column(DB.String(256), nullable=False)
+    tile = DB.Column(DB.BigInteger(), nullable=False)
+
+    # Whether OSM data was fetched from Overpass while building the tile
+    from_overpass = DB.Column(DB.Boolean())
+
+    __table_args__ = (DB.Index("ix_spawn_tile_type_tile", "gameobject_type", "tile", unique=True),)
+
+class SpawnPoint(Base):
+    """ Precomputed location of an OSM node matching the spawn_osm tags
+    of a game object class.
+    """
+
+    __tablename__ = "spawn_point"
+
+    # Polymorphic identity of the game object class and tile of the node
+    gameobject_type = DB.Column(DB.String(256), nullable=False)
+    tile = DB.Column(DB.BigInteger(), nullable=False)
+
+    # OSM id and location of the node
+    osm_id = DB.Column(DB.BigInteger(), nullable=False)
+    latitude = DB.Column(DB.Float(), nullable=False)
+    longitude = DB.Column(DB.Float(), nullable=False)
+
+    __table_args__ = (DB.Index("ix_spawn_point_type_tile", "gameobject_type", "tile"),)
+
+    @staticmethod
+    def build(gameobject_class, tiles):
+        """ Build the spawn points of a game object class within a set of
+        tiles from the OSM data, replacing the existing ones.
+        """
+
+        identity = gameobject_class.__mapper__.polymorphic_identity
+
+        # Build list of tag values using OSMAlchemy
+        has_queries = [OA.node.tags.any(key=k, value=v)
+                       for k, v in gameobject_class.spawn_osm.items()]
+
+        # Query whole nodes, so OSMAlchemy can fetch missing data online,
+        # once per block of adjacent tiles, so tiles far apart do not
+        # end up in one query covering all the area between them
+        nodes = []
+        for lat_min, lon_min, lat_max, lon_max in get_tile_blocks(tiles):
+            bbox_queries = [OA.node.latitude > lat_min, OA.node.latitude < lat_max,
+                            OA.node.longitude > lon_min, OA.node.longitude < lon_max]
+            nodes += DB.session.query(OA.node).filter(sa_and(*bbox_queries, *has_queries)).all()
+
+        # Replace spawn points and records of the tiles
+        tiles = list(tiles)
+        SpawnPoint.query.filter(SpawnPoint.gameobject_type == identity,
+                                SpawnPoint.tile.in_(tiles)).delete(synchronize_session=False)
+        SpawnTile.query.filter(SpawnTile.gameobject_type == identity,
+                               SpawnTile.tile.in_(tiles)).delete(synchronize_session=False)
+
+        points = [{"gameobject_type": identity, "tile": get_tile(node.latitude, node.longitude),
+                   "osm_id": node.id, "latitude": node.latitude, "longitude": node.longitude}
+                  for node in nodes]
+        DB.session.bulk_insert_mappings(SpawnPoint, [point for point in points
+                                                     if point["tile"] in tiles])
+        DB.session.bulk_insert_mappings(SpawnTile, [{"gameobject_type": identity, "tile": tile,
+                                                     "from_overpass": APP.config['OSM_OVERPASS']}
+                                                    for tile in tiles])
+        DB.session.commit()
+
+    @staticmethod
+    def get_in_bboxes(gameobject_class, bboxes):
+        """ Get all spawn points of a game object class within a list of
+        bounding boxes like (lat_min, lon_min, lat_max, lon_max).
+
+        Spawn points of tiles that were not built yet, or that were built
+        longer than SPAWN_POINT_MAX_AGE seconds ago, are built first, as
+        are tiles built without Overpass if it is enabled now.
+        """
+
+        identity = gameobject_class.__mapper__.polymorphic_identity
+
+        # Find all tiles covered by the boxes
+        tiles = set()
+        for bbox in bboxes:
+            for first, last in get_tile_ranges(*bbox):
+                tiles.update(range(first, last + 1))
+        if not tiles:
+            return []
+
+        # Build spawn points of tiles that are not known or outdated
+        oldest = DB.session.query(DB.func.now()).scalar() - timedelta(
+            seconds=APP.config['SPAWN_POINT_MAX_AGE'])
+        known = DB.session.query(SpawnTile.tile).filter(SpawnTile.gameobject_type == identity,
+                                                        SpawnTile.tile.in_(list(tiles)),
+                                                        SpawnTile.created >= oldest)
+        # Tiles built while Overpass was switched off are outdated once it is on
+        if APP.config['OSM_OVERPASS']:
+            known = known.filter(SpawnTile.from_overpass == True)
+        known = known.all()
+        missing = tiles - {row[0] for row in known}
+        if missing:
+            try:
+                SpawnPoint.build(gameobject_class, missing)
+            except IntegrityError:
+                # Another process built the same tiles concurrently
+                DB.session.rollback()
+
+        # Look up spawn points in one query using the index
+        return SpawnPoint.query.filter(
+            SpawnPoint.gameobject_type == identity, SpawnPoint.tile.in_(list(tiles)),
+            or_(*[sa_and(SpawnPoint.latitude.between(bbox[0], bbox[2]),
+                         SpawnPoint.longitude.between(bbox[1], bbox[3])) for bbox in bboxes])).all()
+
+    @staticmethod
+    def invalidate():
+        """ Mark the spawn points of all tiles as outdated, e.g. after
+        importing OSM data.
+        """
+
+        SpawnTile.query.delete(synchronize_session=False)
+        DB.session.commit()
+
+@event.listens_for(OA.node, "after_insert")
+@event.listens_for(OA.node, "after_update")
+@event.listens_for(OA.node, "after_delete")
+def _invalidate_spawn_tile(mapper, connection, target): # pylint: disable=unused-argument
+    """ Mark the spawn points of the tile of a changed OSM node as outdated. """
+
+    if target.latitude is not None and target.longitude is not None:
+        connection.execute(SpawnTile.__table__.delete().where(
+            SpawnTile.tile == get_tile(target.latitude, target.longitude)))
+
 class GameObjectsToAttributes(Base):
     __tablename__ = "gameobjects_to_attributes"
 
@@ -265,7 +694,8 @@ class GameObjectsToAttributes(Base):
                              DB.ForeignKey('attribute.id'))
 
     gameobject = DB.relationship(GameObject, foreign_keys=[gameobject_id],
-                                 backref=DB.backref("attributes",
+                                 backref=DB.backref("eav_attributes" if _COMPACT_ATTRIBUTES
+                                                    else "attributes",
                                                     collection_class=attribute_mapped_collection(
                                                         "key"),
                                                     cascade="all, delete-orphan"))
@@ -274,6 +704,57 @@ class GameObjectsToAttributes(Base):
     key = association_proxy("attribute", "key")
     value = association_proxy("attribute", "value")
 
+class GameObjectAttribute(Base):
+    """ Attribute of a game object, stored as one row per object and key.
+
+    Used instead of GameObjectsToAttributes and Attribute if the
+    ATTRIBUTE_STORAGE setting is "compact".
+    """
+
+    __tablename__ = "gameobject_attribute"
+    __table_args__ = (DB.Index("ix_gameobject_attribute_gameobject_id_key",
+                               "gameobject_id", "key", unique=True),)
+
+    gameobject_id = DB.Column(DB.Integer(), DB.ForeignKey('gameobject.id'), nullable=False)
+    key = DB.Column(DB.Unicode(256), nullable=False)
+    value = DB.Column(DB.Unicode(256))
+
+    gameobject = DB.relationship(GameObject, foreign_keys=[gameobject_id],
+                                 backref=DB.backref("attributes" if _COMPACT_ATTRIBUTES
+                                                    else "compact_attributes",
+                                                    collection_class=attribute_mapped_collection(
+                                                        "key"),
+                                                    cascade="all, delete-orphan"))
+
+def migrate_attributes():
+    """ Move all attributes from the old storage in GameObjectsToAttributes
+    and Attribute to the compact GameObjectAttribute table.
+
+    Attributes already present in the compact table are kept. Returns the
+    number of attributes moved. Afterwards, ATTRIBUTE_STORAGE should be set
+    to "compact".
+    """
+
+    links = GameObjectsToAttributes.__table__
+    attributes = Attribute.__table__
+    target = GameObjectAttribute.__table__
+
+    # Copy everything in one statement, leaving out keys existing in the target
+    existing = exists().where(and_(target.c.gameobject_id == links.c.gameobject_id,
+                                   target.c.key == attributes.c.key))
+    source = select_columns([links.c.gameobject_id, attributes.c.key, attributes.c.value]).select_from(
+        links.join(attributes, links.c.attribute_id == attributes.c.id)).where(
+            and_(links.c.gameobject_id != None, ~existing))
+    count = DB.session.execute(target.insert().from_select(
+        ["gameobject_id", "key", "value"], source)).rowcount
+
+    # Remove the old rows, including attributes left over from deleted links
+    DB.session.execute(links.delete())
+    DB.session.execute(attributes.delete())
+    DB.session.commit()
+
+    return count
+
 class Player(GameObject):
     __tablename__ = "gameobject_player"
 
@@ -312,13 +793,37 @@ class Player(GameObject):
         DB.session.add(self)
         DB.session.commit()
 
+    def get_inventory_counts(self):
+        """ Get the number of items in the inventory by polymorphic type.
+
+        Returns a dictionary like {type: count}, computed with one grouped
+        query and reused for the rest of the current request.
+        """
+
+        # Look for counts computed earlier in this request
+        if has_app_context():
+            cache = g.setdefault("inventory_counts", {})
+            if self.id in cache:
+                return cache[self.id]
+        else:
+            cache = {}
+
+        # Count items in the inventory grouped by type
+        counts = dict(DB.session.query(Item.type, func.count(Item.id))
+                      .select_from(Item)
+                      .filter(Item.owner_id == self.id)
+                      .group_by(Item.type).all())
+
+        cache[self.id] = counts
+        return counts
+
     def has_item(self, itemclass):
         # Return how many items of the class the player has
-        count = 0
-        for item in self.inventory:
-            if isinstance(item, itemclass):
-                count += 1
-        return count
+        counts = self.get_inventory_counts()
+
+        # Sum up counts of the class and all classes derived from it
+        return sum(counts.get(mapper.polymorphic_identity, 0)
+                   for mapper in itemclass.__mapper__.self_and_descendants)
 
     def has_items(self, *itemclasses):
         # Return whether the player has every given item at least one time
@@ -330,19 +835,84 @@ class Player(GameObject):
 
     def drop_item(self, itemclass):
         # Remove every item on a class from the players inventory
-        for item in self.inventory:
-            if isinstance(item, itemclass):
-                DB.session.delete(item)
-                DB.session.commit()
+        self.drop_items(itemclass)
 
     def drop_items(self, *itemclasses):
         # Remove every item of every given class from the players inventory
-        for itemclass in itemclasses:
-            self.drop_item(itemclass)
+        mappers = [mapper for itemclass in itemclasses
+                   for mapper in itemclass.__mapper__.self_and_descendants]
+
+        # Find all items to remove
+        identities = [mapper.polymorphic_identity for mapper in mappers]
+        rows = DB.session.query(Item.id, Item.world_id, Item.latitude, Item.longitude).select_from(
+            Item).filter(Item.owner_id == self.id, Item.type.in_(identities)).all()
+        ids = [row[0] for row in rows]
+
+        if ids:
+            # Record deletion for syncing clients
+            DB.session.execute(GameObjectTombstone.__table__.insert(), [
+                {"gameobject_id": row[0], "world_id": row[1], "latitude": row[2], "longitude": row[3]}
+                for row in rows])
+
+            # Delete from all tables of the inheritance chains and attribute links,
+            # dependent tables first
+            tables = {table for mapper in mappers for table in mapper.tables}
+            for table in reversed(DB.metadata.sorted_tables):
+                if table in tables:
+                    DB.session.execute(table.delete().where(table.c.id.in_(ids)))
+                elif table in (GameObjectsToAttributes.__table__, GameObjectAttribute.__table__):
+                    DB.session.execute(table.delete().where(table.c.gameobject_id.in_(ids)))
+            DB.session.commit()
+
+            # Forget the deleted rows loaded in the session, without loading
+            # anything, so later code in the same request does not see them
+            deleted = set(ids)
+            for obj in list(DB.session.identity_map.values()):
+                state = inspect(obj)
+                if ((isinstance(obj, GameObject) and state.identity[0] in deleted) or
+                        (isinstance(obj, GameObjectAttribute) and
+                         state.dict.get("gameobject_id") in deleted)):
+                    DB.session.expunge(obj)
+            DB.session.expire(self, ["inventory"])
+
+        _clear_inventory_counts()
 
     def may_accept_handover(self, item):
         return True
 
+    def move_to(self, latitude, longitude, path=None):
+        """ Move the player to a new position and collect all items
+        that are auto-collected there.
+
+        If a path of (latitude, longitude) tuples passed on the way is
+        given, items auto-collected anywhere along it are collected as well.
+        Only the new position is stored. Returns the list of collected items.
+        """
+
+        points = list(path or []) + [(latitude, longitude)]
+
+        # Find all items that are auto-collected somewhere on the path in one query
+        items = Item.get_auto_collect_items(self, points)
+
+        # Find which items are reached at which point of the path at once
+        if items:
+            radii = numpy.array([item.auto_collect_radius for item in items], dtype=float)
+            reached = get_distance_matrix(items, points) <= radii[:, numpy.newaxis]
+
+        # Walk the path, so rules of the game are checked where items were reached
+        collected = []
+        for i, point in enumerate(points):
+            self.latitude, self.longitude = point
+            for j, item in enumerate(items):
+                if item.owner is None and reached[j, i]:
+                    if item.collect_by(self) is None:
+                        collected.append(item)
+
+        DB.session.add(self)
+        DB.session.commit()
+
+        return collected
+
     @api_method(authenticated=True)
     def update_position(self, latlon):
         if g.user is None:
@@ -355,15 +925,7 @@ class Player(GameObject):
             return None
 
         # Update position
-        self.latitude, self.longitude = [float(x) for x in latlon.split(",")]
-
-        # FIXME remove slow iteration
-        for item in Item.query.filter_by(world=g.user.current_player.world).all():
-            if item.auto_collect_radius > 0 and item.distance_to_current_player <= item.auto_collect_radius:
-                item.collect()
-
-        DB.session.add(self)
-        DB.session.commit()
+        self.move_to(*[float(x) for x in latlon.split(",")])
 
         # Redirect to own object
         return redirect(url_for(self.__class__, resource_id=self.id))
@@ -380,18 +942,25 @@ class Player(GameObject):
         else:
             cls = self.__class__
 
+        # Seed expression
+        expr = True
+
         if g.user is not None and g.user.current_player is not None:
             # Check if specific constants are set and apply their effects
             mod = g.user.current_player.world.game.module
             if hasattr(mod, "VISIBLE_RAD_PLAYERS"):
                 # Check if the player is in the visible range
-                if self is not cls and self.distance_to_current_player > mod.VISIBLE_RAD_PLAYERS:
+                if self is cls:
+                    expr = and_(expr, cls.in_visible_radius("VISIBLE_RAD_PLAYERS"))
+                elif self.distance_to_current_player > mod.VISIBLE_RAD_PLAYERS:
                     return False
-            if hasattr(mod, "HIDE_SELF"):
+            if hasattr(mod, "HIDE_SELF") and mod.HIDE_SELF:
                 # Hide the player if it is the current player
-                if self is not cls and self == g.user.current_player and mod.HIDE_SELF:
+                if self is cls:
+                    expr = and_(expr, GameObject.id != g.user.current_player.id)
+                elif self == g.user.current_player:
                     return False
-        return True
+        return expr
 
 class Item(GameObject):
     __tablename__ = "gameobject_item"
@@ -412,6 +981,44 @@ class Item(GameObject):
     auto_collect_radius = 0
     show_if_owned_max = None
 
+    @classmethod
+    def get_auto_collect_items(cls, player, path=None):
+        """ Get all items in the world of a player that have an
+        auto_collect_radius including the player's position, or any
+        position on a path of (latitude, longitude) tuples if given.
+        """
+
+        if path is None:
+            path = [(player.latitude, player.longitude)]
+
+        # Find item classes of the game with auto-collect enabled
+        package = "veripeditus.game.%s" % player.world.game.package
+        classes = [mapper.class_ for mapper in cls.__mapper__.self_and_descendants
+                   if mapper.class_.__module__.startswith(package)
+                   and mapper.class_.auto_collect_radius > 0]
+        if not classes:
+            return []
+
+        # Get bounding box around the whole path for the largest radius
+        radius = max(itemclass.auto_collect_radius for itemclass in classes)
+        boxes = [get_bbox_around(latitude, longitude, radius) for latitude, longitude in path]
+        lat_min, lon_min = min(box[0] for box in boxes), min(box[1] for box in boxes)
+        lat_max, lon_max = max(box[2] for box in boxes), max(box[3] for box in boxes)
+
+        # Find uncollected items of these classes using the tile index
+        identities = [itemclass.__mapper__.polymorphic_identity for itemclass in classes]
+        items = cls.query.filter(cls.world_id == player.world_id,
+                                 cls.in_bbox(lat_min, lon_min, lat_max, lon_max),
+                                 cls.type.in_(identities),
+                                 cls.owner_id == None).all()
+
+        # Check the exact distance to any point on the path with the radius of each item
+        if not items:
+            return []
+        radii = numpy.array([item.auto_collect_radius for item in items], dtype=float)
+        reached = (get_distance_matrix(items, path) <= radii[:, numpy.newaxis]).any(axis=1)
+        return [item for item, is_reached in zip(items, reached) if is_reached]
+
     @api_method(authenticated=True)
     def collect(self):
         if g.user is not None and g.user.current_player is not None:
@@ -420,15 +1027,30 @@ class Item(GameObject):
             # FIXME throw proper error
             return None
 
+        # Try to collect and tell the player if that was not allowed
+        message = self.collect_by(player)
+        if message is not None:
+            return send_action("notice", self, message)
+
+        DB.session.commit()
+        return redirect(url_for(self.__class__, resource_id=self.id))
+
+    def collect_by(self, player):
+        """ Make a player the owner of the item if the rules of the game allow it.
+
+        The change is not committed. Returns None if the item was collected,
+        or a message telling why it was not.
+        """
+
         # Check if the player is in range
         if self.distance_max is not None:
             if self.distance_max < self.distance_to(player):
-                return send_action("notice", self, "You are too far away!")
+                return "You are too far away!"
 
         # Check if the player already has the maximum amount of items of a class
         if self.owned_max is not None:
             if player.has_item(self.__class__) >= self.owned_max:
-                return send_action("notice", self, "You have already collected enough of this!")
+                return "You have already collected enough of this!"
 
         # Check if the collection is allowed
         if self.collectible and self.isonmap and self.may_collect(player):
@@ -436,10 +1058,9 @@ class Item(GameObject):
             self.owner = player
             self.on_collected()
             DB.session.add(self)
-            DB.session.commit()
-            return redirect(url_for(self.__class__, resource_id=self.id))
+            return None
         else:
-            return send_action("notice", self, "You cannot collect this!")
+            return "You cannot collect this!"
 
     @api_method(authenticated=True)
     def handover(self, target_player):
@@ -483,19 +1104,23 @@ class Item(GameObject):
                     return False
             mod = g.user.current_player.world.game.module
             if hasattr(mod, "VISIBLE_RAD_ITEMS"):
-                if self is not cls and self.distance_to_current_player > mod.VISIBLE_RAD_ITEMS:
+                if self is cls:
+                    expr = and_(expr, cls.in_visible_radius("VISIBLE_RAD_ITEMS"))
+                elif self.distance_to_current_player > mod.VISIBLE_RAD_ITEMS:
                     return False
 
         # Verify conditional attributes for spawning
-        # Independent of class or instance method
-        if hasattr(self, "spawn_player_attributes"):
+        # Independent of class or instance method, and only if there is a
+        # player to check, e.g. not when counting objects for spawning
+        if (hasattr(self, "spawn_player_attributes") and g.user is not None and
+                g.user.current_player is not None):
+            # Look up only the needed attributes of the player at once
+            values = g.user.current_player.get_attribute_values(list(self.spawn_player_attributes))
             for key, value in self.spawn_player_attributes.items():
-                if key in g.user.current_player.attributes:
-                    attribute = g.user.current_player.attributes[key]
-                else:
+                if key not in values:
                     return False
 
-                if value is not None and attribute != value:
+                if value is not None and values[key] != value:
                     return False
 
         # Find out final return value
@@ -518,6 +1143,22 @@ class Item(GameObject):
     def on_handedover(self):
         pass
 
+def _clear_inventory_counts():
+    """ Forget inventory counts computed in the current request. """
+
+    if has_app_context():
+        g.pop("inventory_counts", None)
+
+@event.listens_for(Item.owner, "set", propagate=True)
+def _on_owner_set(target, value, oldvalue, initiator): # pylint: disable=unused-argument
+    """ Invalidate inventory counts when an item changes its owner. """
+
+    _clear_inventory_counts()
+
+    # The owner is stored in the item table only, so mark the game object
+    # as changed explicitly for clients syncing changes
+    target.updated = DB.func.now()
+
 class NPC(GameObject):
     __tablename__ = "gameobject_npc"
 
@@ -564,10 +1205,15 @@ class NPC(GameObject):
         else:
             cls = self.__class__
 
+        # Seed expression
+        expr = True
+
         if g.user is not None and g.user.current_player is not None:
             mod = g.user.current_player.world.game.module
             if hasattr(mod, "VISIBLE_RAD_NPCS"):
-                if self is not cls and self.distance_to_current_player > mod.VISIBLE_RAD_NPCS:
+                if self is cls:
+                    expr = and_(expr, cls.in_visible_radius("VISIBLE_RAD_NPCS"))
+                elif self.distance_to_current_player > mod.VISIBLE_RAD_NPCS:
                     return False
 
-        return True
+        return expr
@@ -18,23 +18,30 @@ Utility functions for framework components
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import Sequence
 import json
+import math
+from numbers import Real
 import os
-import random
 import sys
 
 from flask import g
 from gpxpy import geo
-from shapely.geometry import Point, Polygon
+import numpy
+from sqlalchemy import or_
 
-def get_image_path(game_mod, basename):
-    """
-    Get the path for an image file (.svg or .png, in order).
+# Zoom level of the slippy map tiles used as spatial key for game objects
+TILE_ZOOM = 16
 
-    Keyword arguments:
+# Maximum latitude covered by slippy map tiles
+_TILE_MAX_LAT = 85.0511287798
 
-    game_mod -- reference to the game module
-    basename -- name of the file without its extension
+# Index of image files per game, like {game module name: {basename: path}}
+_IMAGE_INDEX = {}
+
+def _get_data_paths(game_mod):
+    """
+    Get the data directories of the framework and a game module.
     """
 
     # Get module paths of framework and the provided game
@@ -42,31 +49,189 @@ def get_image_path(game_mod, basename):
     _path_game = os.path.dirname(game_mod.__file__)
 
     # Get data sub-directories
-    _respath_framework = os.path.join(_path_framework, "data")
-    _respath_game = os.path.join(_path_game, "data")
+    return (os.path.join(_path_framework, "data"),
+            os.path.join(_path_game, "data"))
+
+def build_image_index(game_mod):
+    """
+    Scan the data directories of the framework and a game module for
+    images and store them in the image index.
+
+    Keyword arguments:
+
+    game_mod -- reference to the game module
+    """
 
-    # Define extensions and paths to search
+    # Define extensions and paths to search, in order of precedence
     _extensions = (".svg", ".png")
-    _paths = (_respath_framework, _respath_game)
+    _paths = _get_data_paths(game_mod)
 
-    # Define fallback image if nothing else is found
-    _fallback = os.path.join(_respath_framework, "dummy.svg")
+    # Fill index starting with the lowest precedence, so files with
+    # higher precedence overwrite the entries
+    _index = {}
+    for _extension in reversed(_extensions):
+        for _path in reversed(_paths):
+            if not os.path.isdir(_path):
+                continue
+            for _filename in os.listdir(_path):
+                _basename, _ext = os.path.splitext(_filename)
+                _possibility = os.path.join(_path, _filename)
+                if _ext == _extension and os.path.isfile(_possibility):
+                    _index[_basename] = _possibility
+
+    _IMAGE_INDEX[game_mod.__name__] = _index
+
+def clear_image_index():
+    """
+    Clear the image index, e.g. after games were reloaded.
+    """
 
-    # Generate a list of all possibilities
-    _possibilities = ([os.path.join(_path, basename+_extension)
-                       for _extension in _extensions
-                       for _path in _paths] +
-                      [_fallback])
+    _IMAGE_INDEX.clear()
 
-    # Iterate over all possibilities and return the first existing resource
-    for _possibility in _possibilities:
-        if os.path.isfile(_possibility):
-            return _possibility
+def get_image_path(game_mod, basename):
+    """
+    Get the path for an image file (.svg or .png, in order).
+
+    Files are looked up in the image index, which is built on first use.
+
+    Keyword arguments:
+
+    game_mod -- reference to the game module
+    basename -- name of the file without its extension
+    """
+
+    # Build index for the game if it is not known yet
+    if game_mod.__name__ not in _IMAGE_INDEX:
+        build_image_index(game_mod)
+
+    # Define fallback image if nothing else is found
+    _fallback = os.path.join(_get_data_paths(game_mod)[0], "dummy.svg")
+
+    return _IMAGE_INDEX[game_mod.__name__].get(basename, _fallback)
 
 def get_gameobject_distance(obj1, obj2):
     return geo.haversine_distance(obj1.latitude, obj1.longitude,
                                         obj2.latitude, obj2.longitude)
 
+def get_bbox_around(latitude, longitude, radius):
+    """
+    Get a bounding box containing a circle.
+
+    Returns a tuple like (lat_min, lon_min, lat_max, lon_max).
+
+    Keyword arguments:
+
+    latitude, longitude -- centre of the circle
+    radius -- radius of the circle in metres
+    """
+
+    # Distances along meridians are constant, along parallels they shrink
+    delta_lat = math.degrees(radius / geo.EARTH_RADIUS)
+    delta_lon = delta_lat / max(math.cos(math.radians(latitude)), 0.01)
+
+    return (latitude - delta_lat, longitude - delta_lon,
+            latitude + delta_lat, longitude + delta_lon)
+
+def get_tile(latitude, longitude, zoom=TILE_ZOOM):
+    """
+    Get the slippy map tile containing a coordinate.
+
+    The tile is returned as a single number y * 2^zoom + x, so tiles
+    in one row of the map have consecutive numbers.
+    """
+
+    _n = 2 ** zoom
+
+    # Clamp to the area covered by the tiles
+    _lat = max(min(latitude, _TILE_MAX_LAT), -_TILE_MAX_LAT)
+
+    _x = int((longitude + 180.0) / 360.0 * _n)
+    _y = int((1.0 - math.asinh(math.tan(math.radians(_lat))) / math.pi) / 2.0 * _n)
+
+    return min(max(_y, 0), _n - 1) * _n + min(max(_x, 0), _n - 1)
+
+def get_tile_bbox(tile, zoom=TILE_ZOOM):
+    """
+    Get the bounding box of a tile as returned by get_tile.
+
+    Returns a tuple like (lat_min, lon_min, lat_max, lon_max).
+    """
+
+    _n = 2 ** zoom
+    _y, _x = divmod(tile, _n)
+
+    def _lat(_row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1.0 - 2.0 * _row / _n))))
+
+    return (_lat(_y + 1), _x / _n * 360.0 - 180.0,
+            _lat(_y), (_x + 1) / _n * 360.0 - 180.0)
+
+def get_tile_ranges(lat_min, lon_min, lat_max, lon_max, zoom=TILE_ZOOM, max_ranges=None):
+    """
+    Get the tiles covering a bounding box as a list of ranges.
+
+    Returns a list of (first, last) tuples, one for each row of tiles.
+    If there are more than max_ranges rows, a single range from the
+    first to the last tile is returned, which also contains the tiles
+    outside of the box in these rows.
+    """
+
+    _n = 2 ** zoom
+
+    # Tile rows are counted from north to south
+    _first = get_tile(lat_max, lon_min, zoom)
+    _last = get_tile(lat_min, lon_max, zoom)
+
+    # Fall back to one coarse range for large boxes
+    if max_ranges is not None and _last // _n - _first // _n >= max_ranges:
+        return [(_first, _last)]
+
+    return [(_y * _n + _first % _n, _y * _n + _last % _n)
+            for _y in range(_first // _n, _last // _n + 1)]
+
+def get_tile_blocks(tiles, zoom=TILE_ZOOM):
+    """
+    Get the bounding boxes of blocks of adjacent tiles covering a set of tiles.
+
+    Runs of adjacent tiles in a row are joined, and so are runs spanning
+    the same columns in adjacent rows, so separate areas never end up in
+    the same box. Returns a list of tuples like
+    (lat_min, lon_min, lat_max, lon_max).
+    """
+
+    _n = 2 ** zoom
+
+    # Find runs of consecutive tiles in each row
+    runs = []
+    for tile in sorted(tiles):
+        if runs and runs[-1][1] == tile - 1 and tile % _n != 0:
+            runs[-1][1] = tile
+        else:
+            runs.append([tile, tile])
+
+    # Join runs covering the same columns in adjacent rows, keyed by
+    # their columns and the row a continuing run would be in
+    blocks = {}
+    for _first, _last in runs:
+        block = blocks.pop((_first % _n, _last % _n, _first // _n), None)
+        if block is None:
+            block = [_first, _last]
+        else:
+            block[1] = _last
+        blocks[(_first % _n, _last % _n, _first // _n + 1)] = block
+
+    # The first tile is the north-western one, the last the south-eastern
+    return [(get_tile_bbox(_last, zoom)[0], get_tile_bbox(_first, zoom)[1],
+             get_tile_bbox(_first, zoom)[2], get_tile_bbox(_last, zoom)[3])
+            for _first, _last in blocks.values()]
+
+def tile_filter(column, ranges):
+    """
+    Get an SQL expression matching a tile column against a list of ranges.
+    """
+
+    return or_(*[column.between(_first, _last) for _first, _last in ranges])
+
 def current_player():
     return None if g.user is None else g.user.current_player
 
@@ -77,13 +242,120 @@ def send_action(action, gameobject, message):
                        "message": message
                       })
 
-def random_point_in_polygon(points):
-    polygon = Polygon(points)
-    bounds = polygon.bounds
+def _triangulate(points):
+    """
+    Split a simple polygon into triangles by ear clipping.
+
+    Returns a list of (i, j, k) tuples of indices into points.
+    """
+
+    # Drop repeated first point of closed rings
+    if len(points) > 3 and tuple(points[0]) == tuple(points[-1]):
+        points = points[:-1]
 
-    while True:
-        point = Point(random.uniform(bounds[0], bounds[1]), random.uniform(bounds[2], bounds[3]))
-        if polygon.contains(point):
+    def _cross(_a, _b, _c):
+        return ((points[_b][0] - points[_a][0]) * (points[_c][1] - points[_a][1]) -
+                (points[_b][1] - points[_a][1]) * (points[_c][0] - points[_a][0]))
+
+    # Walk the ring counter-clockwise
+    _indices = list(range(len(points)))
+    if sum(_cross(0, _i, _i + 1) for _i in range(1, len(points) - 1)) < 0:
+        _indices.reverse()
+
+    triangles = []
+    while len(_indices) > 3:
+        for _i in range(len(_indices)):
+            _a, _b, _c = _indices[_i - 1], _indices[_i], _indices[(_i + 1) % len(_indices)]
+
+            # An ear is convex and contains no other vertex
+            if _cross(_a, _b, _c) <= 0:
+                continue
+            if any(_cross(_a, _b, _p) >= 0 and _cross(_b, _c, _p) >= 0 and _cross(_c, _a, _p) >= 0
+                   for _p in _indices if _p not in (_a, _b, _c)):
+                continue
+
+            triangles.append((_a, _b, _c))
+            del _indices[_i]
             break
+        else:
+            raise ValueError("Polygon is not simple.")
+    triangles.append(tuple(_indices))
+
+    return triangles
+
+class SpawnArea(object):
+    """
+    Area to spawn game objects in, defined like GameObject.spawn_latlon.
+
+    The geometry is prepared once, so any number of random points can
+    then be drawn uniformly with one call to sample. Supported forms are:
+
+     (lat, lon)                        -- a single point
+     ((lat, lon), (lat, lon))          -- a rectangle
+     ((lat, lon), (lat, lon), …)       -- a polygon
+     ((lat, lon), radius)              -- a circle, radius in metres
+    """
+
+    def __init__(self, latlon):
+        if isinstance(latlon[0], Sequence) and isinstance(latlon[1], Sequence):
+            if len(latlon) == 2:
+                # Rectangle from two corners
+                self.kind = "rect"
+                self._corners = numpy.array(latlon, dtype=float)
+            else:
+                # Polygon, split into triangles weighted by their area
+                self.kind = "polygon"
+                points = numpy.array(latlon, dtype=float)
+                self._triangles = points[numpy.array(_triangulate(points.tolist()))]
+                _ab = self._triangles[:, 1] - self._triangles[:, 0]
+                _ac = self._triangles[:, 2] - self._triangles[:, 0]
+                areas = numpy.abs(_ab[:, 0] * _ac[:, 1] - _ab[:, 1] * _ac[:, 0])
+                self._weights = areas / areas.sum()
+        elif isinstance(latlon[0], Sequence) and isinstance(latlon[1], Real):
+            # Circle around a centre
+            self.kind = "circle"
+            self._centre = numpy.array(latlon[0], dtype=float)
+            self._radius = float(latlon[1])
+        elif isinstance(latlon[0], Real) and isinstance(latlon[1], Real):
+            # Single point
+            self.kind = "point"
+            self._centre = numpy.array(latlon, dtype=float)
+        else:
+            raise TypeError("Unknown value for spawn_latlon.")
+
+    def sample(self, number, rng=numpy.random):
+        """
+        Get random points within the area.
+
+        Returns an array of shape (number, 2) with latitude and longitude.
+        """
+
+        if self.kind == "point":
+            return numpy.tile(self._centre, (number, 1))
+        elif self.kind == "rect":
+            return rng.uniform(self._corners[0], self._corners[1], (number, 2))
+        elif self.kind == "polygon":
+            # Pick triangles by area, then points within them,
+            # mirroring points from the far half of the parallelogram
+            triangles = self._triangles[rng.choice(len(self._triangles), number, p=self._weights)]
+            _u, _v = rng.uniform(size=(2, number, 1))
+            _flip = (_u + _v) > 1
+            _u, _v = numpy.where(_flip, 1 - _u, _u), numpy.where(_flip, 1 - _v, _v)
+            return (triangles[:, 0] + _u * (triangles[:, 1] - triangles[:, 0]) +
+                    _v * (triangles[:, 2] - triangles[:, 0]))
+        else:
+            # Uniform distance and direction, converted from metres to degrees
+            _r = self._radius * numpy.sqrt(rng.uniform(size=number))
+            _theta = rng.uniform(0, 2 * math.pi, number)
+            _lat = self._centre[0] + numpy.degrees(_r * numpy.cos(_theta) / geo.EARTH_RADIUS)
+            _lon = self._centre[1] + numpy.degrees(_r * numpy.sin(_theta) / geo.EARTH_RADIUS /
+                                                   max(math.cos(math.radians(self._centre[0])),
+                                                       0.01))
+            return numpy.column_stack((_lat, _lon))
+
+def random_point_in_polygon(points):
+    """
+    Get a random point within a polygon as a (lat, lon) tuple.
+    """
 
-    return point.bounds[0:2]
+    return tuple(SpawnArea(points).sample(1)[0])
@@ -28,6 +28,10 @@ VISIBLE_RAD_NPCS = 1000000000
 class Player(f.Player):
     pass
 
+class Beer(f.Item):
+    default_name = "Beer"
+    owned_max = 3
+
 class Kangoo(f.NPC):
     spawn_osm = {"natural": "tree"}
     default_name = "Kangoo"
@@ -22,11 +22,12 @@ as a Flask application, either stand-alone or as a WSGI application.
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import os
 from os.path import realpath
 
 from flask import send_from_directory
 
-from veripeditus.server.app import APP
+from veripeditus.server.app import APP, create_app
 
 def server_main(): # pragma: no cover
     """ Entry point for the veripeditus-standalone command.
@@ -45,8 +46,22 @@ def server_main(): # pragma: no cover
                          default="5000")
     aparser.add_argument("-z", "--gzip", help="enable GZip compression for HTTP",
                          action="store_true")
+    aparser.add_argument("-S", "--no-spawner", help="do not spawn game objects in this "
+                                                    "process, e.g. if veripeditus-spawner runs",
+                         action="store_true")
     args = aparser.parse_args()
 
+    # A single process can sign tokens with a random key
+    if not APP.config['SECRET_KEY']:
+        APP.config['SECRET_KEY'] = os.urandom(32)
+
+    create_app()
+
+    # Nothing else can initialise a database in memory
+    if APP.config['SQLALCHEMY_DATABASE_URI'] == 'sqlite:///:memory:':
+        from veripeditus.server.control import init
+        init()
+
     # Enable debugging in Flask application if debug option was set
     if args.debug:
         APP.debug = True
@@ -66,9 +81,104 @@ def server_main(): # pragma: no cover
         from flask_compress import Compress
         Compress(APP)
 
+    # The stand-alone server is a single process, so it can run the spawner;
+    # with debug enabled, only in the reloaded process serving requests
+    if not args.no_spawner and (not APP.debug or os.environ.get("WERKZEUG_RUN_MAIN")):
+        from veripeditus.server.spawn import SCHEDULER
+        SCHEDULER.start()
+
     # Run Flask application
     APP.run(host=args.host, port=int(args.port))
 
+def spawner_main(): # pragma: no cover
+    """ Entry point for the veripeditus-spawner command.
+
+    Runs the spawn scheduler in the foreground. Deployments with several
+    server processes should run exactly one of these, and leave
+    SPAWN_THREAD disabled.
+    """
+
+    create_app()
+
+    from veripeditus.server.spawn import SCHEDULER
+    SCHEDULER.run()
+
+def push_main(): # pragma: no cover
+    """ Entry point for the veripeditus-push command.
+
+    Runs the WebSocket server pushing world events to clients.
+    """
+
+    # parse arguments
+    aparser = argparse.ArgumentParser()
+    aparser.add_argument("-H", "--host", help="the host address to listen on",
+                         default=APP.config['PUSH_HOST'])
+    aparser.add_argument("-P", "--port", help="the port to listen on",
+                         default=str(APP.config['PUSH_PORT']))
+    args = aparser.parse_args()
+
+    create_app()
+
+    from veripeditus.server.push import PushServer
+    PushServer(APP).serve_forever(args.host, int(args.port))
+
+def osm_import_main(): # pragma: no cover
+    """ Entry point for the veripeditus-osm-import command.
+
+    Imports OSM extracts into the database, so no data needs to be
+    fetched from Overpass while playing.
+    """
+
+    # parse arguments
+    aparser = argparse.ArgumentParser()
+    aparser.add_argument("files", help="OSM XML (.osm, .osm.gz, .osm.bz2) or PBF files",
+                         nargs="+")
+    aparser.add_argument("-b", "--batch-size", help="number of elements per transaction",
+                         default="10000")
+    args = aparser.parse_args()
+
+    from veripeditus.server.osm import import_osm_file
+    for path in args.files:
+        counts = import_osm_file(path, int(args.batch_size))
+        print("%s: %i nodes, %i ways" % (path, counts["node"], counts["way"]))
+
+def admin_main(): # pragma: no cover
+    """ Entry point for the veripeditus-admin command.
+
+    Runs the tasks that change the database once per deployment, so
+    server workers do not need to.
+    """
+
+    # parse arguments
+    aparser = argparse.ArgumentParser()
+    subparsers = aparser.add_subparsers(dest="command")
+    subparsers.add_parser("init", help="create tables, sync games and add example data")
+    migrate_parser = subparsers.add_parser("migrate", help="update the schema after an upgrade")
+    migrate_parser.add_argument("--attributes", action="store_true",
+                                help="move game object attributes to the compact storage")
+    subparsers.add_parser("sync-games", help="sync installed games to the database")
+    accounts_parser = subparsers.add_parser("import-accounts",
+                                            help="create users from an accounts list")
+    accounts_parser.add_argument("file", help="file with one username and password per line")
+    args = aparser.parse_args()
+
+    from veripeditus.server import control
+
+    if args.command == "init":
+        control.init()
+    elif args.command == "migrate":
+        for change in control.migrate():
+            print(change)
+        if args.attributes:
+            from veripeditus.framework.model import migrate_attributes
+            print("%i attributes moved" % migrate_attributes())
+    elif args.command == "sync-games":
+        control.reload()
+    elif args.command == "import-accounts":
+        print("%i users created" % control.import_accounts(args.file))
+    else:
+        aparser.print_help()
+
 # Allow direct calling of this script
 if __name__ == '__main__': # pragma: no cover
     # Jump to veripeditus-standalone entry point
@@ -2,6 +2,10 @@
 Flask application code for the Veripeditus server
 
 This module contains everything to set up the Flask application.
+
+Importing it only configures the application and the models. Endpoints
+are registered by create_app, and nothing is written to the database
+until veripeditus-admin init is run, or control.init is called.
 """
 
 # veripeditus-server - Server component for the Veripeditus game framework
@@ -23,8 +27,7 @@ This module contains everything to set up the Flask application.
 # pragma pylint: disable=wrong-import-position
 # pragma pylint: disable=unused-import
 
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+from flask import Config, Flask
 from osmalchemy import OSMAlchemy
 
 # Get a basic Flask application
@@ -33,25 +36,124 @@ APP = Flask(__name__)
 # Default configuration
 # FIXME allow modification after module import
 APP.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+# Connection pool: number of connections kept and opened on top of them,
+# seconds to wait for a connection and to reuse one (None keeps the
+# default); connections to SQLite files are only pooled if DB_POOL_SIZE
+# is set
+APP.config['DB_POOL_SIZE'] = None
+APP.config['DB_MAX_OVERFLOW'] = None
+APP.config['DB_POOL_TIMEOUT'] = None
+APP.config['DB_POOL_RECYCLE'] = None
+# Database engine settings: check pooled connections before use, maximum
+# run time of statements in seconds (PostgreSQL only), and SQLite pragmas
+# (journal mode, synchronous mode, seconds to wait for locks; None keeps
+# the SQLite default)
+APP.config['DB_POOL_PRE_PING'] = False
+APP.config['DB_STATEMENT_TIMEOUT'] = None
+APP.config['DB_SQLITE_JOURNAL_MODE'] = None
+APP.config['DB_SQLITE_SYNCHRONOUS'] = None
+APP.config['DB_SQLITE_BUSY_TIMEOUT'] = None
+# Set of engine settings for several server, spawner and push processes
+# sharing a database, "sqlite-workers" or "postgresql-workers" (see
+# veripeditus.server.db.PROFILES); settings in the files below override it
+APP.config['DB_PROFILE'] = None
 APP.config['PASSWORD_SCHEMES'] = ['pbkdf2_sha512', 'md5_crypt']
 APP.config['BASIC_REALM'] = "Veripeditus"
+# Key for signing session tokens; must be set to the same secret value
+# for all server processes, which refuse to start without it
+APP.config['SECRET_KEY'] = None
+# Lifetime of session tokens, and size and lifetime of the cache of
+# verified credentials, in seconds
+APP.config['AUTH_TOKEN_MAX_AGE'] = 86400
+APP.config['AUTH_CACHE_SIZE'] = 1024
+APP.config['AUTH_CACHE_TTL'] = 300
+# Spawn scheduler: default interval and per-world intervals in seconds,
+# seconds between ticks, maximum number of spawn jobs per tick (0 = unlimited)
+# and whether to run the scheduler in a thread of every server process;
+# only enable this with a single server process, and run one
+# veripeditus-spawner otherwise, as every scheduler spawns on its own
+APP.config['SPAWN_INTERVAL'] = 60
+APP.config['SPAWN_WORLD_INTERVALS'] = {}
+APP.config['SPAWN_TICK'] = 5
+APP.config['SPAWN_BUDGET'] = 20
+APP.config['SPAWN_THREAD'] = False
+# Seconds after which spawn points built from OSM data are rebuilt
+APP.config['SPAWN_POINT_MAX_AGE'] = 86400
+# Seconds to remember deleted game objects for clients syncing changes
+APP.config['SYNC_TOMBSTONE_MAX_AGE'] = 3600
+# Default and maximum number of objects per page of API listings
+APP.config['API_PAGE_SIZE'] = 100
+APP.config['API_MAX_PAGE_SIZE'] = 1000
+# Number of rows fetched at once when streaming exports
+APP.config['API_EXPORT_BATCH_SIZE'] = 1000
+# Check the exact distance in queries for visible radii, not only the bounding box
+APP.config['VISIBILITY_EXACT'] = True
+# Storage of game object attributes, "eav" for the Attribute table linked
+# to objects, or "compact" for one row per object and key; see
+# veripeditus-admin migrate --attributes
+APP.config['ATTRIBUTE_STORAGE'] = "eav"
+# Tables of derived game object classes joined into every query, None to
+# only load the queried class and its parents, or "*" for all derived classes
+APP.config['GAMEOBJECT_WITH_POLYMORPHIC'] = None
+# Push server: address to listen on and seconds between polls for changes
+APP.config['PUSH_HOST'] = "127.0.0.1"
+APP.config['PUSH_PORT'] = 5001
+APP.config['PUSH_INTERVAL'] = 1
+
+# Whether OSM data is fetched from Overpass when missing; can be
+# changed at runtime, e.g. after importing an extract
+APP.config['OSM_OVERPASS'] = True
+# Overpass response cache shared by all processes: path of an SQLite file
+# (None = no cache), lifetime of responses in seconds, maximum size in bytes
+# and minimum seconds between requests to the Overpass server
+APP.config['OSM_OVERPASS_CACHE'] = None
+APP.config['OSM_OVERPASS_CACHE_TTL'] = 7 * 86400
+APP.config['OSM_OVERPASS_CACHE_SIZE'] = 256 * 1024 * 1024
+APP.config['OSM_OVERPASS_INTERVAL'] = 1.0
+
+# Accounts list imported by veripeditus-admin init, if it exists
+APP.config['ACCOUNTS_FILE'] = "/etc/veripeditus/accounts.lst"
 
 # Load configuration from a list of text files
 CFGLIST = ['/var/lib/veripeditus/dbconfig.cfg', '/etc/veripeditus/server.cfg']
+_FILE_CONFIG = Config(APP.root_path)
 for cfg in CFGLIST:
-    APP.config.from_pyfile(cfg, silent=True)
+    _FILE_CONFIG.from_pyfile(cfg, silent=True)
+
+# Apply the database profile below the settings from the files
+from veripeditus.server.db import PROFILES, ConfiguredSQLAlchemy
+_PROFILE = _FILE_CONFIG.get('DB_PROFILE', APP.config['DB_PROFILE'])
+if _PROFILE is not None:
+    APP.config.update(PROFILES[_PROFILE])
+APP.config.update(_FILE_CONFIG)
 
 # Initialise SQLAlchemy and OSMAlchemy
-DB = SQLAlchemy(APP)
+DB = ConfiguredSQLAlchemy(APP)
 OA = OSMAlchemy(DB, overpass=True)
 
-# Import model and create tables
+# Allow switching off Overpass through the configuration
+from veripeditus.server.osm import OverpassSwitch
+OA.overpass = OverpassSwitch(OA.overpass)
+
+# Import model
 import veripeditus.server.model
-DB.create_all()
 
-# Run initialisation code
-from veripeditus.server.control import init
-init()
+def create_app():
+    """ Get the application with all endpoints and hooks registered.
+
+    Only imports the modules defining them, so it can be called by every
+    worker and any number of times without touching the database.
+    """
+
+    # Tokens signed with a key made up per process fail in all others
+    if not APP.config['SECRET_KEY']:
+        raise RuntimeError("SECRET_KEY is not set in the configuration.")
+
+    # Authentication and REST API
+    import veripeditus.server.control
+    import veripeditus.server.rest
+
+    # Set up background spawning of game objects
+    import veripeditus.server.spawn
 
-# Import REST API last
-import veripeditus.server.rest
+    return APP
@@ -16,10 +16,123 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import OrderedDict
 from enum import Enum
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
 
 class Roles(Enum):
     """ Enumeration of all available roles. """
 
     player = "PLAYER"
     admin = "ADMIN"
+
+def get_password_fingerprint(password):
+    """ Get a short fingerprint of a stored password hash.
+
+    The fingerprint changes whenever the password is changed, so it
+    can be used to invalidate cached credentials and tokens.
+    """
+
+    if password is None or password.hash is None:
+        return None
+    return hashlib.sha256(password.hash).hexdigest()[:16]
+
+class CredentialCache(object):
+    """ Bounded cache of recently verified credentials.
+
+    Stores a keyed digest of the username and password, never the
+    password itself. Entries expire after ttl seconds, and the least
+    recently used entries are evicted once size entries are stored.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+
+        # Random key per process, so digests are useless outside of it
+        self._key = os.urandom(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _digest(self, username, password):
+        """ Get the keyed digest for a pair of credentials. """
+
+        msg = ("%s\0%s" % (username, password)).encode("utf-8")
+        return hmac.new(self._key, msg, hashlib.sha256).digest()
+
+    def get(self, username, password):
+        """ Look up credentials.
+
+        Returns a tuple like (user_id, fingerprint) if the credentials
+        were verified recently, or None otherwise.
+        """
+
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                return None
+
+            digest, user_id, fingerprint, expires = entry
+            if expires < time.monotonic():
+                # Drop expired entry
+                del self._entries[username]
+                return None
+
+            # Mark as recently used
+            self._entries.move_to_end(username)
+
+        if not hmac.compare_digest(digest, self._digest(username, password)):
+            return None
+        return user_id, fingerprint
+
+    def put(self, username, password, user_id, fingerprint):
+        """ Store verified credentials. """
+
+        if self.size <= 0:
+            return
+
+        entry = (self._digest(username, password), user_id, fingerprint,
+                 time.monotonic() + self.ttl)
+        with self._lock:
+            self._entries[username] = entry
+            self._entries.move_to_end(username)
+
+            # Evict least recently used entries
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username):
+        """ Remove the entry for a user, e.g. after the password changed. """
+
+        with self._lock:
+            self._entries.pop(username, None)
+
+def _get_token_serializer(secret_key):
+    """ Get the serializer used for signing session tokens. """
+
+    return URLSafeTimedSerializer(secret_key, salt="veripeditus-session")
+
+def create_token(secret_key, user_id, fingerprint):
+    """ Create a signed session token for a user. """
+
+    return _get_token_serializer(secret_key).dumps([user_id, fingerprint])
+
+def load_token(secret_key, token, max_age):
+    """ Verify a signed session token.
+
+    Returns a tuple like (user_id, fingerprint) if the token is valid
+    and not older than max_age seconds, or None otherwise.
+    """
+
+    try:
+        user_id, fingerprint = _get_token_serializer(secret_key).loads(token, max_age=max_age)
+    except (BadSignature, TypeError, ValueError):
+        return None
+
+    return user_id, fingerprint
@@ -24,12 +24,13 @@ used directly in views.
 
 import os
 from flask import request, Response, g
+import sqlalchemy
 
-from veripeditus.framework.model import GameObject
+from veripeditus.framework.util import build_image_index
 from veripeditus.server.app import DB, APP
 from veripeditus.server.auth import Roles
 from veripeditus.server.model import User, Game, World
-from veripeditus.server.util import get_games
+from veripeditus.server.util import get_games, reload_games
 
 def _sync_games():
     """ Find all installed games and sync them to the database. """
@@ -37,15 +38,15 @@ def _sync_games():
     # Get all installed games
     games = get_games()
 
+    # Get all known games at once
+    known = {(game.package, game.name, game.version): game for game in Game.query.all()}
+
     # Iterate over package names and modules
     for package in games.keys():
         module = games[package]
 
-        # Check if game is in database
-        game = Game.query.filter_by(package=package, name=module.NAME,
-                                    version=module.VERSION).first()
-
-        # Create new object if nonexistent
+        # Check if game is in database, and create new object if nonexistent
+        game = known.get((package, module.NAME, module.VERSION))
         if game is None:
             game = Game()
 
@@ -57,9 +58,13 @@ def _sync_games():
         game.author = module.AUTHOR
         game.license = module.LICENSE
 
-        # Write to database
         DB.session.add(game)
-        DB.session.commit()
+
+        # Find all images of the game
+        build_image_index(module)
+
+    # Write to database
+    DB.session.commit()
 
 def _add_data():
     """ Create example data (only if database was unused, e.g. no User
@@ -83,49 +88,139 @@ def _add_data():
         DB.session.add(world)
         DB.session.commit()
 
-    # Check for existance of account list file
-    # FIXME make this configurable
-    # FIXME move to own function or drop
-    if os.path.isfile("/etc/veripeditus/accounts.lst"):
-        # Open accounts list file and load entries from it
-        with open("/etc/veripeditus/accounts.lst", "r") as file:
-            for line in file.readlines():
-                # Split username and password from line
-                username, password = line.strip().split(" ")
-
-                # Create user if a user with this name does not exist
-                if not User.query.filter_by(username=username).scalar():
-                    user = User()
-                    user.username = username
-                    user.password = password
-                    user.name = username
-                    DB.session.add(user)
-
-        # Commit to database at the end
-        DB.session.commit()
+def import_accounts(path):
+    """ Create users from an accounts list file with one username and
+    password per line, separated by a space.
+
+    Existing users are left alone. Returns the number of created users.
+    """
+
+    # Open accounts list file and load entries from it
+    with open(path, "r") as file:
+        accounts = [line.strip().split(" ") for line in file if line.strip()]
+
+    # Find existing users at once
+    existing = {row[0] for row in DB.session.query(User.username).filter(
+        User.username.in_([username for username, _ in accounts]))} if accounts else set()
+
+    created = 0
+    for username, password in accounts:
+        # Create user if a user with this name does not exist
+        if username not in existing:
+            user = User()
+            user.username = username
+            user.password = password
+            user.name = username
+            DB.session.add(user)
+            existing.add(username)
+            created += 1
+
+    # Commit to database at the end
+    DB.session.commit()
+
+    return created
 
 def init():
-    """ Initialise server by calling some setup routines. """
+    """ Initialise the database by creating missing tables, syncing the
+    installed games and adding example data to an empty database.
 
+    Meant to be run once per deployment, e.g. by veripeditus-admin init,
+    and not by every worker.
+    """
+
+    DB.create_all()
     _sync_games()
     _add_data()
 
+    # Import accounts from the list file, if configured
+    if APP.config['ACCOUNTS_FILE'] and os.path.isfile(APP.config['ACCOUNTS_FILE']):
+        import_accounts(APP.config['ACCOUNTS_FILE'])
+
+def migrate():
+    """ Bring the schema of an existing database up to date with the models.
+
+    Creates missing tables, adds missing columns to existing tables and
+    creates missing indexes. Added columns are nullable, so existing rows
+    keep working until they are filled in, which is done here for columns
+    the server depends on. Returns a list of descriptions of the changes.
+    """
+
+    # pragma pylint: disable=cyclic-import
+    from veripeditus.framework.model import backfill_tiles
+
+    changes = []
+
+    # Remember tables before creating the missing ones with their indexes
+    inspector = sqlalchemy.inspect(DB.engine)
+    existing = set(inspector.get_table_names())
+    DB.create_all()
+
+    for table in DB.metadata.sorted_tables:
+        if table.name not in existing:
+            changes.append("created table %s" % table.name)
+            continue
+
+        # Add columns the models have, but the table does not
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                with DB.engine.begin() as connection:
+                    connection.execute(sqlalchemy.text("ALTER TABLE %s ADD COLUMN %s %s" % (
+                        table.name, column.name, column.type.compile(dialect=DB.engine.dialect))))
+                changes.append("added column %s.%s" % (table.name, column.name))
+
+        # Create indexes the models have, but the table does not
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(DB.engine)
+                changes.append("created index %s" % index.name)
+
+    # Fill in the tile index of game objects from older versions
+    count = backfill_tiles()
+    if count:
+        changes.append("filled in tile of %i game objects" % count)
+
+    return changes
+
+def reload():
+    """ Discover newly installed games and sync them to the database.
+
+    Allows adding games without restarting the server.
+    """
+
+    reload_games()
+    _sync_games()
+
 @APP.before_request
 def _check_auth():
     """ Check any HTTP Authorization header before a request.
 
     This function sets the g.user object to the logged-in user.
-    if any, or to None.
+    if any, or to None, and g.auth_method to how the user logged in,
+    "token" or "password", or None.
     """
 
     # Default to None
     g.user = None
+    g.auth_method = None
 
     # Look for Authorization header
-    if request.authorization:
+    auth_header = request.headers.get("Authorization", "")
+    auth_method = None
+    if auth_header.startswith("Bearer "):
+        # Load user from signed session token
+        g.user = User.get_by_token(auth_header[7:].strip())
+        auth_method = "token"
+    elif auth_header.startswith("Basic ") and request.authorization:
         # Load user and store it in Flask globals
         g.user = User.get_authenticated(request.authorization.username,
                                         request.authorization.password)
+        auth_method = "password"
+
+    # Only record the method if it logged in a user
+    if g.user is not None:
+        g.auth_method = auth_method
 
 def needs_authentication():
     """ Helper function that returns a WWW_Authenticate response
@@ -136,16 +231,3 @@ def needs_authentication():
     return Response('Authentication failed.', 401,
                     {'WWW-Authenticate': 'Basic realm="%s"'
                                          % APP.config['BASIC_REALM']})
-
-@APP.after_request
-def _run_spawns(res):
-    """ Function run after every request to handle spawns of game objects. """
-    # FIXME come up with something more efficient
-
-    # Iterate over all known game object classes
-    for gameobject in GameObject.__subclasses__():
-        # Run spawn code
-        gameobject.spawn()
-
-    # Return original response unchanged
-    return res
@@ -0,0 +1,223 @@
+"""
+Database engine configuration for the Veripeditus server
+
+This module tunes the SQLAlchemy engine from the DB_* settings: pooling,
+SQLite pragmas, checking connections before use and statement timeouts.
+Profiles bundle settings for common deployments.
+"""
+
+# veripeditus-server - Server component for the Veripeditus game framework
+# Copyright (C) 2016, 2017  Dominik George <nik@naturalnet.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import weakref
+
+import flask_sqlalchemy
+from flask_sqlalchemy import SQLAlchemy
+import sqlalchemy
+from sqlalchemy import event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+# Versions as tuples of numbers, like (1, 1)
+_SA_VERSION = tuple(int(part) for part in sqlalchemy.__version__.split(".")[:2])
+_FSA_VERSION = tuple(int(part) for part in flask_sqlalchemy.__version__.split(".")[:2])
+
+# Settings for common deployments, selected by DB_PROFILE; settings in
+# the configuration files take precedence
+PROFILES = {
+    # Several worker processes sharing one SQLite file on a small install:
+    # readers do not block the writer, and writers wait for each other
+    # instead of failing with "database is locked"
+    "sqlite-workers": {
+        'DB_POOL_SIZE': 2,
+        'DB_MAX_OVERFLOW': 4,
+        'DB_POOL_TIMEOUT': 30,
+        'DB_SQLITE_JOURNAL_MODE': "WAL",
+        'DB_SQLITE_SYNCHRONOUS': "NORMAL",
+        'DB_SQLITE_BUSY_TIMEOUT': 30,
+    },
+    # Several worker processes with a PostgreSQL server: a few pooled
+    # connections per worker, dropped when stale, and no statement
+    # running long enough to hold up the other workers
+    "postgresql-workers": {
+        'DB_POOL_SIZE': 5,
+        'DB_MAX_OVERFLOW': 10,
+        'DB_POOL_TIMEOUT': 10,
+        'DB_POOL_RECYCLE': 1800,
+        'DB_POOL_PRE_PING': True,
+        'DB_STATEMENT_TIMEOUT': 30,
+    },
+}
+
+# Engine options set from DB_* settings of the pool
+_POOL_OPTIONS = {
+    'pool_size': 'DB_POOL_SIZE',
+    'max_overflow': 'DB_MAX_OVERFLOW',
+    'pool_timeout': 'DB_POOL_TIMEOUT',
+    'pool_recycle': 'DB_POOL_RECYCLE',
+}
+
+def get_engine_options(config):
+    """ Get the options for creating the engine of the database URI
+    following the DB_* settings.
+    """
+
+    info = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    options = {}
+
+    if info.drivername.startswith("sqlite"):
+        # Databases in memory always use a single connection, and SQLite
+        # files are only pooled if a pool size is set
+        if info.database in (None, "", ":memory:") or not config['DB_POOL_SIZE']:
+            return options
+
+        # Reuse connections to SQLite files, passed between threads by
+        # the pool, instead of opening one per request
+        options['poolclass'] = QueuePool
+        options['connect_args'] = {'check_same_thread': False}
+
+    # Pool settings that are not set keep the defaults
+    for option, key in _POOL_OPTIONS.items():
+        if config[key] is not None:
+            options[option] = config[key]
+
+    # Check pooled connections before use, which SQLAlchemy 1.2 and
+    # later can do by itself
+    if config['DB_POOL_PRE_PING'] and _SA_VERSION >= (1, 2):
+        options['pool_pre_ping'] = True
+
+    return options
+
+def get_database_now(session):
+    """ Get the current time of the database for comparing with the
+    timestamps it set.
+
+    The timestamp columns hold the local time of the database session
+    without a time zone, so the time zone some databases return for
+    now() is dropped.
+    """
+
+    now = session.query(sqlalchemy.func.now()).scalar()
+    if now.tzinfo is not None:
+        now = now.replace(tzinfo=None)
+    return now
+
+def configure_engine(engine, config):
+    """ Register the event handlers applying the DB_* settings to an engine.
+
+    Must be called before the engine connects for the first time.
+    """
+
+    if engine.dialect.name == "sqlite":
+        @event.listens_for(engine, "connect")
+        def _set_sqlite_pragmas(dbapi_connection, connection_record): # pylint: disable=unused-variable,unused-argument
+            """ Set pragmas on every new SQLite connection. """
+
+            cursor = dbapi_connection.cursor()
+            if config['DB_SQLITE_BUSY_TIMEOUT'] is not None:
+                cursor.execute("PRAGMA busy_timeout = %i" % (config['DB_SQLITE_BUSY_TIMEOUT'] * 1000))
+            if config['DB_SQLITE_JOURNAL_MODE'] is not None:
+                cursor.execute("PRAGMA journal_mode = %s" % config['DB_SQLITE_JOURNAL_MODE'])
+            if config['DB_SQLITE_SYNCHRONOUS'] is not None:
+                cursor.execute("PRAGMA synchronous = %s" % config['DB_SQLITE_SYNCHRONOUS'])
+            cursor.close()
+    elif engine.dialect.name == "postgresql" and config['DB_STATEMENT_TIMEOUT'] is not None:
+        @event.listens_for(engine, "connect")
+        def _set_statement_timeout(dbapi_connection, connection_record): # pylint: disable=unused-variable,unused-argument
+            """ Limit the run time of statements on every new connection. """
+
+            cursor = dbapi_connection.cursor()
+            cursor.execute("SET statement_timeout = %i" % (config['DB_STATEMENT_TIMEOUT'] * 1000))
+            cursor.close()
+            dbapi_connection.commit()
+
+    if config['DB_POOL_PRE_PING'] and _SA_VERSION < (1, 2):
+        @event.listens_for(engine, "engine_connect")
+        def _ping_connection(connection, branch): # pylint: disable=unused-variable
+            """ Check a pooled connection before use, and reconnect if it
+            was closed by the server in the meantime, like pool_pre_ping
+            does in later versions of SQLAlchemy.
+            """
+
+            # Sub-connections share the checked connection
+            if branch:
+                return
+
+            # Do not run the ping inside a transaction
+            save_should_close_with_result = connection.should_close_with_result
+            connection.should_close_with_result = False
+            try:
+                connection.scalar("SELECT 1")
+            except exc.DBAPIError as err:
+                if not err.connection_invalidated:
+                    raise
+                # The pool was invalidated, so this reconnects
+                connection.scalar("SELECT 1")
+            finally:
+                connection.should_close_with_result = save_should_close_with_result
+
+class ConfiguredSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy extension creating engines according to the
+    DB_* settings of the application.
+
+    The engine options are passed on in SQLALCHEMY_ENGINE_OPTIONS, where
+    options set in the configuration take precedence.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # Engines that already got their event handlers, if engines are
+        # only available through get_engine
+        self._configured_engines = weakref.WeakSet()
+        super().__init__(*args, **kwargs)
+
+    def init_app(self, app):
+        options = get_engine_options(app.config)
+        options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+        super().init_app(app)
+
+    if _FSA_VERSION < (2, 4):
+        def apply_driver_hacks(self, app, info, options):
+            """ Apply SQLALCHEMY_ENGINE_OPTIONS, which Flask-SQLAlchemy
+            only supports from version 2.4 on.
+            """
+
+            super().apply_driver_hacks(app, info, options)
+            options.update(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+
+    # Register the event handlers when an engine is created, in the way
+    # the installed version of Flask-SQLAlchemy creates engines
+    if _FSA_VERSION >= (3, 0):
+        def _make_engine(self, bind_key, options, app):
+            engine = super()._make_engine(bind_key, options, app)
+            configure_engine(engine, app.config)
+            return engine
+    elif _FSA_VERSION >= (2, 4):
+        def create_engine(self, sa_url, engine_opts):
+            engine = super().create_engine(sa_url, engine_opts)
+            configure_engine(engine, self.get_app().config)
+            return engine
+    else:
+        def get_engine(self, app=None, bind=None):
+            engine = super().get_engine(app, bind)
+
+            # Engines are created in get_engine and reused on later calls
+            if engine not in self._configured_engines:
+                configure_engine(engine, self.get_app(app).config)
+                self._configured_engines.add(engine)
+
+            return engine
@@ -23,17 +23,23 @@ server core.
 
 # pragma pylint: disable=too-few-public-methods
 
+from datetime import datetime
+
 from flask import g, redirect
 from flask_restless import url_for
+from sqlalchemy import event
 from sqlalchemy_utils import PasswordType, force_auto_coercion
 
 from veripeditus.server.app import APP, DB
-from veripeditus.server.auth import Roles
-from veripeditus.server.util import api_method, get_game_by_name
+from veripeditus.server.auth import CredentialCache, create_token, get_password_fingerprint, load_token
+from veripeditus.server.util import api_method, get_game_by_name, get_game_constants
 
 # Activiate auto coercion of data types
 force_auto_coercion()
 
+# Cache of verified credentials, to avoid slow password hashing on every request
+_CREDENTIAL_CACHE = CredentialCache(APP.config['AUTH_CACHE_SIZE'], APP.config['AUTH_CACHE_TTL'])
+
 class Base(DB.Model):
     """ Base class for all models in Veripeditus. """
 
@@ -77,17 +83,61 @@ class User(Base):
         or None otherwise.
         """
 
+        # Look for recently verified credentials first
+        cached = _CREDENTIAL_CACHE.get(username, password)
+        if cached is not None:
+            user = User.query.get(cached[0])
+
+            # Only use the cache if the password was not changed since
+            if user and get_password_fingerprint(user.password) == cached[1]:
+                return user
+
         # Filter for username first
         user = User.query.filter_by(username=username).first()
 
         # Compare password if a user was found
         if user and user.password == password:
+            # Remember verified credentials
+            _CREDENTIAL_CACHE.put(username, password, user.id,
+                                  get_password_fingerprint(user.password))
+
             # Return found user
             return user
         else:
             # Fallback to None
             return None
 
+    @staticmethod
+    def get_by_token(token):
+        """ Return a User object if the session token is valid,
+        or None otherwise.
+        """
+
+        # Verify signature and age of token
+        loaded = load_token(APP.config['SECRET_KEY'], token,
+                            APP.config['AUTH_TOKEN_MAX_AGE'])
+        if loaded is None:
+            return None
+
+        # Tokens are invalidated by changing the password
+        user = User.query.get(loaded[0])
+        if user and get_password_fingerprint(user.password) == loaded[1]:
+            return user
+        else:
+            return None
+
+    def create_token(self):
+        """ Create a signed session token for this user. """
+
+        return create_token(APP.config['SECRET_KEY'], self.id,
+                            get_password_fingerprint(self.password))
+
+@event.listens_for(User.password, "set")
+def _invalidate_credentials(target, value, oldvalue, initiator): # pylint: disable=unused-argument
+    """ Remove cached credentials of a user when the password is changed. """
+
+    _CREDENTIAL_CACHE.invalidate(target.username)
+
 class Game(Base):
     """ A game known to the server.
 
@@ -119,6 +169,12 @@ class Game(Base):
         # Determine the game module from the package name
         return get_game_by_name(self.package)
 
+    @property
+    def constants(self):
+        """ Dictionary of the constants defined in the game module. """
+
+        return get_game_constants(self.package)
+
     @api_method(authenticated=True)
     def world_create(self, name=None):
         """ Create a world with this game.
@@ -149,6 +205,9 @@ class World(Base):
     name = DB.Column(DB.String(32), unique=True, nullable=False)
     # Whether this world is enabled or not
     enabled = DB.Column(DB.Boolean(), default=True, nullable=False)
+    # Time of the last request to spawn game objects soon, read by the
+    # spawn scheduler in whatever process it runs
+    spawn_requested = DB.Column(DB.DateTime())
 
     # Relationship to the game played in this world
     game_id = DB.Column(DB.Integer, DB.ForeignKey('game.id'))
@@ -181,8 +240,17 @@ class World(Base):
         # Update current_player
         g.user.current_player = player
         DB.session.add(g.user)
+
+        # Spawn game objects around the new player soon, also if the
+        # scheduler runs in a separate veripeditus-spawner process
+        self.spawn_requested = datetime.utcnow()
         DB.session.commit()
 
+        # Wake up a scheduler thread in this process, if any
+        # pragma pylint: disable=cyclic-import
+        from veripeditus.server.spawn import SCHEDULER
+        SCHEDULER.trigger(self.id)
+
         # Redirect to new player object
         return redirect(url_for(player.__class__, resource_id=player.id))
         return redirect("/api/gameobject_player/%i" % player.id)
@@ -0,0 +1,527 @@
+"""
+OpenStreetMap data handling for the Veripeditus server
+
+This module contains the switch and cache for the Overpass API used by
+OSMAlchemy and the bulk import of OSM extracts into the OSMAlchemy tables.
+"""
+
+# veripeditus-server - Server component for the Veripeditus game framework
+# Copyright (C) 2016, 2017  Dominik George <nik@naturalnet.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bz2
+from datetime import datetime
+import gzip
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from xml.etree import ElementTree
+
+from sqlalchemy import bindparam, event, text
+
+from veripeditus.server.app import APP, DB, OA
+from veripeditus.server.util import select_columns
+
+_LOGGER = logging.getLogger(__name__)
+
+# Empty answer to Overpass queries while Overpass is switched off
+_EMPTY_OSM = '<?xml version="1.0" encoding="UTF-8"?><osm version="0.6"></osm>'
+# Query time recorded for queries that were not run online
+_NEVER = datetime(1970, 1, 1)
+
+class OverpassCache(object):
+    """ Persistent cache of Overpass responses in an SQLite file.
+
+    The file can be shared by all worker processes on a host. Responses
+    are kept for ttl seconds, and the least recently used ones are
+    evicted once the responses take more than max_size bytes.
+
+    To not flood the upstream server, only one process fetches a missing
+    response while the others wait for it, and requests to the upstream
+    server are spaced by at least interval seconds across all processes.
+
+    Responses are keyed by the exact query, not by tile. Spawn points are
+    built per block of adjacent tiles, so a response is only reused for
+    the same block, e.g. when several processes build the same missing
+    tiles at once, not for an overlapping or partial area.
+    """
+
+    def __init__(self, path, ttl, max_size, interval=0.0, timeout=30.0):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.interval = interval
+        self.timeout = timeout
+
+        # SQLite connections must not be shared between threads
+        self._local = threading.local()
+
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS response (key TEXT PRIMARY KEY, "
+                         "response TEXT, size INTEGER, created REAL, accessed REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_response_accessed ON response (accessed)")
+            conn.execute("CREATE TABLE IF NOT EXISTS lease (key TEXT PRIMARY KEY, expires REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS throttle (id INTEGER PRIMARY KEY, next REAL)")
+
+    def _connect(self):
+        """ Get the connection of the current thread. """
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def get_key(query, *args, **kwargs):
+        """ Get the cache key for a query and its options. """
+
+        return hashlib.sha1(repr((query, args, sorted(kwargs.items()))).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """ Get a cached response, or None if it is unknown or expired. """
+
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT response FROM response WHERE key = ? AND created > ?",
+                               (key, now - self.ttl)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE response SET accessed = ? WHERE key = ?", (now, key))
+        return None if row is None else row[0]
+
+    def put(self, key, response):
+        """ Store a response and evict old ones if the cache is too large. """
+
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?)",
+                         (key, response, len(response), now, now))
+
+            # Evict expired responses, then least recently used ones
+            conn.execute("DELETE FROM response WHERE created <= ?", (now - self.ttl,))
+            excess = (conn.execute("SELECT SUM(size) FROM response").fetchone()[0] or 0) - self.max_size
+            if excess > 0:
+                for old_key, size in conn.execute(
+                        "SELECT key, size FROM response ORDER BY accessed").fetchall():
+                    conn.execute("DELETE FROM response WHERE key = ?", (old_key,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+
+    def acquire(self, key):
+        """ Try to become the process fetching a response.
+
+        Returns True if no other process is fetching it right now.
+        """
+
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM lease WHERE expires < ?", (now,))
+            cursor = conn.execute("INSERT OR IGNORE INTO lease VALUES (?, ?)",
+                                  (key, now + self.timeout))
+            return cursor.rowcount == 1
+
+    def release(self, key):
+        """ Allow other processes to fetch a response again. """
+
+        with self._connect() as conn:
+            conn.execute("DELETE FROM lease WHERE key = ?", (key,))
+
+    def wait_for_slot(self):
+        """ Wait until the next request to the upstream server is allowed. """
+
+        if not self.interval:
+            return
+
+        # Reserve the next free slot in one transaction
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT next FROM throttle WHERE id = 1").fetchone()
+            slot = max(time.time(), row[0] if row else 0.0)
+            conn.execute("INSERT OR REPLACE INTO throttle VALUES (1, ?)", (slot + self.interval,))
+
+        time.sleep(max(slot - time.time(), 0.0))
+
+class OverpassSwitch(object):
+    """ Wrapper around the Overpass API object used by OSMAlchemy.
+
+    Queries are only passed on if OSM_OVERPASS is enabled in the
+    configuration, which is checked on every query so it can be
+    changed at runtime. Otherwise, an empty result is returned and
+    only data already in the database is used. Queries answered that
+    way are not recorded as run by OSMAlchemy, so they are run online
+    as soon as Overpass is enabled again.
+
+    If OSM_OVERPASS_CACHE is set to the path of a file, responses are
+    cached there.
+    """
+
+    def __init__(self, api, app=APP):
+        self.api = api
+        self.app = app
+
+        self._cache = None
+
+    def get_cache(self):
+        """ Get the response cache, or None if it is disabled. """
+
+        path = self.app.config['OSM_OVERPASS_CACHE']
+        if not path:
+            return None
+
+        # Open cache on first use, or if it was reconfigured
+        if self._cache is None or self._cache.path != path:
+            self._cache = OverpassCache(path, self.app.config['OSM_OVERPASS_CACHE_TTL'],
+                                        self.app.config['OSM_OVERPASS_CACHE_SIZE'],
+                                        self.app.config['OSM_OVERPASS_INTERVAL'])
+        return self._cache
+
+    def Get(self, query, *args, **kwargs): # pylint: disable=invalid-name
+        """ Run an Overpass query, if enabled. """
+
+        if not self.app.config['OSM_OVERPASS']:
+            return _EMPTY_OSM
+
+        cache = self.get_cache()
+        if cache is None:
+            return self.api.Get(query, *args, **kwargs)
+
+        key = cache.get_key(query, *args, **kwargs)
+        deadline = time.time() + cache.timeout
+        while True:
+            response = cache.get(key)
+            if response is not None:
+                return response
+
+            # Fetch if no other process does, otherwise wait for its result
+            if cache.acquire(key):
+                break
+            elif time.time() > deadline:
+                return self.api.Get(query, *args, **kwargs)
+            time.sleep(0.1)
+
+        try:
+            cache.wait_for_slot()
+            response = self.api.Get(query, *args, **kwargs)
+            cache.put(key, response)
+        finally:
+            cache.release(key)
+
+        return response
+
+@event.listens_for(OA.cached_query.oql_queried, "set", retval=True)
+def _keep_offline_query_stale(target, value, oldvalue, initiator): # pylint: disable=unused-argument
+    """ Record queries answered while Overpass is switched off as never run. """
+
+    if not APP.config['OSM_OVERPASS']:
+        return _NEVER
+    return value
+
+def _chunks(values, size=500):
+    """ Split a list into chunks, to keep IN lists within database limits. """
+
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+class OSMImporter(object):
+    """ Bulk importer for OSM elements into the OSMAlchemy tables.
+
+    Elements are collected in batches and written with one multi-row
+    insert per table, so memory use only depends on the batch size.
+    Elements already in the database are replaced.
+
+    Primary keys are allocated by the importer, so no other process
+    may write OSM data while an import is running.
+    """
+
+    def __init__(self, batch_size=10000):
+        self.batch_size = batch_size
+
+        # Tables of the OSMAlchemy model
+        tables = DB.metadata.tables
+        self._elements = OA.element.__table__
+        self._nodes = OA.node.__table__
+        self._ways = OA.way.__table__
+        self._tags = OA.tag.__table__
+        self._elements_tags = tables[OA.prefix + "elements_tags"]
+        self._ways_nodes = tables[OA.prefix + "ways_nodes"]
+
+        # Next free primary keys per table
+        self._next_ids = {}
+        for table, column in ((self._elements, "element_id"), (self._tags, "tag_id"),
+                              (self._elements_tags, "map_id"), (self._ways_nodes, "map_id")):
+            last = DB.session.query(DB.func.max(table.c[column])).scalar()
+            self._next_ids[table] = (last or 0) + 1
+
+        # Pending elements by type, like [(osm_id, attrs, tags, extra), …]
+        self._pending = {"node": [], "way": []}
+        self.counts = {"node": 0, "way": 0}
+
+    def _allocate(self, table, number):
+        """ Allocate a number of primary keys for a table. """
+
+        first = self._next_ids[table]
+        self._next_ids[table] = first + number
+        return range(first, first + number)
+
+    def add_node(self, osm_id, latitude, longitude, tags, attrs):
+        """ Add a node to the current batch. """
+
+        self._pending["node"].append((osm_id, attrs, tags, (latitude, longitude)))
+        if len(self._pending["node"]) >= self.batch_size:
+            self.flush()
+
+    def add_way(self, osm_id, node_refs, tags, attrs):
+        """ Add a way with the OSM ids of its nodes to the current batch. """
+
+        # Ways refer to nodes, which must be written first
+        if self._pending["node"]:
+            self.flush()
+
+        self._pending["way"].append((osm_id, attrs, tags, node_refs))
+        if len(self._pending["way"]) >= self.batch_size:
+            self.flush()
+
+    def _get_element_ids(self, type_, osm_ids):
+        """ Map OSM ids of elements of a type to their primary keys. """
+
+        element_ids = {}
+        for chunk in _chunks(set(osm_ids)):
+            element_ids.update(DB.session.execute(
+                select_columns([self._elements.c.id, self._elements.c.element_id]).where(
+                    (self._elements.c.type == type_) & self._elements.c.id.in_(chunk))).fetchall())
+        return element_ids
+
+    def _clear_elements(self, element_ids):
+        """ Delete the tags of elements and the node lists of ways. """
+
+        for chunk in _chunks(element_ids):
+            tag_ids = [row[0] for row in DB.session.execute(
+                select_columns([self._elements_tags.c.tag_id]).where(
+                    self._elements_tags.c.element_id.in_(chunk)))]
+            DB.session.execute(self._elements_tags.delete().where(
+                self._elements_tags.c.element_id.in_(chunk)))
+            for tag_chunk in _chunks(tag_ids):
+                DB.session.execute(self._tags.delete().where(self._tags.c.tag_id.in_(tag_chunk)))
+            DB.session.execute(self._ways_nodes.delete().where(
+                self._ways_nodes.c.way_id.in_(chunk)))
+
+    @staticmethod
+    def _write_rows(table, rows, known):
+        """ Insert rows of elements, or update the rows of known elements. """
+
+        new_rows = [row for row in rows if row["element_id"] not in known]
+        if new_rows:
+            DB.session.execute(table.insert(), new_rows)
+
+        # Rows of known elements are kept, as ways that are not part of
+        # the import may still refer to their nodes
+        old_rows = [{("_element_id" if key == "element_id" else key): value
+                     for key, value in row.items()}
+                    for row in rows if row["element_id"] in known]
+        if old_rows:
+            DB.session.execute(table.update().where(
+                table.c.element_id == bindparam("_element_id")), old_rows)
+
+    def _write(self, type_, elements):
+        """ Write a batch of elements of one type. """
+
+        now = datetime.now()
+
+        # Replace elements that are already known, keeping their primary keys
+        # so references from ways and relations stay intact
+        existing = self._get_element_ids(type_, [element[0] for element in elements])
+        known = set(existing.values())
+        if existing:
+            self._clear_elements(list(known))
+        new_ids = iter(self._allocate(self._elements, len(elements) - len(existing)))
+        element_ids = [existing[osm_id] if osm_id in existing else next(new_ids)
+                       for osm_id, _, _, _ in elements]
+        self._write_rows(self._elements, [
+            dict(attrs, element_id=element_id, type=type_, id=osm_id)
+            for element_id, (osm_id, attrs, _, _) in zip(element_ids, elements)], known)
+
+        # Tags, one tag row per element and key like OSMAlchemy does
+        pairs = [(element_id, key, value)
+                 for element_id, (_, _, tags, _) in zip(element_ids, elements)
+                 for key, value in tags.items()]
+        if pairs:
+            tag_ids = self._allocate(self._tags, len(pairs))
+            map_ids = self._allocate(self._elements_tags, len(pairs))
+            DB.session.execute(self._tags.insert(), [
+                {"tag_id": tag_id, "key": key, "value": value}
+                for tag_id, (_, key, value) in zip(tag_ids, pairs)])
+            DB.session.execute(self._elements_tags.insert(), [
+                {"map_id": map_id, "element_id": element_id, "tag_id": tag_id}
+                for map_id, tag_id, (element_id, _, _) in zip(map_ids, tag_ids, pairs)])
+
+        if type_ == "node":
+            self._write_rows(self._nodes, [
+                {"element_id": element_id, "latitude": latlon[0], "longitude": latlon[1],
+                 "osmalchemy_updated": now}
+                for element_id, (_, _, _, latlon) in zip(element_ids, elements)], known)
+        elif type_ == "way":
+            self._write_rows(self._ways, [
+                {"element_id": element_id, "osmalchemy_updated": now}
+                for element_id in element_ids], known)
+
+            # Link nodes, skipping nodes that are not in the database
+            node_ids = self._get_element_ids("node", [ref for element in elements
+                                                      for ref in element[3]])
+            links = [(element_id, position, node_ids[ref])
+                     for element_id, (_, _, _, refs) in zip(element_ids, elements)
+                     for position, ref in enumerate(refs) if ref in node_ids]
+            if links:
+                map_ids = self._allocate(self._ways_nodes, len(links))
+                DB.session.execute(self._ways_nodes.insert(), [
+                    {"map_id": map_id, "way_id": way_id, "node_id": node_id, "position": position}
+                    for map_id, (way_id, position, node_id) in zip(map_ids, links)])
+
+        self.counts[type_] += len(elements)
+
+    def flush(self):
+        """ Write and commit all pending elements. """
+
+        for type_ in ("node", "way"):
+            if self._pending[type_]:
+                self._write(type_, self._pending[type_])
+                self._pending[type_] = []
+        DB.session.commit()
+
+    def finish(self):
+        """ Write remaining elements and update dependent data. """
+
+        self.flush()
+
+        # Keep sequences in sync with the allocated primary keys
+        if DB.engine.dialect.name == "postgresql":
+            for table, column in ((self._elements, "element_id"), (self._tags, "tag_id"),
+                                  (self._elements_tags, "map_id"), (self._ways_nodes, "map_id")):
+                DB.session.execute(text("SELECT setval(pg_get_serial_sequence('%s', '%s'), %i)" % (
+                    table.name, column, self._next_ids[table] - 1)))
+            DB.session.commit()
+
+        # Spawn points need to be built from the new data
+        from veripeditus.framework.model import SpawnPoint
+        SpawnPoint.invalidate()
+
+def _parse_attrs(attrib):
+    """ Get the metadata of an element from its XML or PBF attributes.
+
+    All keys are always set, as rows of one insert need the same columns.
+    """
+
+    attrs = dict.fromkeys(("version", "changeset", "uid", "user", "visible", "timestamp"))
+    for key in ("version", "changeset", "uid"):
+        if attrib.get(key) is not None:
+            attrs[key] = int(attrib[key])
+    if attrib.get("user") is not None:
+        attrs["user"] = attrib["user"]
+    if attrib.get("visible") is not None:
+        attrs["visible"] = attrib["visible"] in ("true", True)
+    if attrib.get("timestamp") is not None:
+        timestamp = attrib["timestamp"]
+        if isinstance(timestamp, str):
+            timestamp = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")
+        attrs["timestamp"] = timestamp
+    return attrs
+
+def _import_osm_xml(fileobj, importer):
+    """ Stream elements from an OSM XML file into an importer. """
+
+    context = ElementTree.iterparse(fileobj, events=("start", "end"))
+    root = None
+
+    for kind, elem in context:
+        if kind == "start":
+            if root is None:
+                root = elem
+            continue
+
+        if elem.tag == "node":
+            tags = {tag.get("k"): tag.get("v") for tag in elem.iter("tag")}
+            importer.add_node(int(elem.get("id")), float(elem.get("lat")), float(elem.get("lon")),
+                              tags, _parse_attrs(elem.attrib))
+        elif elem.tag == "way":
+            tags = {tag.get("k"): tag.get("v") for tag in elem.iter("tag")}
+            refs = [int(nd.get("ref")) for nd in elem.iter("nd")]
+            importer.add_way(int(elem.get("id")), refs, tags, _parse_attrs(elem.attrib))
+        elif elem.tag == "relation":
+            # FIXME support relations
+            pass
+        else:
+            continue
+
+        # Drop parsed elements, so memory use stays constant
+        root.clear()
+
+def _import_osm_pbf(path, importer): # pragma: no cover
+    """ Stream elements from an OSM PBF file into an importer.
+
+    Needs the osmium module.
+    """
+
+    import osmium
+
+    class _Handler(osmium.SimpleHandler):
+        def _attrs(self, obj):
+            return _parse_attrs({"version": obj.version, "changeset": obj.changeset,
+                                 "uid": obj.uid, "user": obj.user, "visible": obj.visible,
+                                 "timestamp": obj.timestamp.replace(tzinfo=None)})
+
+        def node(self, obj):
+            importer.add_node(obj.id, obj.location.lat, obj.location.lon,
+                              {tag.k: tag.v for tag in obj.tags}, self._attrs(obj))
+
+        def way(self, obj):
+            importer.add_way(obj.id, [nd.ref for nd in obj.nodes],
+                             {tag.k: tag.v for tag in obj.tags}, self._attrs(obj))
+
+    _Handler().apply_file(path)
+
+def import_osm_file(path, batch_size=10000):
+    """ Import an OSM extract into the OSMAlchemy tables.
+
+    Supports OSM XML (.osm, also compressed as .osm.gz or .osm.bz2)
+    and, if the osmium module is installed, PBF (.osm.pbf).
+
+    Returns a dictionary with the number of imported elements per type.
+    """
+
+    importer = OSMImporter(batch_size)
+
+    if path.endswith(".pbf"):
+        _import_osm_pbf(path, importer)
+    else:
+        if path.endswith(".gz"):
+            fileobj = gzip.open(path, "rb")
+        elif path.endswith(".bz2"):
+            fileobj = bz2.open(path, "rb")
+        else:
+            fileobj = open(path, "rb")
+
+        with fileobj:
+            _import_osm_xml(fileobj, importer)
+
+    importer.finish()
+    _LOGGER.info("Imported %i nodes and %i ways from %s.", importer.counts["node"],
+                 importer.counts["way"], path)
+
+    return importer.counts
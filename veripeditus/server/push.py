@@ -0,0 +1,457 @@
+"""
+Push channel for world events in the Veripeditus server
+
+This module contains a small WebSocket server, running on asyncio
+next to the Flask application. Clients subscribe to a viewport in a
+world and get game object events pushed instead of polling for them.
+They can also send position updates over the same connection.
+"""
+
+# veripeditus-server - Server component for the Veripeditus game framework
+# Copyright (C) 2016, 2017  Dominik George <nik@naturalnet.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import hashlib
+import json
+import logging
+import math
+import struct
+from urllib.parse import parse_qs, urlparse
+
+from flask import g
+
+from veripeditus.framework.distance import get_bbox_mask, get_coordinates
+from veripeditus.framework.model import GameObject, GameObjectTombstone, Item
+from veripeditus.server.app import DB
+from veripeditus.server.db import get_database_now
+from veripeditus.server.model import User
+from veripeditus.server.rest import _serialize_gameobject
+
+_LOGGER = logging.getLogger(__name__)
+
+# Magic value for the WebSocket handshake from RFC 6455
+_WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# WebSocket frame opcodes
+_OP_CONTINUATION = 0x0
+_OP_TEXT = 0x1
+_OP_CLOSE = 0x8
+_OP_PING = 0x9
+_OP_PONG = 0xA
+
+# Maximum size of a message accepted from clients
+_MAX_MESSAGE_SIZE = 65536
+
+# Seconds to wait for a client to take pushed messages before dropping it
+_SEND_TIMEOUT = 10
+
+class WebSocketError(Exception):
+    """ Raised if a client violates the WebSocket protocol. """
+
+    pass
+
+class WebSocket(object):
+    """ Minimal server side of a WebSocket connection (RFC 6455).
+
+    Only supports unfragmented sending of text messages, which is
+    all the push channel needs.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+        # Whether the handshake completed, so WebSocket frames can be sent
+        self.open = False
+
+    async def handshake(self):
+        """ Read the HTTP upgrade request and accept it.
+
+        Returns the request path, including the query string.
+        """
+
+        # Read request line and headers
+        request = await self.reader.readuntil(b"\r\n\r\n")
+        lines = request.decode("latin-1").split("\r\n")
+        method, path, _ = lines[0].split(" ", 2)
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+
+        if method != "GET" or headers.get("upgrade", "").lower() != "websocket" \
+                or "sec-websocket-key" not in headers:
+            self.writer.write(b"HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n")
+            raise WebSocketError("Not a WebSocket upgrade request.")
+
+        # Calculate accept key and switch protocols
+        accept = base64.b64encode(hashlib.sha1(
+            (headers["sec-websocket-key"] + _WS_GUID).encode("ascii")).digest())
+        self.writer.write(b"HTTP/1.1 101 Switching Protocols\r\n"
+                          b"Upgrade: websocket\r\nConnection: Upgrade\r\n"
+                          b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+        self.open = True
+
+        return path
+
+    def _send_frame(self, opcode, payload):
+        """ Send a single, final frame. Server frames are not masked. """
+
+        header = bytes([0x80 | opcode])
+        if len(payload) < 126:
+            header += bytes([len(payload)])
+        elif len(payload) < 65536:
+            header += bytes([126]) + struct.pack("!H", len(payload))
+        else:
+            header += bytes([127]) + struct.pack("!Q", len(payload))
+        self.writer.write(header + payload)
+
+    async def send(self, *messages):
+        """ Send text messages, and wait until the client took them, so
+        data for slow clients does not pile up in the buffer.
+        """
+
+        for message in messages:
+            self._send_frame(_OP_TEXT, message.encode("utf-8"))
+        await self.writer.drain()
+
+    def close(self):
+        """ Send a close frame, if the handshake completed, and close the
+        connection.
+        """
+
+        try:
+            if self.open:
+                self._send_frame(_OP_CLOSE, b"")
+        finally:
+            self.open = False
+            self.writer.close()
+
+    async def _read_frame(self):
+        """ Read a frame and return a tuple like (fin, opcode, payload). """
+
+        head = await self.reader.readexactly(2)
+        fin, opcode = head[0] & 0x80, head[0] & 0x0F
+        masked, length = head[1] & 0x80, head[1] & 0x7F
+
+        if length == 126:
+            length = struct.unpack("!H", await self.reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", await self.reader.readexactly(8))[0]
+        if length > _MAX_MESSAGE_SIZE:
+            raise WebSocketError("Message too large.")
+
+        # Client frames must be masked
+        if not masked:
+            raise WebSocketError("Unmasked client frame.")
+        mask = await self.reader.readexactly(4)
+        payload = await self.reader.readexactly(length)
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+        return fin, opcode, payload
+
+    async def receive(self):
+        """ Receive a text message, or None if the connection was closed. """
+
+        message = b""
+        while True:
+            fin, opcode, payload = await self._read_frame()
+
+            if opcode == _OP_CLOSE:
+                return None
+            elif opcode == _OP_PING:
+                self._send_frame(_OP_PONG, payload)
+            elif opcode in (_OP_TEXT, _OP_CONTINUATION):
+                message += payload
+                if len(message) > _MAX_MESSAGE_SIZE:
+                    raise WebSocketError("Message too large.")
+                if fin:
+                    return message.decode("utf-8")
+
+class _Subscriber(object):
+    """ State of one connected client. """
+
+    def __init__(self, websocket, user_id):
+        self.websocket = websocket
+        self.user_id = user_id
+
+        # Viewport subscribed to, set by the client
+        self.world_id = None
+        self.bbox = None
+
+        # Ids of game objects pushed to the client and not removed since
+        self.known = set()
+
+def _parse_numbers(values, count):
+    """ Parse a list of exactly count finite numbers from a message. """
+
+    numbers = [float(x) for x in values]
+    if len(numbers) != count or not all(math.isfinite(x) for x in numbers):
+        raise ValueError("Expected %i finite numbers." % count)
+    return numbers
+
+class PushServer(object):
+    """ WebSocket server pushing game object events of worlds to clients.
+
+    Changes are found by polling the database once per PUSH_INTERVAL for
+    every world that has subscribers, no matter how many there are. The
+    database is only used from one worker thread, the connections are
+    handled on the asyncio event loop.
+
+    Clients connect with ?token=<session token> and send JSON messages:
+
+     {"subscribe": {"world": <id>, "bbox": [lat_min, lon_min, lat_max, lon_max]}}
+     {"position": [lat, lon]}
+
+    They receive JSON messages like {"event": "spawn", "gameobject": {…}},
+    with event being one of spawn, move, remove or collect. Events are only
+    sent for objects the client can see, or was told about before; clients
+    load the full viewport through the REST API after subscribing.
+    """
+
+    def __init__(self, app, loop=None):
+        self.app = app
+        self.loop = loop or asyncio.new_event_loop()
+
+        self._subscribers = set()
+        # Database time of the last poll per world
+        self._cursors = {}
+        # Changes already sent in the last poll per world, like {(id, updated, …), …}
+        self._sent = {}
+
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def _run_in_app(self, func, *args):
+        """ Run a function using the database in the worker thread. """
+
+        def _wrapper():
+            # Game code may build URLs, so provide a request context
+            with self.app.test_request_context():
+                try:
+                    return func(*args)
+                finally:
+                    DB.session.remove()
+
+        return self.loop.run_in_executor(self._executor, _wrapper)
+
+    @staticmethod
+    def _authenticate(token):
+        """ Find the id of the user a session token belongs to. """
+
+        user = User.get_by_token(token)
+        return None if user is None else user.id
+
+    @staticmethod
+    def _update_position(user_id, latitude, longitude):
+        """ Move the current player of a user. """
+
+        g.user = User.query.get(user_id)
+        if g.user is not None and g.user.current_player is not None:
+            g.user.current_player.move_to(latitude, longitude)
+
+    async def handle(self, reader, writer):
+        """ Handle a client connection. """
+
+        websocket = WebSocket(reader, writer)
+        subscriber = None
+
+        try:
+            path = await websocket.handshake()
+
+            # Authenticate with session token
+            token = parse_qs(urlparse(path).query).get("token", [""])[0]
+            user_id = await self._run_in_app(self._authenticate, token)
+            if user_id is None:
+                await websocket.send(json.dumps({"error": "Authentication failed."}))
+                return
+
+            subscriber = _Subscriber(websocket, user_id)
+            self._subscribers.add(subscriber)
+
+            while True:
+                message = await websocket.receive()
+                if message is None:
+                    break
+
+                try:
+                    data = json.loads(message)
+                    if "subscribe" in data:
+                        # Validate everything before changing the subscription
+                        world_id = int(data["subscribe"]["world"])
+                        bbox = _parse_numbers(data["subscribe"]["bbox"], 4)
+                        subscriber.world_id, subscriber.bbox = world_id, bbox
+                    if "position" in data:
+                        latitude, longitude = _parse_numbers(data["position"], 2)
+                        await self._run_in_app(self._update_position, user_id,
+                                               latitude, longitude)
+                except (KeyError, TypeError, ValueError):
+                    await websocket.send(json.dumps({"error": "Invalid message."}))
+        except (asyncio.IncompleteReadError, ConnectionError, WebSocketError, ValueError):
+            pass
+        finally:
+            self._subscribers.discard(subscriber)
+            websocket.close()
+
+    def _poll_world(self, world_id, subscribers):
+        """ Find changes in a world and build the messages for its subscribers.
+
+        Returns a list of (subscriber, message) tuples.
+        """
+
+        # Use database time, as the updated timestamps are set by the database
+        now = get_database_now(DB.session)
+        since = self._cursors.get(world_id, now)
+        self._cursors[world_id] = now
+
+        # Overlap by two seconds, as timestamps may only have second
+        # resolution, and SQLite compares them as text, so a row from
+        # the same second as the bound sorts before it
+        since = since - timedelta(seconds=2)
+
+        changed = GameObject.query.with_polymorphic([Item]).filter(
+            GameObject.world_id == world_id, GameObject.updated >= since).all()
+        tombstones = DB.session.query(GameObjectTombstone.gameobject_id,
+                                      GameObjectTombstone.latitude,
+                                      GameObjectTombstone.longitude).filter(
+                                          GameObjectTombstone.world_id == world_id,
+                                          GameObjectTombstone.created >= since).all()
+
+        # Skip changes already sent in the last poll because of the overlap;
+        # objects can change more than once within the resolution of the
+        # timestamps, so their state is compared as well
+        def _state(gameobject):
+            return (gameobject.id, gameobject.updated, gameobject.latitude,
+                    gameobject.longitude, getattr(gameobject, "owner_id", None))
+        sent = self._sent.get(world_id, set())
+        changed = [go for go in changed if _state(go) not in sent]
+        # Ids can be reused by some databases, so existing objects win
+        alive = {go.id for go in changed}
+        tombstones = [row for row in tombstones
+                      if (row[0], None) not in sent and row[0] not in alive]
+        self._sent[world_id] = {_state(go) for go in changed} | \
+                               {(row[0], None) for row in tombstones}
+
+        latitudes, longitudes = get_coordinates(changed)
+        tombstone_latitudes, tombstone_longitudes = get_coordinates(
+            [(row[1], row[2]) for row in tombstones])
+
+        messages = []
+        for subscriber in subscribers:
+            # Visibility rules depend on the user
+            g.user = User.query.get(subscriber.user_id)
+            if g.user is None:
+                continue
+            player = g.user.current_player
+
+            # Check bounding box and distances for all changed objects at once
+            inside = get_bbox_mask(latitudes, longitudes, *subscriber.bbox)
+            GameObject.prefetch_distances(changed)
+
+            for gameobject, in_bbox in zip(changed, inside):
+                # Only tell about objects in view or known to the client
+                known = gameobject.id in subscriber.known
+                if isinstance(gameobject, Item) and gameobject.owner is not None:
+                    if not (in_bbox or known or gameobject.owner is player):
+                        continue
+                    event = {"event": "collect", "id": str(gameobject.id)}
+                elif in_bbox and (gameobject is player or gameobject.isonmap):
+                    event = {"event": "spawn" if gameobject.created >= since else "move",
+                             "gameobject": _serialize_gameobject(gameobject)}
+                elif in_bbox or known:
+                    # Moved out of view or hidden
+                    event = {"event": "remove", "id": str(gameobject.id)}
+                else:
+                    continue
+
+                if "gameobject" in event:
+                    subscriber.known.add(gameobject.id)
+                else:
+                    subscriber.known.discard(gameobject.id)
+                messages.append((subscriber, json.dumps(event)))
+
+            # Deleted objects, by their last position
+            inside = get_bbox_mask(tombstone_latitudes, tombstone_longitudes, *subscriber.bbox)
+            for (id_, _, _), in_bbox in zip(tombstones, inside):
+                if in_bbox or id_ in subscriber.known:
+                    subscriber.known.discard(id_)
+                    messages.append((subscriber, json.dumps({"event": "remove", "id": str(id_)})))
+
+        return messages
+
+    async def _push(self, subscriber, messages):
+        """ Send messages to a subscriber, and drop it if it does not take
+        them in time.
+        """
+
+        if subscriber not in self._subscribers:
+            return
+
+        try:
+            await asyncio.wait_for(subscriber.websocket.send(*messages), _SEND_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError):
+            self._subscribers.discard(subscriber)
+            subscriber.websocket.close()
+
+    async def poll(self):
+        """ Poll all subscribed worlds for changes and push them. """
+
+        # Group subscribers by world
+        worlds = {}
+        for subscriber in list(self._subscribers):
+            if subscriber.world_id is not None:
+                worlds.setdefault(subscriber.world_id, []).append(subscriber)
+
+        # Forget worlds nobody is interested in anymore
+        for world_id in set(self._cursors) - set(worlds):
+            del self._cursors[world_id]
+            self._sent.pop(world_id, None)
+
+        for world_id, subscribers in worlds.items():
+            messages = await self._run_in_app(self._poll_world, world_id, subscribers)
+
+            # Push to all subscribers concurrently, so slow clients do not
+            # hold up the others
+            grouped = {}
+            for subscriber, message in messages:
+                grouped.setdefault(subscriber, []).append(message)
+            await asyncio.gather(*[self._push(subscriber, grouped[subscriber])
+                                   for subscriber in grouped])
+
+    async def run_polling(self):
+        """ Poll for changes forever. """
+
+        while True:
+            try:
+                await self.poll()
+            except Exception: # pylint: disable=broad-except
+                _LOGGER.exception("Polling for changes failed.")
+            await asyncio.sleep(self.app.config['PUSH_INTERVAL'])
+
+    def serve_forever(self, host, port):
+        """ Start the WebSocket server and run the event loop. """
+
+        asyncio.set_event_loop(self.loop)
+        server = self.loop.run_until_complete(asyncio.start_server(self.handle, host, port))
+        self.loop.create_task(self.run_polling())
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
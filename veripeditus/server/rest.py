@@ -20,15 +20,31 @@ This module contains everything to set up the API.
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from flask import g, make_response, redirect, request
+from datetime import date, datetime, timedelta
+import hashlib
+import json
+import math
+from urllib.parse import urlencode
+
+from flask import abort, g, jsonify, make_response, redirect, request
+from sqlalchemy import and_, or_
 from flask_restless import APIManager, url_for
 from werkzeug.wrappers import Response
 
-from veripeditus.framework.model import GameObject
+from veripeditus.framework.model import GameObject, GameObjectTombstone, Item, MAX_TILE_RANGES
+from veripeditus.framework.util import get_tile_ranges
 from veripeditus.server.app import APP, DB, OA
+from veripeditus.server.auth import Roles
 from veripeditus.server.control import needs_authentication, _check_auth
+from veripeditus.server.db import get_database_now
 from veripeditus.server.model import User, World, Game
-from veripeditus.server.util import guess_mime_type
+from veripeditus.server.util import get_mapped_table, guess_mime_type, select_columns
+
+try:
+    # Use a faster JSON encoder for large responses if available
+    import ujson
+except ImportError:
+    ujson = None
 
 # Columns to include in all endpoints/models
 _INCLUDE = ['id', 'created', 'updated']
@@ -40,9 +56,72 @@ MANAGER = APIManager(APP, flask_sqlalchemy_db=DB)
 OA.create_api(MANAGER)
 
 # Create APIs for server models
-MANAGER.create_api(User, page_size=0, max_page_size=0)
-MANAGER.create_api(Game, page_size=0, max_page_size=0)
-MANAGER.create_api(World, page_size=0, max_page_size=0)
+MANAGER.create_api(User, page_size=APP.config['API_PAGE_SIZE'],
+                   max_page_size=APP.config['API_MAX_PAGE_SIZE'])
+MANAGER.create_api(Game, page_size=APP.config['API_PAGE_SIZE'],
+                   max_page_size=APP.config['API_MAX_PAGE_SIZE'])
+MANAGER.create_api(World, page_size=APP.config['API_PAGE_SIZE'],
+                   max_page_size=APP.config['API_MAX_PAGE_SIZE'])
+
+def _rewrite_viewport_filters(filters):
+    """ Rewrite a list of filters that are combined with AND, so a
+    viewport query can use the index on (world_id, tile).
+
+    Filters on the world relationship by id are replaced by a filter on
+    world_id, and if the filters limit latitude and longitude on both
+    sides, filters on the tiles of that box are added.
+    """
+
+    bounds = {}
+
+    for i, filt in enumerate(filters):
+        if "or" in filt:
+            # Rewrite alternatives separately, and put back the results
+            for j, subfilt in enumerate(filt["or"]):
+                rewritten = [subfilt]
+                _rewrite_viewport_filters(rewritten)
+                filt["or"][j] = rewritten[0] if len(rewritten) == 1 else {"and": rewritten}
+        elif "and" in filt:
+            _rewrite_viewport_filters(filt["and"])
+        elif filt.get("name") == "world" and filt.get("op") == "has":
+            # Compare the foreign key instead of using a subquery
+            val = filt.get("val")
+            if isinstance(val, dict) and val.get("name") == "id" and val.get("op") in ("eq", "=="):
+                filters[i] = {"name": "world_id", "op": "eq", "val": val["val"]}
+        elif filt.get("name") in ("latitude", "longitude"):
+            # Remember bounds of the box
+            if filt.get("op") in ("ge", ">=", "gt", ">"):
+                bounds[(filt["name"], "min")] = filt["val"]
+            elif filt.get("op") in ("le", "<=", "lt", "<"):
+                bounds[(filt["name"], "max")] = filt["val"]
+
+    if len(bounds) == 4:
+        try:
+            box = [float(bounds[key]) for key in (("latitude", "min"), ("longitude", "min"),
+                                                  ("latitude", "max"), ("longitude", "max"))]
+        except (TypeError, ValueError):
+            # Leave invalid values to the normal filter handling
+            return
+
+        # Add tile ranges covering the box
+        ranges = get_tile_ranges(*box, max_ranges=MAX_TILE_RANGES)
+        filters.append({"or": [{"and": [{"name": "tile", "op": "ge", "val": first},
+                                        {"name": "tile", "op": "le", "val": last}]}
+                               for first, last in ranges]})
+
+def _use_tile_index(filters=None, **kwargs): # pylint: disable=unused-argument
+    """ Preprocessor for game object collections rewriting viewport filters. """
+
+    if filters:
+        _rewrite_viewport_filters(filters)
+
+def _apply_visibility(filters=None, **kwargs): # pylint: disable=unused-argument
+    """ Preprocessor for game object collections leaving out objects the
+    current user cannot see, so they are never loaded from the database.
+    """
+
+    if filters is not None:
+        filters.append({"name": "isonmap", "op": "eq", "val": True})
 
 # Create APIs for all GameObjects
 for go in [GameObject] + GameObject.__subclasses__():
@@ -52,7 +131,10 @@ for go in [GameObject] + GameObject.__subclasses__():
         MANAGER.create_api(rgo,
                            additional_attributes=["gameobject_type"],
                            includes=rgo._api_includes,
-                           page_size=0, max_page_size=0)
+                           preprocessors={"GET_COLLECTION": [_use_tile_index,
+                                                             _apply_visibility]},
+                           page_size=APP.config['API_PAGE_SIZE'],
+                           max_page_size=APP.config['API_MAX_PAGE_SIZE'])
 
 @APP.route("/api/v2/<string:type_>/<int:id_>/<string:method>")
 @APP.route("/api/v2/<string:type_>/<int:id_>/<string:method>/<arg>")
@@ -134,6 +216,51 @@ def _get_own_player():
     # Redirect to the current player object
     return redirect(url_for(g.user.current_player.__class__, resource_id=g.user.current_player.id))
 
+@APP.route("/api/v2/gameobject_player/self/positions", methods=["POST"])
+def _post_own_positions():
+    """ Update the position of the own player from a batch of location fixes.
+
+    The body is a JSON object like {"fixes": [{"latitude": …, "longitude": …,
+    "timestamp": …}, …]}. The latest fix becomes the new position, and items
+    are auto-collected along the path of all fixes. Returns the new position
+    and the collected items.
+    """
+
+    # Check if a user is logged in, in the first place
+    if g.user is None:
+        return needs_authentication()
+    if g.user.current_player is None:
+        # FIXME more specific error
+        return ("", 404)
+
+    # Parse fixes and order them by time; fixes without time keep their
+    # place after the fix before them, as the sort is stable
+    try:
+        fixes = request.get_json(force=True)["fixes"]
+        times, last = [], float("-inf")
+        for fix in fixes:
+            if fix.get("timestamp") is not None:
+                last = float(fix["timestamp"])
+                if not math.isfinite(last):
+                    raise ValueError("Timestamp is not a finite number.")
+            times.append(last)
+        path = [(float(fixes[i]["latitude"]), float(fixes[i]["longitude"]))
+                for i in sorted(range(len(fixes)), key=times.__getitem__)]
+        if not all(math.isfinite(x) for point in path for x in point):
+            raise ValueError("Position is not finite.")
+    except (AttributeError, KeyError, TypeError, ValueError):
+        # FIXME more specific error
+        return ("", 400)
+    if not path:
+        return ("", 400)
+
+    # Apply only the latest position, collecting along the way
+    player = g.user.current_player
+    collected = player.move_to(*path[-1], path=path[:-1])
+
+    return jsonify(position={"latitude": player.latitude, "longitude": player.longitude},
+                   collected=[_serialize_gameobject(item) for item in collected])
+
 @APP.route("/api/v2/user/register")
 def _register_user():
     """ Create the User defined in the Authorization header """
@@ -164,3 +291,423 @@ def _register_user():
         # If a user with this name already exists, return an error
         # FIXME proper error
         return ("", 409)
+
+@APP.route("/api/v2/user/token")
+def _get_token():
+    """ Return a session token for the user that is currently logged in.
+
+    The token can be sent as Authorization: Bearer <token> instead of the
+    credentials for later requests. Tokens are only issued for the
+    password, so a token cannot be renewed forever.
+    """
+
+    # Check if a user is logged in with the password, in the first place
+    if g.user is None or g.auth_method != "password":
+        return needs_authentication()
+
+    return jsonify(token=g.user.create_token(),
+                   expires_in=APP.config['AUTH_TOKEN_MAX_AGE'])
+
+def _serialize_gameobject(gameobject, inventory=False):
+    """ Serialize a game object to a JSON API resource object with the
+    attributes and relationships used by the map view.
+    """
+
+    resource = {"id": str(gameobject.id),
+                "type": gameobject.gameobject_type,
+                "attributes": {"name": gameobject.name,
+                               "image": gameobject.image,
+                               "latitude": gameobject.latitude,
+                               "longitude": gameobject.longitude,
+                               "isonmap": bool(gameobject.isonmap),
+                               "gameobject_type": gameobject.gameobject_type},
+                "relationships": {"world": {"data": {"id": str(gameobject.world_id),
+                                                     "type": "world"}}}}
+
+    if inventory:
+        resource["relationships"]["inventory"] = {"data": [
+            {"id": str(item.id), "type": item.gameobject_type}
+            for item in gameobject.inventory]}
+
+    return resource
+
+# Columns of game objects needed to show them on the map
+_MAP_COLUMNS = [GameObject.id, GameObject.type, GameObject.name, GameObject.image,
+                GameObject.latitude, GameObject.longitude, GameObject.world_id]
+
+def _select_map_rows(*filters, columns=_MAP_COLUMNS):
+    """ Select the columns needed for the map of all game objects matching
+    the filters, as plain rows without building ORM objects.
+
+    The filters may use columns of the item table, which is joined.
+    """
+
+    _tables = GameObject.__table__.outerjoin(Item.__table__, Item.__table__.c.id == GameObject.id)
+
+    return DB.session.execute(select_columns(columns).select_from(_tables).where(and_(*filters)))
+
+def _serialize_map_rows(rows):
+    """ Serialize rows selected by _select_map_rows like _serialize_gameobject.
+
+    The rows are expected to be filtered by GameObject.isonmap.
+    """
+
+    # Resource types are the table names of the classes, by polymorphic identity
+    _types = {mapper.polymorphic_identity: mapper.class_.__tablename__
+              for mapper in GameObject.__mapper__.self_and_descendants}
+
+    return [{"id": str(id_),
+             "type": _types.get(type_, GameObject.__tablename__),
+             "attributes": {"name": name,
+                            "image": image,
+                            "latitude": latitude,
+                            "longitude": longitude,
+                            "isonmap": True,
+                            "gameobject_type": _types.get(type_, GameObject.__tablename__)},
+             "relationships": {"world": {"data": {"id": str(world_id), "type": "world"}}}}
+            for id_, type_, name, image, latitude, longitude, world_id in rows]
+
+def _json_response(**kwargs):
+    """ Build a compact JSON response, encoded with ujson if installed. """
+
+    if ujson is None:
+        body = json.dumps(kwargs, separators=(",", ":"))
+    else:
+        body = ujson.dumps(kwargs)
+
+    return Response(body, mimetype="application/json")
+
+def _parse_bbox(value):
+    """ Parse a bounding box like lat_min,lon_min,lat_max,lon_max. """
+
+    bbox = [float(x) for x in value.split(",")]
+    if len(bbox) != 4:
+        raise ValueError("Bounding box needs four values.")
+    return bbox
+
+def _get_visibility_key(world):
+    """ Get a short string identifying everything the visibility of game
+    objects for the current player depends on, except the objects themselves.
+
+    Objects can appear or disappear without changing when this changes, e.g.
+    when the player moves in a game with visible radii, or collects so many
+    items of a class that owned_max hides the others.
+    """
+
+    player = g.user.current_player
+    if player is None or player.world_id != world.id:
+        return ""
+    mod = world.game.module
+
+    # Position, if visibility depends on the distance to the player
+    state = [player.id]
+    if any(name.startswith("VISIBLE_RAD_") for name in dir(mod)):
+        state.append((player.latitude, player.longitude))
+
+    # Item classes hidden by owned_max, and attributes required by items
+    keys = set()
+    for mapper in Item.__mapper__.self_and_descendants:
+        cls = mapper.class_
+        if (cls.owned_max is not None and not cls.show_if_owned_max and
+                player.has_item(cls) >= cls.owned_max):
+            state.append(mapper.polymorphic_identity)
+        keys.update(getattr(cls, "spawn_player_attributes", {}).keys())
+    if keys:
+        state.append(sorted(player.get_attribute_values(list(keys)).items()))
+
+    return hashlib.sha1(repr(state).encode("utf-8")).hexdigest()[:16]
+
+def _make_cursor(timestamp, bbox, key):
+    """ Build the opaque cursor returned to clients for syncing changes. """
+
+    return "%s;%s;%s" % (timestamp.strftime(_CURSOR_FORMAT), ",".join(repr(x) for x in bbox), key)
+
+def _parse_cursor(cursor):
+    """ Parse a cursor into a tuple like (timestamp, bbox, visibility key). """
+
+    timestamp, bbox, key = cursor.split(";")
+    return datetime.strptime(timestamp, _CURSOR_FORMAT), _parse_bbox(bbox), key
+
+# Format of timestamps in cursors
+_CURSOR_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+def _get_viewport_response(world, bbox, cursor=None):
+    """ Build the response for the viewport and changes endpoints.
+
+    Without a cursor, all visible game objects within the box are returned.
+    With a cursor, only game objects that changed since it was issued or
+    that were outside the box of the cursor are returned, and objects that
+    were removed are listed by id.
+    """
+
+    # Use database time, as the updated timestamps are set by the database
+    now = get_database_now(DB.session)
+    reset = True
+    key = _get_visibility_key(world)
+
+    # Get game objects of all types, leaving out owned items and objects
+    # the game hides from the current player
+    filters = [GameObject.world_id == world.id,
+               GameObject.in_bbox(*bbox),
+               Item.owner_id == None,
+               GameObject.isonmap]
+    removed = set()
+
+    if cursor is not None:
+        since, since_bbox, since_key = cursor
+
+        # Only sync changes if tombstones since then are still known, and
+        # the visibility of unchanged objects cannot have changed
+        if (since_key == key and
+                now - since < timedelta(seconds=APP.config['SYNC_TOMBSTONE_MAX_AGE'])):
+            reset = False
+
+            # Overlap by two seconds, as timestamps may only have second
+            # resolution, and SQLite compares them as text, so a row from
+            # the same second as the bound sorts before it
+            since = since - timedelta(seconds=2)
+
+            # Only get objects that changed or came into view
+            filters.append(or_(GameObject.updated >= since,
+                               ~GameObject.in_bbox(*since_bbox)))
+
+            # Objects in the old box that moved out of view, were collected or were hidden
+            moved = _select_map_rows(GameObject.world_id == world.id,
+                                     GameObject.updated >= since,
+                                     GameObject.in_bbox(*since_bbox),
+                                     or_(~GameObject.in_bbox(*bbox),
+                                         Item.owner_id != None,
+                                         ~GameObject.isonmap),
+                                     columns=[GameObject.id])
+            removed.update(row[0] for row in moved)
+
+            # Deleted objects
+            tombstones = DB.session.query(GameObjectTombstone.gameobject_id).filter(
+                GameObjectTombstone.world_id == world.id,
+                GameObjectTombstone.created >= since).all()
+            removed.update(row[0] for row in tombstones)
+
+    # Serialize plain rows, as the visibility rules are applied in the query
+    current_player_id = None if g.user.current_player is None else g.user.current_player.id
+    data = _serialize_map_rows(row for row in _select_map_rows(*filters)
+                               if row[0] != current_player_id)
+
+    included = []
+    if g.user.current_player is not None and g.user.current_player.world is world:
+        data.append(_serialize_gameobject(g.user.current_player, inventory=True))
+        included = [_serialize_gameobject(item) for item in g.user.current_player.inventory]
+        removed.discard(g.user.current_player.id)
+
+    return _json_response(data=data, included=included,
+                          removed=[str(id_) for id_ in sorted(removed)],
+                          cursor=_make_cursor(now, bbox, key), reset=reset)
+
+@APP.route("/api/v2/world/<int:id_>/viewport")
+def _get_viewport(id_):
+    """ Return all visible game objects of all types within a bounding box.
+
+    The box is passed as ?bbox=lat_min,lon_min,lat_max,lon_max. The own
+    player is always returned, with the items in its inventory included.
+    """
+
+    # Check if a user is logged in, in the first place
+    if g.user is None:
+        return needs_authentication()
+
+    # Find world
+    world = World.query.get(id_)
+    if world is None:
+        # FIXME more specific error
+        return ("", 404)
+
+    # Parse bounding box
+    try:
+        bbox = _parse_bbox(request.args["bbox"])
+    except (KeyError, ValueError):
+        # FIXME more specific error
+        return ("", 400)
+
+    return _get_viewport_response(world, bbox)
+
+@APP.route("/api/v2/world/<int:id_>/changes")
+def _get_changes(id_):
+    """ Return game objects within a bounding box that changed since a cursor.
+
+    The box is passed as ?bbox=lat_min,lon_min,lat_max,lon_max and the cursor
+    returned by the last call to this endpoint or the viewport endpoint as
+    ?cursor=. Without a cursor, or if it is too old, the full viewport is
+    returned and reset is set to true.
+    """
+
+    # Check if a user is logged in, in the first place
+    if g.user is None:
+        return needs_authentication()
+
+    # Find world
+    world = World.query.get(id_)
+    if world is None:
+        # FIXME more specific error
+        return ("", 404)
+
+    # Parse bounding box and cursor
+    try:
+        bbox = _parse_bbox(request.args["bbox"])
+        cursor = _parse_cursor(request.args["cursor"]) if "cursor" in request.args else None
+    except (KeyError, ValueError):
+        # FIXME more specific error
+        return ("", 400)
+
+    return _get_viewport_response(world, bbox, cursor)
+
+# Columns never included in listings and exports
+_LIST_EXCLUDE = ['password']
+
+def _get_collection_model(name):
+    """ Get the model of a collection that can be listed by its name,
+    or abort with 404 Not Found.
+    """
+
+    collections = {"user": User, "game": Game, "world": World}
+    for mapper in GameObject.__mapper__.self_and_descendants:
+        # Only the framework classes have their own collections
+        if mapper.class_.__module__ == GameObject.__module__:
+            collections[mapper.class_.__tablename__] = mapper.class_
+
+    if name not in collections:
+        abort(404)
+    return collections[name]
+
+def _select_collection(model):
+    """ Get a select statement for all plain columns of a model, ordered
+    by id, without building ORM objects from its rows.
+    """
+
+    mapper = model.__mapper__
+    columns = [prop.columns[0].label(prop.key) for prop in mapper.column_attrs
+               if prop.key not in _LIST_EXCLUDE]
+
+    return select_columns(columns).select_from(get_mapped_table(mapper)).order_by(
+        mapper.primary_key[0])
+
+def _serialize_row(collection, keys, row):
+    """ Serialize a plain row of a collection, with the column names of
+    its result, to a JSON API resource object.
+    """
+
+    attributes = {}
+    for key, value in zip(keys, row):
+        if isinstance(value, (datetime, date)):
+            value = value.isoformat()
+        elif value is not None and not isinstance(value, (str, int, float, bool)):
+            value = str(value)
+        attributes[key] = value
+
+    return {"id": str(attributes.pop("id")), "type": collection, "attributes": attributes}
+
+@APP.route("/api/v2/<string:collection>")
+def _get_collection_page(collection):
+    """ Return one page of a collection, ordered by id.
+
+    Pages are selected by ?after=<id>, the id of the last object of the
+    previous page, and ?limit=<number>. The URL of the next page is
+    returned in links/next, and is null on the last page. Only available
+    to administrators.
+    """
+
+    # Check if a user is logged in, in the first place
+    if g.user is None:
+        return needs_authentication()
+    # Listings show all objects regardless of their visibility
+    if g.user.role != Roles.admin.value:
+        # FIXME more specific error
+        return ("", 403)
+
+    model = _get_collection_model(collection)
+
+    # Parse page parameters
+    try:
+        limit = min(int(request.args.get("limit", APP.config['API_PAGE_SIZE'])),
+                    APP.config['API_MAX_PAGE_SIZE'])
+        after = request.args.get("after", None)
+        if after is not None:
+            after = int(after)
+    except ValueError:
+        # FIXME more specific error
+        return ("", 400)
+    if limit < 1:
+        return ("", 400)
+
+    # Continue after the last id, which uses the primary key index
+    stmt = _select_collection(model).limit(limit)
+    if after is not None:
+        stmt = stmt.where(model.__mapper__.primary_key[0] > after)
+    result = DB.session.execute(stmt)
+    keys = list(result.keys())
+    data = [_serialize_row(collection, keys, row) for row in result]
+
+    if len(data) == limit:
+        next_url = "%s?%s" % (request.base_url, urlencode({"after": data[-1]["id"],
+                                                           "limit": limit}))
+    else:
+        next_url = None
+
+    return _json_response(data=data, links={"next": next_url})
+
+@APP.route("/api/v2/<string:collection>/export")
+def _export_collection(collection):
+    """ Stream a whole collection, ordered by id.
+
+    The default ?format=jsonl sends one resource object per line, and
+    ?format=json sends a JSON API document. Rows are fetched in batches
+    from a server-side cursor, so the size of the collection does not
+    matter for memory. Only available to administrators.
+    """
+
+    # Check if a user is logged in, in the first place
+    if g.user is None:
+        return needs_authentication()
+    if g.user.role != Roles.admin.value:
+        # FIXME more specific error
+        return ("", 403)
+
+    model = _get_collection_model(collection)
+    fmt = request.args.get("format", "jsonl")
+    if fmt not in ("json", "jsonl"):
+        return ("", 400)
+
+    stmt = _select_collection(model)
+    batch_size = APP.config['API_EXPORT_BATCH_SIZE']
+
+    def _generate():
+        # Use an own connection, as the session is gone while streaming
+        connection = DB.engine.connect()
+        try:
+            result = connection.execution_options(stream_results=True).execute(stmt)
+            keys = list(result.keys())
+
+            if fmt == "json":
+                yield '{"data":['
+
+            first = True
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                for row in rows:
+                    line = json.dumps(_serialize_row(collection, keys, row), separators=(",", ":"))
+                    if fmt == "jsonl":
+                        yield line + "\n"
+                    elif first:
+                        yield line
+                    else:
+                        yield "," + line
+                    first = False
+
+            if fmt == "json":
+                yield ']}'
+        finally:
+            connection.close()
+
+    mimetype = "application/json" if fmt == "json" else "application/x-ndjson"
+    return Response(_generate(), mimetype=mimetype)
@@ -0,0 +1,240 @@
+"""
+Background spawn scheduler for the Veripeditus server
+
+This module contains the scheduler that runs the spawn code of all
+game object classes outside of the request path.
+"""
+
+# veripeditus-server - Server component for the Veripeditus game framework
+# Copyright (C) 2016, 2017  Dominik George <nik@naturalnet.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+
+from flask import g
+
+from veripeditus.framework.model import GameObject, GameObjectTombstone
+from veripeditus.server.app import APP, DB
+from veripeditus.server.model import Game, World
+
+_LOGGER = logging.getLogger(__name__)
+
+def get_spawn_classes():
+    """ Get all game object classes defined in games, grouped by game package.
+
+    Returns a dictionary like {package: [class, …]}.
+    """
+
+    classes = {}
+
+    # Iterate over the framework base classes and their implementations in games
+    for base in GameObject.__subclasses__():
+        for cls in base.__subclasses__():
+            # Game classes live in veripeditus.game.<package>
+            package = cls.__module__.split(".")[2]
+            classes.setdefault(package, []).append(cls)
+
+    return classes
+
+def spawn_class(cls, world):
+    """ Run the spawn code of one game object class in one world. """
+
+    if "spawn" in vars(cls):
+        # Call custom spawn code of the game
+        cls.spawn(world)
+    else:
+        # Call parameterised default spawn code
+        cls.spawn_default(world)
+
+class SpawnScheduler(object):
+    """ Scheduler running the spawn code of game object classes periodically.
+
+    Every (world, class) pair is a job that becomes due after an interval.
+    The interval is taken from the spawn_interval attribute of the class,
+    the SPAWN_WORLD_INTERVALS configuration for the world or the
+    SPAWN_INTERVAL default, whichever is found first. At most SPAWN_BUDGET
+    jobs are run per tick.
+
+    Spawning in a world can be requested before its jobs are due, either
+    by calling trigger in the process running the scheduler, or from any
+    process by setting World.spawn_requested.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+        # Time of next run per (world id, class), filled on first sight
+        self._due = {}
+        # Worlds for which a spawn was requested on demand
+        self._triggered = set()
+        # Last seen World.spawn_requested per world id
+        self._requested = {}
+        # Requested jobs that did not fit into the budget of a tick
+        self._carried = set()
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def get_interval(self, world_id, cls):
+        """ Determine the spawn interval in seconds for a job. """
+
+        if getattr(cls, "spawn_interval", None) is not None:
+            return cls.spawn_interval
+
+        world_intervals = self.app.config['SPAWN_WORLD_INTERVALS']
+        if world_id in world_intervals:
+            return world_intervals[world_id]
+
+        return self.app.config['SPAWN_INTERVAL']
+
+    def trigger(self, world_id):
+        """ Request spawning all classes in a world on the next tick. """
+
+        with self._lock:
+            self._triggered.add(world_id)
+
+        # Wake up the worker thread, if any
+        self._wakeup.set()
+
+    def _get_jobs(self, now):
+        """ Get a list of all (world, class) pairs that are due now.
+
+        Triggered worlds come first, then the jobs that are overdue the longest.
+        """
+
+        with self._lock:
+            triggered = self._triggered
+            self._triggered = set()
+        carried = self._carried
+        self._carried = set()
+
+        classes = get_spawn_classes()
+        jobs = []
+
+        # Find all enabled worlds running a game with spawnable classes
+        worlds = World.query.join(Game).filter(World.enabled == True,
+                                               Game.package.in_(list(classes.keys()))).all()
+        for world in worlds:
+            # Spawns requested by other processes through the database
+            if (world.spawn_requested is not None and
+                    world.spawn_requested != self._requested.get(world.id)):
+                self._requested[world.id] = world.spawn_requested
+                triggered.add(world.id)
+
+            for cls in classes[world.game.package]:
+                due = self._due.setdefault((world.id, cls), now)
+                if world.id in triggered or (world.id, cls) in carried:
+                    jobs.append((float("-inf"), world, cls))
+                elif due <= now:
+                    jobs.append((due, world, cls))
+
+        jobs.sort(key=lambda job: job[0])
+        return [(world, cls) for _, world, cls in jobs]
+
+    def run_pending(self, now=None):
+        """ Run all due spawn jobs, up to the configured budget.
+
+        Must be called within an application context. Returns the number
+        of jobs that were run.
+        """
+
+        if now is None:
+            now = time.monotonic()
+
+        # Spawn code does not run on behalf of any user
+        g.user = None
+
+        jobs = self._get_jobs(now)
+        budget = self.app.config['SPAWN_BUDGET']
+        if budget:
+            # Jobs exceeding the budget stay due, but requested jobs that are
+            # not due are kept for the next tick, without waking up early
+            self._carried = {(world.id, cls) for world, cls in jobs[budget:]
+                             if self._due[(world.id, cls)] > now}
+            jobs = jobs[:budget]
+
+        for world, cls in jobs:
+            # Schedule next run before running, so failing jobs do not loop
+            self._due[(world.id, cls)] = now + self.get_interval(world.id, cls)
+
+            try:
+                spawn_class(cls, world)
+            except Exception: # pylint: disable=broad-except
+                _LOGGER.exception("Spawning %s in world %i failed.", cls.__name__, world.id)
+                DB.session.rollback()
+
+        # Forget deleted objects no client can still be waiting for
+        try:
+            GameObjectTombstone.prune(self.app.config['SYNC_TOMBSTONE_MAX_AGE'])
+        except Exception: # pylint: disable=broad-except
+            _LOGGER.exception("Pruning tombstones failed.")
+            DB.session.rollback()
+
+        # Give back the connection used in this tick
+        DB.session.remove()
+
+        return len(jobs)
+
+    def run(self):
+        """ Run ticks until stop() is called. """
+
+        while not self._stopped.is_set():
+            with self.app.app_context():
+                try:
+                    self.run_pending()
+                except Exception: # pylint: disable=broad-except
+                    _LOGGER.exception("Spawn tick failed.")
+
+            # Sleep until the next tick or until triggered
+            self._wakeup.wait(self.app.config['SPAWN_TICK'])
+            self._wakeup.clear()
+
+    def start(self):
+        """ Start the worker thread, if it is not running yet. """
+
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run, name="veripeditus-spawn")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the worker thread and wait for it to finish. """
+
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+# Scheduler instance used by the server
+SCHEDULER = SpawnScheduler(APP)
+
+@APP.before_request
+def _start_spawn_scheduler():
+    """ Start the spawn worker thread if enabled and not running yet.
+
+    This is deferred to a request so the thread is started in the worker
+    process, not in a pre-forking master process.
+    """
+
+    if APP.config['SPAWN_THREAD']:
+        SCHEDULER.start()
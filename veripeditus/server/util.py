@@ -28,6 +28,7 @@ import pkgutil
 import sys
 
 import magic
+import sqlalchemy
 
 def get_game_names():
     """
@@ -46,25 +47,86 @@ def get_game_names():
 
     return _pkgs
 
-def get_games():
+# Registry of installed games, filled by reload_games()
+_GAMES = None
+_GAME_CONSTANTS = None
+
+def reload_games():
     """
-    Get a list of installed game modules
+    Discover installed games and (re-)build the game registry.
+
+    Games that were installed after the last discovery are imported,
+    already imported game modules are kept as they are.
 
     Returns a dictionary like {name: module}
     """
 
+    # pragma pylint: disable=global-statement
+    global _GAMES, _GAME_CONSTANTS
+
+    # Make the import system see newly installed packages
+    importlib.invalidate_caches()
+
     # Get game names and import modules, build dict
     _pkgs = {i: importlib.import_module("veripeditus.game." + i)
              for i in get_game_names()}
 
+    # Resolve constants (upper-case module attributes) of all games
+    _constants = {i: {k: v for k, v in vars(_pkgs[i]).items() if k.isupper()}
+                  for i in _pkgs}
+
+    # Replace registry in one go so readers never see a partial state
+    _GAMES, _GAME_CONSTANTS = _pkgs, _constants
+
+    # Images of games might have changed as well
+    # Imported here because the framework depends on the server being set up
+    # pragma pylint: disable=cyclic-import
+    from veripeditus.framework.util import clear_image_index
+    clear_image_index()
+
     return _pkgs
 
+def get_games():
+    """
+    Get a list of installed game modules
+
+    Returns a dictionary like {name: module}
+    """
+
+    # Discover games on first use
+    if _GAMES is None:
+        return reload_games()
+
+    return _GAMES
+
 def get_game_by_name(name):
     """
     Get a game module object by its name.
+
+    Games that are not in the registry yet, e.g. because another process
+    installed them, are discovered again once before giving up.
+    """
+
+    games = get_games()
+
+    # The game might have been installed after discovery
+    if name not in games:
+        games = reload_games()
+
+    return games[name]
+
+def get_game_constants(name):
+    """
+    Get the constants (e.g. NAME, VERSION, HIDE_SELF) defined by a game.
+
+    Returns a dictionary like {constant: value}
     """
 
-    return get_games()[name]
+    # Make sure the registry is filled, and contains newly installed games
+    if name not in get_games():
+        reload_games()
+
+    return _GAME_CONSTANTS[name]
 
 def get_data_path():
     """
@@ -92,6 +154,28 @@ def api_method(authenticated=True):
 
     return _real_api_method
 
+# SQLAlchemy version as tuple of numbers, like (1, 1)
+_SA_VERSION = tuple(int(part) for part in sqlalchemy.__version__.split(".")[:2])
+
+def select_columns(columns):
+    """ Get a select statement for a list of columns.
+
+    SQLAlchemy 1.4 and later take the columns as arguments, older
+    versions only as a list.
+    """
+
+    if _SA_VERSION >= (1, 4):
+        return sqlalchemy.select(*columns)
+    return sqlalchemy.select(columns)
+
+def get_mapped_table(mapper):
+    """ Get the table or join of tables a mapper stores its objects in. """
+
+    # Renamed from mapped_table in SQLAlchemy 1.3
+    if _SA_VERSION >= (1, 3):
+        return mapper.persist_selectable
+    return mapper.mapped_table
+
 # Find out what MIME magic module is in use
 # pragma pylint: disable=no-member
 if "MIME" in vars(magic):
@@ -35,12 +35,19 @@ GameDataService = function() {
     self.gameobjects = {};
     self.gameobjects_temp = {};
     self.gameobjects_missing = 0;
-    self.gameobject_types = ["Player", "Item", "NPC"];
     self.worlds = {};
 
+    // Cursor and world for syncing only changes of gameobjects
+    self.sync_cursor = null;
+    self.sync_world_id = null;
+
     // Current player id
     self.current_player_id = -1;
 
+    // Push channel, used if a URL of the push server is configured
+    self.push_url = localStorage.push_url;
+    self.push_socket = null;
+
     self.doRequest = function(method, url, cb, data) {
         // Fill options here
         var options = {};
@@ -81,16 +88,70 @@ GameDataService = function() {
             self.gameobjects[self.current_player_id].attributes.latitude = Device.position.coords.latitude;
             self.gameobjects[self.current_player_id].attributes.longitude = Device.position.coords.longitude;
 
-            // Check time of last update
-            if (Date.now() - self.last_location_update > 5000) {
-                // Send the update request
-                self.doRequest("GET", "/api/v2/gameobject/" + self.current_player_id + "/update_position/" + self.gameobjects[self.current_player_id].attributes.latitude + "," + self.gameobjects[self.current_player_id].attributes.longitude);
-                self.last_location_update = Date.now();
+            if (self.isPushConnected()) {
+                // Send the update over the push channel
+                self.push_socket.send(JSON.stringify({
+                    "position": [self.gameobjects[self.current_player_id].attributes.latitude,
+                                 self.gameobjects[self.current_player_id].attributes.longitude]
+                }));
+            } else {
+                // Buffer the fix, dropping the oldest ones on long outages
+                self.position_fixes.push({
+                    "latitude": Device.position.coords.latitude,
+                    "longitude": Device.position.coords.longitude,
+                    "timestamp": Device.position.timestamp
+                });
+                self.position_fixes = self.position_fixes.slice(-100);
+
+                // Check time of last update
+                if (Date.now() - self.last_location_update > 5000) {
+                    self.sendPositionFixes();
+                    self.last_location_update = Date.now();
+                }
+            }
+        }
+    };
+
+    self.position_fixes = [];
+    self.sendPositionFixes = function() {
+        // Send all buffered fixes in one request
+        var fixes = self.position_fixes;
+        self.position_fixes = [];
+        var req = self.doRequest("POST", "/api/v2/gameobject_player/self/positions", function(data) {
+            // Reload gameobjects if something was collected on the way
+            if (data.collected.length > 0) {
+                self.updateGameObjects();
             }
+        }, JSON.stringify({"fixes": fixes}));
+
+        if (req) {
+            // Keep fixes for the next try if sending failed
+            req.fail(function() {
+                self.position_fixes = fixes.concat(self.position_fixes).slice(-100);
+            });
         }
     };
 
     self.onReturnGameObjects = function(data) {
+        if (!data.reset) {
+            // Start from known gameobjects still within the view bounds
+            $.each(self.gameobjects, function(id, go) {
+                if (id == self.current_player_id || (
+                        go.attributes.latitude >= self.bounds[0][0] && go.attributes.latitude <= self.bounds[1][0] &&
+                        go.attributes.longitude >= self.bounds[0][1] && go.attributes.longitude <= self.bounds[1][1])) {
+                    self.gameobjects_temp[id] = go;
+                }
+            });
+
+            // Drop removed gameobjects
+            for (var i = 0; i < data.removed.length; i++) {
+                delete self.gameobjects_temp[data.removed[i]];
+            }
+        }
+
+        // Remember cursor for next sync
+        self.sync_cursor = data.cursor;
+
         // Iterate over data and merge into gameobjects store
         for (var i = 0; i < data.data.length; i++) {
             var go = data.data[i];
@@ -130,65 +191,31 @@ GameDataService = function() {
 
         // Only run if logged-in
         if (self.current_player_id > -1) {
-            // Construct JSON query filter for REST API
-            var query = [{
-                'or': [{
-                    'and': [{
-                        'name': 'latitude',
-                        'op': 'ge',
-                        'val': self.bounds[0][0]
-                    },
-                    {
-                        'name': 'latitude',
-                        'op': 'le',
-                        'val': self.bounds[1][0]
-                    },
-                    {
-                        'name': 'longitude',
-                        'op': 'ge',
-                        'val': self.bounds[0][1]
-                    },
-                    {
-                        'name': 'longitude',
-                        'op': 'le',
-                        'val': self.bounds[1][1]
-                    },
-                    {
-                        'name': 'world',
-                        'op': 'has',
-                        'val': {
-                            'name': 'id',
-                            'op': 'eq',
-                            'val': self.gameobjects[self.current_player_id].relationships.world.data.id
-                        }
-                    },
-                    {
-                        'name': 'isonmap',
-                        'op': 'eq',
-                        'val': true
-                    }]
-                },
-                {
-                    'name': 'id',
-                    'op': 'eq',
-                    'val': self.current_player_id
-                }]
-            }];
-
-            // Define and trace gameobject types to load
-            self.gameobjects_missing = self.gameobject_types.length;
+            // Construct bounding box for changes API
+            var bbox = [self.bounds[0][0], self.bounds[0][1], self.bounds[1][0], self.bounds[1][1]].join(",");
+            var world_id = self.gameobjects[self.current_player_id].relationships.world.data.id;
+            var params = {
+                'bbox': bbox
+            };
+
+            // Only load changes if the world is still the same
+            if (self.sync_cursor && self.sync_world_id == world_id) {
+                params.cursor = self.sync_cursor;
+            }
+            self.sync_world_id = world_id;
+
+            // Trace response to load
+            self.gameobjects_missing = 1;
 
             // Clear out gameobjects
             self.gameobjects_temp = {};
 
-            $.each(self.gameobject_types, function(i, gameobject_type) {
-                self.doRequest("GET", "/api/" + gameobject_type, self.onReturnGameObjects, {
-                    'filter[objects]': JSON.stringify(query)
-                });
-            });
+            // Load changed gameobjects of all types in one request
+            self.doRequest("GET", "/api/v2/world/" + world_id + "/changes", self.onReturnGameObjects, params);
         } else {
             // Invalidate game
             self.gameobjects = {};
+            self.sync_cursor = null;
 
             // Call onUpdatedGameObjects on all views
             $.each(Veripeditus.views, function(id, view) {
@@ -199,12 +226,74 @@ GameDataService = function() {
         }
     };
 
+    self.isPushConnected = function() {
+        return self.push_socket != null && self.push_socket.readyState == WebSocket.OPEN;
+    };
+
+    self.pushSubscribe = function() {
+        // Subscribe to events in the current world and view bounds
+        if (self.isPushConnected() && self.current_player_id > -1) {
+            self.push_socket.send(JSON.stringify({
+                "subscribe": {
+                    "world": self.gameobjects[self.current_player_id].relationships.world.data.id,
+                    "bbox": [self.bounds[0][0], self.bounds[0][1], self.bounds[1][0], self.bounds[1][1]]
+                }
+            }));
+        }
+    };
+
+    self.onPushMessage = function(message) {
+        var data = JSON.parse(message.data);
+
+        if (data.event == "spawn" || data.event == "move") {
+            var gameobject = self.gameobjects[data.gameobject.id];
+            if (gameobject) {
+                // Merge into the known object, keeping e.g. the inventory of the own player
+                $.extend(gameobject.attributes, data.gameobject.attributes);
+                $.extend(gameobject.relationships, data.gameobject.relationships);
+            } else {
+                self.gameobjects[data.gameobject.id] = data.gameobject;
+            }
+        } else if ((data.event == "remove" || data.event == "collect") && data.id != self.current_player_id) {
+            delete self.gameobjects[data.id];
+        } else {
+            return;
+        }
+
+        // Call onUpdatedGameObjects on all views
+        $.each(Veripeditus.views, function(id, view) {
+            if (view.onUpdatedGameObjects) {
+                view.onUpdatedGameObjects();
+            }
+        });
+    };
+
+    self.connectPush = function() {
+        // Skip if not configured or already connected
+        if (!self.push_url || !window.WebSocket || self.push_socket != null) {
+            return;
+        }
+
+        // Get a session token to authenticate with
+        self.doRequest("GET", "/api/v2/user/token", function(data) {
+            self.push_socket = new WebSocket(self.push_url + "?token=" + encodeURIComponent(data.token));
+            self.push_socket.onopen = self.pushSubscribe;
+            self.push_socket.onmessage = self.onPushMessage;
+            self.push_socket.onclose = function() {
+                // Fall back to requests until reconnected
+                self.push_socket = null;
+            };
+        });
+    };
+
     self.updateSelf = function() {
         // Request own player item
         self.doRequest("GET", "/api/v2/gameobject_player/self", function(data) {
             self.current_player_id = data.data.id;
             self.gameobjects[data.data.id] = data.data;
             self.updateGameObjects();
+            self.connectPush();
+            self.pushSubscribe();
         });
 
         // Request list of worlds
@@ -227,6 +316,7 @@ GameDataService = function() {
         self.bounds[1] = northEast;
 
         self.updateGameObjects();
+        self.pushSubscribe();
     };
 
     self.login = function(username, password) {
@@ -252,6 +342,11 @@ GameDataService = function() {
         localStorage.removeItem("username");
         localStorage.removeItem("password");
 
+        // Close push channel
+        if (self.push_socket != null) {
+            self.push_socket.close();
+        }
+
         // This wil invalidate the game
         self.current_player_id = -1;
         self.updateGameObjects();